@@ -0,0 +1,76 @@
+import time
+
+class AdaptivePoller():
+    '''
+    Chooses a read interval for each controller from how fast its
+    temperature is changing and how far it is from its setpoint
+
+    * A controller that is ramping (|dT/dt| above rateThreshold, degrees per
+      second) or far from setpoint (|T - setpoint| above errorThreshold) is
+      read as often as every minInterval seconds
+    * A stable controller falls back toward maxInterval (the configured
+      readinterval)
+    * The intervals are stretched when needed so the total number of reads
+      per second stays within budget
+    '''
+    def __init__(self, minInterval, maxInterval, rateThreshold=0.05, errorThreshold=2, budget=10):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.rateThreshold = rateThreshold
+        self.errorThreshold = errorThreshold
+        self.budget = budget
+
+        # Last temperature, time and setpoint by address:
+        self._temps = {}
+        self._rates = {}
+        self._setpoints = {}
+
+    def update(self, reading):
+        '''
+        BusEngine listener, tracks the rate of change and setpoint of each
+        controller
+        '''
+        if reading['error'] is not None:
+            return
+        address = reading['address']
+        if reading['command'] == 'setpoint':
+            self._setpoints[address] = reading['data']
+        elif reading['command'] == 'currentTemp':
+            now = time.monotonic()
+            previous = self._temps.get(address)
+            if previous and now > previous[1]:
+                self._rates[address] = (reading['data'] - previous[0]) / (now - previous[1])
+            self._temps[address] = (reading['data'], now)
+
+    def activity(self, address):
+        '''
+        Returns how far a controller is from being stable (0 = stable, 1 =
+        at the rate or error threshold)
+        '''
+        rate = abs(self._rates.get(address, 0)) / self.rateThreshold
+        error = 0
+        if address in self._temps and address in self._setpoints:
+            error = abs(self._temps[address][0] - self._setpoints[address]) / self.errorThreshold
+        return max(rate, error)
+
+    def interval(self, address):
+        interval = self.maxInterval / (1 + self.maxInterval / self.minInterval * self.activity(address))
+        return min(max(interval, self.minInterval), self.maxInterval)
+
+    def intervals(self, addresses):
+        '''
+        Returns {address: read interval in seconds} within the bus budget
+        '''
+        intervals = {address: self.interval(address) for address in addresses}
+        # Stretches the intervals that are not yet at maxInterval until the
+        # total fits the budget (or every controller is at maxInterval)
+        while self.budget and sum(1 / interval for interval in intervals.values()) > self.budget * 1.000001:
+            free = [address for address, interval in intervals.items() if interval < self.maxInterval]
+            if not free:
+                break
+            freeBudget = self.budget - sum(1 / intervals[address] for address in intervals if address not in free)
+            freeRate = sum(1 / intervals[address] for address in free)
+            scale = freeRate / freeBudget if freeBudget > 0 else float('inf')
+            for address in free:
+                intervals[address] = min(intervals[address] * scale, self.maxInterval)
+        return intervals
@@ -0,0 +1,127 @@
+class Watchdog():
+    '''
+    Checks every current temp reading against per-controller alarm rules
+
+    * rules: {address: {'limit': degrees C or None, 'maxRate': degrees per
+      second or None}}
+    * A controller within margin degrees of its limit, or projected to reach
+      it within lookahead seconds at its current rate, is a 'warning': it is
+      re-read right away and then at least every interval seconds until it
+      is back to 'ok'
+    * At or above its limit, or rising faster than maxRate, it is an 'alarm'
+    * Each reading is checked in constant time from the previous reading of
+      the same controller. Listeners are called with an event dict whenever
+      a controller's level changes (from the bus thread)
+    '''
+    def __init__(self, engine, rules, interval=1, margin=10, lookahead=60):
+        self.engine = engine
+        self.rules = rules
+        self.interval = interval
+        self.margin = margin
+        self.lookahead = lookahead
+        self.listeners = []
+
+        # Last (temp, time, rate) and current event by address:
+        self._last = {}
+        self.state = {}
+        self.engine.addListener(self.check)
+
+    def close(self):
+        self.engine.removeListener(self.check)
+        for address in self.state:
+            self.engine.setPriority(address, None)
+
+    def addListener(self, func):
+        self.listeners.append(func)
+
+    def removeListener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def active(self):
+        '''
+        Returns the events of the controllers that are not 'ok'
+        '''
+        return [event for event in self.state.values() if event['level'] != 'ok']
+
+    def check(self, reading):
+        '''
+        BusEngine listener
+        '''
+        address = reading['address']
+        rule = self.rules.get(address)
+        if rule is None or reading['error'] is not None or reading['command'] != 'currentTemp':
+            return
+        temp, now = reading['data'], reading['time']
+        # Rate of rise from the previous reading. A re-read right after a
+        # reading gives a meaningless rate, the previous rate is kept instead
+        rate = None
+        last = self._last.get(address)
+        if last and now - last[1] >= self.interval / 2:
+            rate = (temp - last[0]) / (now - last[1])
+            self._last[address] = (temp, now, rate)
+        elif last:
+            rate = last[2]
+        else:
+            self._last[address] = (temp, now, None)
+
+        level, reason = 'ok', None
+        limit, maxRate = rule.get('limit'), rule.get('maxRate')
+        if limit is not None and temp >= limit:
+            level, reason = 'alarm', 'overTemp'
+        elif maxRate is not None and rate is not None and rate > maxRate:
+            level, reason = 'alarm', 'rateOfRise'
+        elif limit is not None and temp >= limit - self.margin:
+            level, reason = 'warning', 'nearLimit'
+        elif limit is not None and rate is not None and rate > 0 and temp + rate * self.lookahead >= limit:
+            level, reason = 'warning', 'nearLimit'
+        elif maxRate is not None and rate is not None and rate > maxRate / 2:
+            level, reason = 'warning', 'rateOfRise'
+
+        previous = self.state.get(address)
+        if previous is None and level == 'ok':
+            return
+        if previous is not None and previous['level'] == level and previous['reason'] == reason:
+            previous.update(temp=temp, rate=rate, time=now)
+            return
+        event = {'address': address, 'level': level, 'reason': reason, 'temp': temp, 'rate': rate,
+                 'limit': limit, 'maxRate': maxRate, 'time': now}
+        self.state[address] = event
+
+        if level == 'ok':
+            self.engine.setPriority(address, None)
+        elif previous is None or previous['level'] == 'ok':
+            # Confirms the reading right away, then keeps reading fast:
+            self.engine.readNow(address)
+            self.engine.setPriority(address, self.interval)
+        for listener in list(self.listeners):
+            try:
+                listener(dict(event))
+            except Exception as e:
+                print('watchdog listener: ', e)
+
+def watchdogRules(settings):
+    '''
+    Returns watchdog rules (degrees C) from the 'alarmtemp' (kelvin) and
+    'maxrate' options of the controllers in a parsed config file
+    '''
+    rules = {}
+    for controller in settings['controllers']:
+        if controller['alarmTemp'] is not None or controller['maxRate'] is not None:
+            rules[controller['address']] = {
+                'limit': controller['alarmTemp'] - 273.15 if controller['alarmTemp'] is not None else None,
+                'maxRate': controller['maxRate']
+            }
+    return rules
+
+def formatEvent(event, name=''):
+    '''
+    Returns a one-line description of a watchdog event (kelvin)
+    '''
+    if event['level'] == 'ok':
+        return '{0} (address {1}) back to normal at {2:.1f} K'.format(name, event['address'], event['temp'] + 273.15)
+    if event['reason'] == 'rateOfRise':
+        return '{0} (address {1}) {2}: rising {3:.2f} K/s (limit {4} K/s)'.format(
+            name, event['address'], event['level'].upper(), event['rate'], event['maxRate'])
+    return '{0} (address {1}) {2}: {3:.1f} K (limit {4:.1f} K)'.format(
+        name, event['address'], event['level'].upper(), event['temp'] + 273.15, event['limit'] + 273.15)
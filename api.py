@@ -0,0 +1,226 @@
+'''
+Local HTTP/JSON API for other lab tools
+
+Reads are served from the bus engine's latest-value cache and never cause
+bus traffic; setpoint commands are queued on the same engine as the GUI or
+headless poller. Temperatures are in kelvin, like the GUI; other parameters
+(heatPower, alarmState, loopMode with 'assembly' set) are as read.
+
+    GET  /readings              latest reading of every controller
+    GET  /readings/<address>    latest reading of one controller
+    GET  /stream                server-sent events, one per new reading
+    GET  /stats                 bus transaction and parameter cache counts
+    GET  /alarms                active over-temperature watchdog alarms
+    POST /setpoint              body: {"address": 1, "temp": 300}
+                                (409 while monitoring another master)
+
+/stream options: ?delta=1 only sends readings whose value changed,
+?format=binary sends packed records (see stream.binaryRecord) instead of
+SSE, ?queue=N sets how many readings are held for a slow client before the
+oldest are dropped. Watchdog level changes are sent to SSE clients as
+events with "event": "alarm".
+'''
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from stream import StreamHub
+
+class ApiServer():
+    '''
+    Serves a BusEngine's latest readings over HTTP on a background thread
+    '''
+    def __init__(self, engine, host='127.0.0.1', port=8765, maxTemp=None, names=None, watchdog=None):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.maxTemp = maxTemp
+        # Controller names by address, included in responses when known:
+        self.names = names or {}
+
+        # Serialized /readings bodies by address (None for all), cleared
+        # whenever the engine publishes a new reading:
+        self._cache = {}
+        self.engine.addListener(self._invalidate)
+
+        # Push streaming to /stream clients:
+        self.stream = StreamHub(self.engine.temperatureCommands)
+        self.engine.addListener(self.stream.publish)
+
+        # Optional alarms.Watchdog:
+        self.watchdog = watchdog
+        if self.watchdog:
+            self.watchdog.addListener(self._publishAlarm)
+
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self._handlerClass())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='ApiServer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.engine.removeListener(self._invalidate)
+        self.engine.removeListener(self.stream.publish)
+        if self.watchdog:
+            self.watchdog.removeListener(self._publishAlarm)
+        self.stream.close()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _invalidate(self, reading):
+        self._cache = {}
+
+    def _c_to_k(self, c):
+        return c + 273.15
+
+    def _k_to_c(self, k):
+        return k - 273.15
+
+    def alarm(self, event):
+        '''
+        Returns a watchdog event with temperatures in kelvin
+        '''
+        return dict(event, name=self.names.get(event['address']), temp=self._c_to_k(event['temp']),
+                    limit=self._c_to_k(event['limit']) if event['limit'] is not None else None)
+
+    def alarms(self):
+        active = self.watchdog.active() if self.watchdog else []
+        return json.dumps({'alarms': [self.alarm(event) for event in active]}).encode('utf-8')
+
+    def _publishAlarm(self, event):
+        self.stream.publishEvent('alarm', self.alarm(event))
+
+    def readings(self, address=None):
+        '''
+        Returns the latest readings as a serialized JSON body. Bodies are
+        cached until the next reading so repeated polling costs a dict lookup
+        '''
+        # A reading published while the body is built replaces self._cache,
+        # the body then only goes into the discarded cache:
+        cache = self._cache
+        body = cache.get(address)
+        if body is None:
+            controllers = {}
+            for (readingAddress, command), reading in list(self.engine.latest.items()):
+                if address is not None and readingAddress != address:
+                    continue
+                controller = controllers.setdefault(readingAddress, {
+                    'address': readingAddress,
+                    'name': self.names.get(readingAddress)
+                })
+                value = reading['data']
+                if command in self.engine.temperatureCommands:
+                    value = self._c_to_k(value)
+                controller[command] = {'value': value, 'time': reading['time']}
+            body = json.dumps({'readings': [controllers[a] for a in sorted(controllers)]}).encode('utf-8')
+            cache[address] = body
+        return body
+
+    def setTemp(self, address, tempK):
+        '''
+        Queues a setpoint change (kelvin). Returns an error string, or None
+        if the request was queued
+        '''
+        if self._listenOnly():
+            return 'Setpoints cannot be changed while monitoring another master.'
+        if address not in self.engine.controllers:
+            return 'No controller at address {0}.'.format(address)
+        if self.maxTemp and tempK > self.maxTemp:
+            return 'Setpoint exceeds max temperature.'
+        self.engine.set(address, self._k_to_c(tempK))
+
+    def _listenOnly(self):
+        # The engine drops writes while a BusMonitor listens (the bus
+        # process has no monitor):
+        return getattr(self.engine, 'listenOnly', False)
+
+    def _handlerClass(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _sendError(self, status, message):
+                self._send(status, json.dumps({'error': message}).encode('utf-8'))
+
+            def _stream(self, query):
+                encoding = 'binary' if query.get('format') == ['binary'] else 'json'
+                subscriber = api.stream.subscribe(encoding, query.get('delta') == ['1'],
+                                                  int(query.get('queue', ['256'])[0]))
+                self.send_response(200)
+                if encoding == 'binary':
+                    self.send_header('Content-Type', 'application/octet-stream')
+                else:
+                    self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    while not subscriber.closed:
+                        payloads = subscriber.get(timeout=15)
+                        if encoding == 'binary':
+                            self.wfile.write(b''.join(payloads))
+                        elif payloads:
+                            self.wfile.write(b''.join(b'data: ' + p + b'\n\n' for p in payloads))
+                        else:
+                            # Keeps idle connections open through proxies
+                            self.wfile.write(b': keepalive\n\n')
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    api.stream.unsubscribe(subscriber)
+
+            def do_GET(self):
+                path, _, queryString = self.path.partition('?')
+                parts = path.strip('/').split('/')
+                try:
+                    if parts == ['stream']:
+                        self._stream(parse_qs(queryString))
+                    elif parts == ['stats']:
+                        self._send(200, json.dumps(api.engine.stats()).encode('utf-8'))
+                    elif parts == ['alarms']:
+                        self._send(200, api.alarms())
+                    elif parts == ['readings']:
+                        self._send(200, api.readings())
+                    elif len(parts) == 2 and parts[0] == 'readings':
+                        self._send(200, api.readings(int(parts[1])))
+                    else:
+                        self._sendError(404, 'Not found.')
+                except ValueError:
+                    self._sendError(400, 'Address and queue length must be integers.')
+
+            def do_POST(self):
+                if self.path.split('?')[0].strip('/') != 'setpoint':
+                    self._sendError(404, 'Not found.')
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.rfile.read(length).decode('utf-8'))
+                    address = int(request['address'])
+                    tempK = float(request['temp'])
+                except (ValueError, KeyError, TypeError):
+                    self._sendError(400, 'Expected {"address": <int>, "temp": <kelvin>}.')
+                    return
+                error = api.setTemp(address, tempK)
+                if error:
+                    # Conflicts with the mode the bus is in, rather than a bad request:
+                    self._sendError(409 if api._listenOnly() else 400, error)
+                else:
+                    self._send(202, json.dumps({'address': address, 'temp': tempK}).encode('utf-8'))
+
+            def log_message(self, format, *args):
+                # Dashboards poll often, don't print every request
+                pass
+
+        return Handler
@@ -0,0 +1,130 @@
+'''
+Baud rate of the bus when the config file doesn't give one
+
+With 'baudrate' missing from [SERIAL] (or 'baudrate=auto'), the port is
+opened at the rate that last worked on it, or found by reading current temp
+from a controller in the config at each rate the PM3 supports with a short
+timeout. The rate found is saved per port in cacheFile, so the next start
+normally needs one probe. A listen-only port (monitor.py) is not probed:
+each rate is listened to for listenWindow seconds for a valid frame instead.
+'''
+import json
+import os
+import time
+
+# Rates the PM3 supports, the factory default first:
+rates = (38400, 19200, 9600)
+# Read timeout while probing: a current temp response takes 22 ms at 9600
+# baud, plus the controller's turnaround
+probeTimeout = 0.1
+defaultRate = 38400
+# Seconds the traffic of another master is listened to at each rate:
+listenWindow = 0.5
+cacheFile = os.path.join(os.path.expanduser('~'), '.watlow_baudrates.json')
+
+def loadCache(fileName=None):
+    '''
+    Returns the cached baud rates by port ({} if there are none)
+    '''
+    try:
+        with open(fileName or cacheFile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def saveRate(port, baudrate, fileName=None):
+    cache = loadCache(fileName)
+    if cache.get(port) == baudrate:
+        return
+    cache[port] = baudrate
+    try:
+        with open(fileName or cacheFile, 'w') as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        print('Could not save the baud rate of {0}: {1}'.format(port, e))
+
+def probe(connection, address=1, protocol='standard'):
+    '''
+    Reads current temp from the controller at address at the connection's
+    current settings. Returns True if a valid response came back
+    '''
+    if protocol == 'modbus':
+        from modbus_driver import PM3Modbus
+        controller = PM3Modbus(connection=connection, address=address)
+    else:
+        from watlow_driver import PM3
+        controller = PM3(connection=connection, address=address)
+        controller.printFrames = False
+    connection.reset_input_buffer()
+    try:
+        response = controller.write('4001')
+    except Exception:
+        return False
+    return response is not None and response['error'] is None
+
+def listen(connection, window=None):
+    '''
+    Reads what arrives on the port for window seconds (listenWindow by
+    default) without writing. Returns True once a valid frame is seen
+    '''
+    from codec import FrameAssembler
+    assembler = FrameAssembler()
+    connection.reset_input_buffer()
+    end = time.monotonic() + (window or listenWindow)
+    while time.monotonic() < end:
+        if assembler.feed(connection.read(max(1, connection.in_waiting))):
+            return True
+    return False
+
+def detect(connection, address=1, protocol='standard', cache=True, fileName=None, listenOnly=False):
+    '''
+    Finds the baud rate of an open serial port by probing the controller at
+    address (or with listenOnly, by listening for the frames of another
+    master), the cached rate of the port first. Leaves the port at the rate
+    found (cached for the next start if cache is True) and returns it, or
+    at the cached or default rate if no controller answered and returns None
+    '''
+    timeout = connection.timeout
+    cached = loadCache(fileName).get(connection.port) if cache else None
+    candidates = [cached] if cached in rates else []
+    candidates += [rate for rate in rates if rate != cached]
+    found = None
+    connection.timeout = probeTimeout
+    try:
+        for rate in candidates:
+            connection.baudrate = rate
+            if listen(connection) if listenOnly else probe(connection, address, protocol):
+                found = rate
+                break
+    finally:
+        connection.timeout = timeout
+    if found is None:
+        connection.baudrate = candidates[0]
+        print('No {0} on {1} at {2} baud'.format(
+            'traffic' if listenOnly else 'controller answered at address {0}'.format(address),
+            connection.port, ', '.join(str(rate) for rate in candidates)))
+        return None
+    if cache:
+        saveRate(connection.port, found, fileName)
+    return found
+
+def openPort(connection, port, baudrate=None, timeout=0.5, address=1, protocol='standard', listenOnly=False):
+    '''
+    Opens a closed serial.Serial on port at baudrate, or if baudrate is None
+    at the rate detect() finds with the controller at address (or by
+    listening with listenOnly). Returns the rate in use
+    '''
+    connection.port = port
+    connection.timeout = timeout
+    connection.baudrate = baudrate or defaultRate
+    connection.open()
+    if baudrate:
+        return baudrate
+    return detect(connection, address, protocol, listenOnly=listenOnly) or connection.baudrate
+
+def probeAddress(settings):
+    '''
+    Address probed for the baud rate: the first controller in the config
+    '''
+    return settings['controllers'][0]['address'] if settings['controllers'] else 1
@@ -0,0 +1,141 @@
+'''
+Frame codec benchmark
+
+Compares building set requests and reading/decoding read responses through
+the preallocated frames and receive buffer of codec.py with the former
+concatenating encoder and hexlify/unhexlify decoder (reproduced below,
+using the same CRC functions so only the copying differs):
+
+    python bench_codec.py
+    python bench_codec.py --frames 100000
+
+Reports the time per frame and, from tracemalloc, the peak temporary
+memory per frame (bytes allocated at once while building or decoding one
+frame) and the memory still held after all frames. CPython has no public
+allocation counter, the peak is the closest per-frame measure. With NumPy
+installed it also times bulk.decodeFrames() over a capture of the same
+response.
+
+The monitor case feeds a capture of read requests and responses through a
+BusMonitor (listen-only mode) in 64 byte chunks and compares the time per
+frame with the time a frame takes on a fully loaded 38400 baud bus.
+'''
+import argparse
+import io
+import struct
+import time
+import tracemalloc
+from binascii import hexlify, unhexlify
+
+import bulk
+import codec
+import parameters
+from engine import BusEngine
+from monitor import BusMonitor
+
+# Read response of address 1, current temp 4001, and its request
+response = unhexlify('55FF060010000B8802030104010108468F3638DD0E')
+request = unhexlify('55ff0510000006e8010301040101e399')
+
+def referenceSetRequest(address, value):
+    '''
+    Set request built the former way: hex strings, unhexlify and bytearray
+    concatenation
+    '''
+    hexHeader = unhexlify('55ff05' + str(9 + address) + '00000a')
+    hexData = unhexlify('010407010108') + struct.pack('>f', value)
+    request = bytearray(hexHeader)
+    request += bytearray([codec.headerCheck(hexHeader)])
+    request += bytearray(hexData)
+    request += struct.pack('<H', codec.dataCrc(hexData))
+    return request
+
+def referenceDecode(port):
+    '''
+    Response read as a new bytes object, checked on slices and decoded
+    through hexlify and unhexlify
+    '''
+    port.seek(0)
+    bytesResponse = port.read(len(response))
+    if bytearray([bytesResponse[7]]) != bytes([codec.headerCheck(bytesResponse[0:7])]) or \
+       bytesResponse[-2:] != struct.pack('<H', codec.dataCrc(bytesResponse[8:-2])):
+        return None
+    ieee_754 = hexlify(bytesResponse[-6:-2])
+    return (struct.unpack('>f', unhexlify(ieee_754))[0] - 32) * (5/9)
+
+def codecDecode(reader, port, parameter=parameters.lookup('4001')):
+    '''
+    Response read into the receive buffer and decoded in place
+    '''
+    port.seek(0)
+    frame = reader.read(port, parameter.readSize)
+    if not reader.validate(frame):
+        return None
+    return parameter.decode(frame)
+
+def measure(function, args, frames):
+    '''
+    Returns (us per frame, mean peak temporary bytes per frame, bytes held
+    after all frames)
+    '''
+    for i in range(1000):
+        function(*args)
+    start = time.perf_counter()
+    for i in range(frames):
+        function(*args)
+    perFrame = (time.perf_counter() - start) / frames * 1e6
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peaks = 0
+    for i in range(frames):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        function(*args)
+        peaks += tracemalloc.get_traced_memory()[1] - current
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return perFrame, peaks / frames, held
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure frame build/decode time and allocations')
+    parser.add_argument('--frames', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    frames = codec.FrameCodec(1)
+    setpoint = parameters.lookup('7001')
+    # Stands in for the serial port (it has read and readinto):
+    port = io.BytesIO(response)
+    cases = [
+        ('set request, concatenated', referenceSetRequest, (1, 78.5)),
+        ('set request, codec', frames.setRequest, (setpoint, 78.5)),
+        ('read + decode, hexlify', referenceDecode, (port,)),
+        ('read + decode, codec', codecDecode, (codec.FrameReader(), port)),
+    ]
+    print('{0:28} {1:>10} {2:>14} {3:>10}'.format('', 'us/frame', 'peak B/frame', 'held B'))
+    for name, function, functionArgs in cases:
+        perFrame, peak, held = measure(function, functionArgs, args.frames)
+        print('{0:28} {1:10.2f} {2:14.1f} {3:10}'.format(name, perFrame, peak, held))
+
+    if bulk.np is not None:
+        capture = response * args.frames * 10
+        start = time.perf_counter()
+        bulk.decodeFrames(capture)
+        perFrame = (time.perf_counter() - start) / (args.frames * 10) * 1e6
+        print('{0:28} {1:10.3f}'.format('decode, bulk (NumPy)', perFrame))
+
+    engine = BusEngine()
+    engine.addController(1)
+    monitor = BusMonitor(engine, None)
+    capture = (request + response) * args.frames
+    start = time.perf_counter()
+    for i in range(0, len(capture), 64):
+        monitor.feed(capture[i:i + 64])
+    perFrame = (time.perf_counter() - start) / (args.frames * 2) * 1e6
+    # 10 bits per byte on the wire:
+    lineRate = len(request + response) / 2 * 10 / 38400 * 1e6
+    print('{0:28} {1:10.2f}   ({2:.0f} us/frame at 38400 baud, {3} frames decoded)'.format(
+        'decode, monitor', perFrame, lineRate, monitor.assembler.frames))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Startup benchmark for the GUI
+
+Measures time-to-first-paint (process start until the main window's first
+paint event) and the import time of each module, either from source or for
+the one-file build made by freeze.py:
+
+    python bench_startup.py                     # runs main.py from source
+    python bench_startup.py --exe dist/main.exe # runs the frozen build
+    python bench_startup.py --runs 10 --output bench_output.txt
+
+The GUI exits right after its first paint when WATLOW_STARTUP_BENCHMARK is
+set (see MainWindow.event). Per-module import times come from Python's
+-X importtime report (PYTHONPROFILEIMPORTTIME), which frozen builds may not
+produce.
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+def runOnce(command):
+    '''
+    Starts the GUI once and returns (seconds to first paint, importtime lines)
+    '''
+    env = dict(os.environ, WATLOW_STARTUP_BENCHMARK='1', PYTHONPROFILEIMPORTTIME='1')
+    start = time.time()
+    proc = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=120)
+    firstPaint = None
+    for line in proc.stdout.splitlines():
+        if line.startswith('first-paint '):
+            firstPaint = float(line.split()[1]) - start
+    importLines = [line for line in proc.stderr.splitlines() if line.startswith('import time:')]
+    return firstPaint, importLines
+
+def parseImportTimes(lines):
+    '''
+    Returns a list of (module, self us, cumulative us) from -X importtime output
+    '''
+    times = []
+    for line in lines:
+        fields = line[len('import time:'):].split('|')
+        try:
+            selfTime, cumulative = int(fields[0]), int(fields[1])
+        except ValueError:
+            # Column header line
+            continue
+        times.append((fields[2].strip(), selfTime, cumulative))
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure GUI time-to-first-paint and import times')
+    parser.add_argument('--exe', help='frozen executable built by freeze.py (default: main.py from source)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    if args.exe:
+        command = [args.exe]
+    else:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')]
+
+    paints = []
+    importLines = []
+    for i in range(args.runs):
+        firstPaint, lines = runOnce(command)
+        if firstPaint is None:
+            print('Run {0}: no first paint reported'.format(i + 1))
+            continue
+        paints.append(firstPaint)
+        importLines = lines
+
+    report = ['Startup benchmark: {0}'.format(' '.join(command))]
+    if paints:
+        report.append('time to first paint: median {0:.1f} ms, min {1:.1f} ms, max {2:.1f} ms ({3} runs)'.format(
+            statistics.median(paints) * 1000, min(paints) * 1000, max(paints) * 1000, len(paints)))
+    importTimes = parseImportTimes(importLines)
+    if importTimes:
+        report.append('')
+        report.append('{0:>10} {1:>10}  module (slowest {2} by cumulative import time, last run)'.format('self ms', 'cumul. ms', args.top))
+        for module, selfTime, cumulative in sorted(importTimes, key=lambda t: t[2], reverse=True)[:args.top]:
+            report.append('{0:10.1f} {1:10.1f}  {2}'.format(selfTime / 1000, cumulative / 1000, module))
+    else:
+        report.append('(no per-module import times reported)')
+
+    print('\n'.join(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(report) + '\n')
+
+if __name__ == '__main__':
+    main()
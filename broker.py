@@ -0,0 +1,252 @@
+'''
+Bus broker: one process owns the serial port and many clients share it
+
+The GUI, headless.py and scripts connect to the broker over a local socket
+instead of opening the port themselves (set 'broker=host:port' in [SERIAL]).
+Clients send complete Standard Bus request frames and receive the response
+frame, so any PM3 request works unchanged through BrokerConnection.
+
+Identical read requests (same address, parameter and instance give the same
+frame) that are queued or in progress at the same time are answered by a
+single bus transaction.
+
+Usage:
+    python broker.py config.ini [--listen 8767]
+
+Messages in both directions are a 2 byte big-endian length followed by a
+frame (an empty frame is returned when the controller did not answer).
+'''
+import argparse
+import socket
+import sys
+import threading
+import queue
+import serial
+import autobaud
+from config import parseConfig
+import lowlatency
+
+def _recvExact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+def recvMessage(sock):
+    length = int.from_bytes(_recvExact(sock, 2), 'big')
+    return _recvExact(sock, length)
+
+def sendMessage(sock, data):
+    sock.sendall(len(data).to_bytes(2, 'big') + bytes(data))
+
+def isReadRequest(frame):
+    # bytes[8:10] of a read request are '0103' (see PM3._buildReadRequest)
+    return len(frame) > 9 and frame[8] == 0x01 and frame[9] == 0x03
+
+# Seconds a client waits for its transaction (queued and on the bus) before
+# it gets an empty response. BrokerConnection waits longer than that for the
+# broker:
+transactTimeout = 10
+
+class _Flight():
+    '''
+    One bus transaction and the clients waiting for its response. A flight
+    all of whose clients gave up is abandoned and skipped by the bus thread
+    '''
+    def __init__(self, frame):
+        self.frame = frame
+        self.response = b''
+        self.done = threading.Event()
+        self.waiting = 0
+        self.abandoned = False
+
+class BusBroker():
+    '''
+    Owns one serial port and serves bus transactions to socket clients
+    '''
+    def __init__(self, connection, host='127.0.0.1', port=8767):
+        self.connection = connection
+        self.host = host
+        self.port = port
+
+        # Read transactions queued or in progress by request frame:
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        self.transactions = 0
+        self.coalesced = 0
+        # Clients waiting longer than this (seconds) get an empty response:
+        self.transactTimeout = transactTimeout
+
+        self.server = None
+
+    def transact(self, frame):
+        '''
+        Returns the response to a request frame, sharing the bus transaction
+        with any identical read already waiting (called from client threads)
+        '''
+        frame = bytes(frame)
+        with self._lock:
+            flight = self._inflight.get(frame) if isReadRequest(frame) else None
+            if flight is None:
+                flight = _Flight(frame)
+                if isReadRequest(frame):
+                    self._inflight[frame] = flight
+                self._queue.put(flight)
+            else:
+                self.coalesced += 1
+            flight.waiting += 1
+        if not flight.done.wait(self.transactTimeout):
+            with self._lock:
+                flight.waiting -= 1
+                if flight.waiting == 0:
+                    # Not run if it is still queued (a retried write would
+                    # otherwise reach the bus twice):
+                    flight.abandoned = True
+                    if self._inflight.get(frame) is flight:
+                        del self._inflight[frame]
+            print('Exception: no bus response within {0} s'.format(self.transactTimeout))
+            return b''
+        return flight.response
+
+    def _runBus(self):
+        # The driver is only loaded once there is a bus to serve:
+        from codec import FrameReader
+        from watlow_driver import readFrame
+        reader = FrameReader()
+        while True:
+            flight = self._queue.get()
+            if flight is None:
+                break
+            with self._lock:
+                if flight.abandoned:
+                    flight.done.set()
+                    continue
+            try:
+                self.connection.reset_input_buffer()
+                self.connection.write(flight.frame)
+                # A copy: the clients send it after the next transaction
+                flight.response = readFrame(self.connection, reader)
+            except Exception as e:
+                # The waiting clients get an empty response (no answer)
+                print('Exception: ', e)
+            finally:
+                self.transactions += 1
+                with self._lock:
+                    if self._inflight.get(flight.frame) is flight:
+                        del self._inflight[flight.frame]
+                flight.done.set()
+
+    def _serveClient(self, sock):
+        with sock:
+            try:
+                while True:
+                    sendMessage(sock, self.transact(recvMessage(sock)))
+            except (ConnectionError, OSError):
+                pass
+
+    def serveForever(self):
+        threading.Thread(target=self._runBus, name='BrokerBus', daemon=True).start()
+        self.server = socket.create_server((self.host, self.port))
+        while True:
+            sock, address = self.server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serveClient, args=(sock,), daemon=True).start()
+
+class BrokerConnection():
+    '''
+    Serial-like connection to a BusBroker, used in place of serial.Serial by
+    the PM3 driver: write() sends a request frame and waits for the response,
+    read() returns it
+    '''
+    def __init__(self, host='127.0.0.1', port=8767, timeout=transactTimeout + 5):
+        self.host = host
+        self.brokerPort = port
+        self.port = '{0}:{1}'.format(host, port)
+        self.timeout = timeout
+        self.sock = None
+        self._response = b''
+        self._lock = threading.Lock()
+
+    def open(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.brokerPort), self.timeout)
+        except OSError as e:
+            raise serial.SerialException('Could not connect to broker {0}: {1}'.format(self.port, e))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def isOpen(self):
+        return self.sock is not None
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._response = b''
+
+    def write(self, data):
+        if self.sock is None:
+            raise serial.SerialException('Broker connection is not open')
+        with self._lock:
+            try:
+                sendMessage(self.sock, data)
+                self._response = recvMessage(self.sock)
+            except (ConnectionError, OSError) as e:
+                self.close()
+                raise serial.SerialException('Broker connection lost: {0}'.format(e))
+        return len(data)
+
+    def read(self, size=1):
+        data, self._response = self._response[:size], self._response[size:]
+        return data
+
+def parseBrokerAddress(address):
+    '''
+    Splits 'host:port' (or just 'port') into (host, port)
+    '''
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share one Watlow serial bus between several clients')
+    parser.add_argument('config', help='config .ini file with the [SERIAL] port to own')
+    parser.add_argument('--listen', default='127.0.0.1:8767', help='host:port to accept clients on')
+    args = parser.parse_args(argv)
+
+    settings = parseConfig(args.config)
+    try:
+        connection = serial.Serial()
+        autobaud.openPort(connection, settings['port'], settings['baudrate'], settings['timeout'],
+                          autobaud.probeAddress(settings), settings['protocol'])
+        if settings['lowLatency']:
+            try:
+                print('Low latency mode: ', lowlatency.configure(connection))
+            except serial.SerialException:
+                connection.close()
+                raise
+    except serial.SerialException as e:
+        print('Could not open port {0}: {1}'.format(settings['port'], e))
+        return 1
+    host, port = parseBrokerAddress(args.listen)
+    broker = BusBroker(connection, host, port)
+    print('Broker for {0} listening on {1}:{2}'.format(settings['port'], host, port))
+    try:
+        broker.serveForever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('{0} bus transactions, {1} coalesced reads'.format(broker.transactions, broker.coalesced))
+        connection.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
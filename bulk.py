@@ -0,0 +1,91 @@
+'''
+Vectorized decoding of captured read responses
+
+decodeFrames() takes a contiguous buffer of read response frames that all
+have the same layout (e.g. hours of captured traffic of float parameters)
+and decodes every frame in one NumPy pass: header and data check bytes are
+computed column by column over all frames at once instead of frame by
+frame through PM3._parseResponse.
+
+NumPy is optional, it is only needed by decodeFrames().
+'''
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import codec
+import parameters
+
+# Read response of a float: header (8), 02 03 01 class member instance,
+# type 08, value (4), data check (2)
+frameLength = 21
+
+def _dataCrcTable():
+    '''
+    Table of the bit reversed 0x1021 CRC-16 (codec.dataCrc) by byte
+    '''
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+if np is not None:
+    _crc8Table = np.array(codec.crc8Table, dtype=np.uint8)
+    _crc16Table = np.array(_dataCrcTable(), dtype=np.uint16)
+_temperatureIds = [int(paramId) for paramId, instance in parameters.byId
+                   if instance == 1 and parameters.byId[(paramId, instance)].units == 'F']
+
+def decodeFrames(buffer, length=frameLength):
+    '''
+    Decodes a buffer (bytes, bytearray, memoryview or uint8 array) of
+    back-to-back response frames of length bytes. A partial frame at the end
+    is ignored. Returns a dict of arrays, one entry per frame:
+
+    * address: controller address from the zone byte
+    * parameter: parameter ID (e.g. 4001)
+    * instance
+    * value: the big-endian float32, in degrees C for temperatures
+    * valid: preamble, header check byte, data check bytes and float type
+      code all match (value is NaN where they don't)
+    '''
+    if np is None:
+        raise ImportError('decodeFrames needs NumPy (pip install numpy)')
+
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    count = len(data) // length
+    frames = data[:count * length].reshape(count, length)
+
+    # Header check byte, see codec.headerCheck (t[~x] there is t[255 - x]):
+    t = _crc8Table
+    check = ~t[frames[:, 6] ^ t[frames[:, 5] ^ t[frames[:, 4] ^ t[frames[:, 3] ^ t[255 - frames[:, 2]]]]]]
+    valid = (frames[:, 0] == 0x55) & (frames[:, 1] == 0xff) & (frames[:, 7] == check)
+
+    # Data check bytes, one column at a time (0xFFFF start, output inverted):
+    crc = np.full(count, 0xffff, dtype=np.uint16)
+    for column in range(8, length - 2):
+        crc = _crc16Table[(crc ^ frames[:, column]) & 0xff] ^ (crc >> 8)
+    received = frames[:, length - 2].astype(np.uint16) | (frames[:, length - 1].astype(np.uint16) << 8)
+    valid &= (crc ^ 0xffff) == received
+    valid &= frames[:, length - 7] == 0x08
+
+    # Zone byte read as decimal digits ('10' = 1, '11' = 2, ...):
+    zone = frames[:, 4].astype(np.int32)
+    address = (zone >> 4) * 10 + (zone & 0x0f) - 9
+    parameter = frames[:, 11].astype(np.int32) * 1000 + frames[:, 12]
+
+    value = frames[:, length - 6:length - 2].copy().view('>f4')[:, 0].astype(np.float64)
+    temperature = np.isin(parameter, _temperatureIds)
+    value[temperature] = (value[temperature] - 32) * (5/9)
+    value[~valid] = np.nan
+
+    return {
+        'address': address,
+        'parameter': parameter,
+        'instance': frames[:, 13].astype(np.int32),
+        'value': value,
+        'valid': valid
+    }
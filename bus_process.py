@@ -0,0 +1,398 @@
+'''
+Runs the bus engine in a child process so serial timing is independent of
+the GUI (GIL contention, repaints)
+
+The child writes each valid reading into a fixed-layout shared memory table
+(LatestTable) and the GUI reads it on its refresh tick; only commands and
+their replies (engine stats, group commit results) travel over a pipe, the
+replies are picked up on the refresh tick too. Enabled in the GUI with
+'busprocess=yes' in [GENERAL].
+'''
+import multiprocessing
+import struct
+import threading
+from multiprocessing import shared_memory
+import serial
+from predictive import PredictivePoller
+
+class LatestTable():
+    '''
+    Shared memory table of the latest reading of each controller
+
+    One slot per address: sequence counter (uint32, odd while the slot is
+    being written), padding, current temp, its time, setpoint, its time
+    (float64, degrees C and time.time()). Readers retry while the sequence
+    counter is odd or changes during the read, so no lock is needed
+    '''
+    slot = struct.Struct('<IIdddd')
+    fields = {'currentTemp': 2, 'setpoint': 4}
+
+    def __init__(self, name=None, slots=32):
+        self.slots = slots
+        size = self.slot.size * slots
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def write(self, reading):
+        '''
+        BusEngine listener used in the child process (single writer)
+        '''
+        address = reading['address']
+        if reading['error'] is not None or reading['command'] not in self.fields or not 0 <= address < self.slots:
+            return
+        offset = address * self.slot.size
+        values = list(self.slot.unpack_from(self.shm.buf, offset))
+        index = self.fields[reading['command']]
+        values[index] = reading['data']
+        values[index + 1] = reading['time']
+        # Odd sequence number marks the slot as being written:
+        struct.pack_into('<I', self.shm.buf, offset, (values[0] + 1) & 0xffffffff)
+        values[0] = (values[0] + 2) & 0xffffffff
+        struct.pack_into('<dddd', self.shm.buf, offset + 8, *values[2:])
+        struct.pack_into('<I', self.shm.buf, offset, values[0])
+
+    def read(self, address):
+        '''
+        Returns (currentTemp, currentTime, setpoint, setpointTime) of a slot
+        '''
+        offset = address * self.slot.size
+        while True:
+            values = self.slot.unpack_from(self.shm.buf, offset)
+            if values[0] % 2 == 0 and struct.unpack_from('<I', self.shm.buf, offset)[0] == values[0]:
+                return values[2:]
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+def _runBusProcess(tableName, slots, port, baudrate, timeout, commands, lowLatency=False, probeAddress=1,
+                   protocol='standard'):
+    '''
+    Child process: owns the serial port and a BusEngine, executes commands
+    received over the pipe until 'stop'
+    '''
+    from engine import BusEngine
+    table = LatestTable(tableName, slots)
+    try:
+        from autobaud import openPort
+        connection = serial.Serial()
+        print('bus process baud rate: ', openPort(connection, port, baudrate, timeout, probeAddress, protocol))
+        if lowLatency:
+            from lowlatency import configure
+            try:
+                print('bus process low latency mode: ', configure(connection))
+            except serial.SerialException:
+                connection.close()
+                raise
+    except serial.SerialException as e:
+        commands.send(('error', str(e)))
+        table.close()
+        return
+    engine = BusEngine(connection)
+    engine.addListener(table.write)
+    engine.start()
+    commands.send(('opened', None))
+    # Group commit results are sent from the engine's bus thread:
+    sendLock = threading.Lock()
+    def reply(*message):
+        with sendLock:
+            commands.send(message)
+    while True:
+        try:
+            command = commands.recv()
+        except EOFError:
+            break
+        if command[0] == 'stop':
+            break
+        if command[0] == 'stats':
+            reply('stats', engine.stats())
+            continue
+        if command[0] == 'setGroup':
+            values, groupId = command[1:]
+            engine.setGroup(values, None if groupId is None else
+                            lambda result, groupId=groupId: reply('group', groupId, result))
+            continue
+        try:
+            getattr(engine, command[0])(*command[1:])
+        except Exception as e:
+            print('bus process: ', e)
+    engine.stop()
+    connection.close()
+    table.close()
+
+class _ProcessConnection():
+    '''
+    Serial-like handle used by the GUI to open/close the bus process
+    '''
+    def __init__(self, busProcess):
+        self.busProcess = busProcess
+        self.port = None
+        # None detects the baud rate with the controller at probeAddress:
+        self.baudrate = None
+        self.timeout = 0.5
+        self.lowLatency = False
+        self.probeAddress = 1
+
+    def open(self):
+        self.busProcess.open(self.port, self.baudrate, self.timeout, self.lowLatency, self.probeAddress)
+
+    def close(self):
+        self.busProcess.close()
+
+    def isOpen(self):
+        return self.busProcess.isOpen()
+
+    def flush(self):
+        pass
+
+class BusProcess():
+    '''
+    Parent side of the bus process with the BusEngine interface used by the
+    GUI. Listeners are called from refresh(), which should be called on the
+    GUI refresh tick
+    '''
+    temperatureCommands = ('currentTemp', 'setpoint')
+
+    def __init__(self, slots=32):
+        self.slots = slots
+        self.table = LatestTable(slots=slots)
+        self.connection = _ProcessConnection(self)
+        self.controllers = {}
+        self.latest = {}
+        self.listeners = []
+        self.readInterval = 60
+        self.protocol = 'standard'
+        self.assembly = None
+        self.maxAge = {}
+        self.periods = {}
+        self.focus = None
+        self.adaptive = None
+        # Predictive polling runs in the child, a copy of the estimator fed by
+        # refresh() provides the estimates shown between reads
+        self.predictiveArgs = None
+        self.predictive = None
+        self._polling = False
+        self._process = None
+        self._commands = None
+        # Commands may come from the GUI and API threads:
+        self._sendLock = threading.Lock()
+        # Latest engine stats received from the child, and the callbacks of
+        # group commits waiting for their result by id (see _receive):
+        self._stats = {}
+        self._groupCallbacks = {}
+        self._groupId = 0
+
+    def open(self, port, baudrate=38400, timeout=0.5, lowLatency=False, probeAddress=1):
+        # 'spawn' on every platform: forking a process with Qt running is unsafe
+        context = multiprocessing.get_context('spawn')
+        self._commands, childCommands = context.Pipe()
+        self._process = context.Process(target=_runBusProcess, name='BusProcess', daemon=True,
+                                                args=(self.table.name, self.slots, port, baudrate, timeout, childCommands,
+                                                      lowLatency, probeAddress, self.protocol))
+        self._process.start()
+        if not self._commands.poll(10):
+            self.close()
+            raise serial.SerialException('Bus process did not start')
+        status, error = self._commands.recv()
+        if status == 'error':
+            self._process.join()
+            self._process = None
+            raise serial.SerialException(error)
+        self._send('setProtocol', self.protocol)
+        self._send('setAssembly', self.assembly)
+        for address in self.controllers:
+            self._send('addController', address)
+        for command, seconds in self.maxAge.items():
+            self._send('setMaxAge', command, seconds)
+        for (address, command), seconds in self.periods.items():
+            self._send('setPeriod', address, command, seconds)
+        if self.adaptive:
+            self._send('setAdaptive', *self.adaptive)
+        if self.predictiveArgs:
+            self._send('setPredictive', *self.predictiveArgs)
+
+    def close(self):
+        if self._process is not None:
+            self._send('stop')
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+        self._polling = False
+        self._stats = {}
+        self._groupCallbacks = {}
+
+    def isOpen(self):
+        return self._process is not None and self._process.is_alive()
+
+    def stop(self):
+        self.close()
+        self.table.close(unlink=True)
+
+    def _send(self, *command):
+        with self._sendLock:
+            if self.isOpen():
+                self._commands.send(command)
+
+    def start(self):
+        pass
+
+    def updateSerial(self, serialObj):
+        pass
+
+    def addController(self, address):
+        self.controllers[int(address)] = None
+        self._send('addController', int(address))
+
+    def removeController(self, address):
+        self.controllers.pop(address, None)
+        for key in [key for key in self.latest if key[0] == address]:
+            del self.latest[key]
+        self._send('removeController', address)
+
+    def addListener(self, func):
+        self.listeners.append(func)
+
+    def addPortListener(self, func):
+        # The engine in the child re-opens a failed port on its own, its port
+        # events are not passed back
+        pass
+
+    def cancelReconnect(self):
+        pass
+
+    def removeListener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def setProtocol(self, protocol):
+        self.protocol = protocol
+        self._send('setProtocol', protocol)
+
+    def setAssembly(self, commands=None):
+        # Only temperatures are shared through the LatestTable
+        self.assembly = commands
+        self._send('setAssembly', commands)
+
+    def setMaxAge(self, command, seconds):
+        self.maxAge[command] = seconds
+        self._send('setMaxAge', command, seconds)
+
+    def setPeriod(self, address, command, seconds):
+        self.periods[(int(address), command)] = seconds
+        self._send('setPeriod', int(address), command, seconds)
+
+    def setFocus(self, address=None, minInterval=None):
+        self.focus = address
+        self._send('setFocus', address, minInterval)
+
+    def setPriority(self, address, interval=None):
+        self._send('setPriority', int(address), interval)
+
+    def setAdaptive(self, minInterval=None, rateThreshold=0.05, errorThreshold=2, budget=10):
+        self._clearPredictive()
+        self.adaptive = (minInterval, rateThreshold, errorThreshold, budget)
+        self._send('setAdaptive', *self.adaptive)
+
+    def setPredictive(self, tolerance=None, minInterval=1, processNoise=0.0001, measurementNoise=0.01, budget=10):
+        self._clearPredictive()
+        self.predictiveArgs = (tolerance, minInterval, processNoise, measurementNoise, budget)
+        self._send('setPredictive', *self.predictiveArgs)
+        if tolerance:
+            self.predictive = PredictivePoller(tolerance, minInterval or 1, self.readInterval,
+                                               processNoise, measurementNoise, budget)
+            self.addListener(self.predictive.update)
+
+    def _clearPredictive(self):
+        if self.predictive:
+            self.removeListener(self.predictive.update)
+        self.predictive = None
+        self.predictiveArgs = None
+
+    def stats(self):
+        '''
+        Metrics of the engine in the child process as of its last reply ({}
+        before the first one). Doesn't wait: asks the child for fresh ones,
+        which are picked up by refresh()
+        '''
+        self._send('stats')
+        return self._stats
+
+    def read(self, address, command):
+        self._send('read', int(address), command)
+
+    def readNow(self, address, command='currentTemp'):
+        self._send('readNow', int(address), command)
+
+    def set(self, address, value):
+        self._send('set', int(address), value)
+
+    def setGroup(self, values, callback=None):
+        '''
+        callback is called from refresh() with the result of the commit in
+        the child process
+        '''
+        groupId = None
+        if callback is not None and self.isOpen():
+            self._groupId += 1
+            groupId = self._groupId
+            self._groupCallbacks[groupId] = callback
+        self._send('setGroup', {int(address): value for address, value in values.items()}, groupId)
+
+    def readAll(self):
+        self._send('readAll')
+
+    def isPolling(self):
+        return self._polling and self.isOpen()
+
+    def startPolling(self, interval=None):
+        if interval is not None:
+            self.readInterval = interval
+        self._send('startPolling', self.readInterval)
+        self._polling = True
+
+    def stopPolling(self):
+        self._send('stopPolling')
+        self._polling = False
+
+    def _receive(self):
+        '''
+        Takes the replies waiting in the pipe without blocking
+        '''
+        try:
+            while self.isOpen() and self._commands.poll():
+                message = self._commands.recv()
+                if message[0] == 'stats':
+                    self._stats = message[1]
+                elif message[0] == 'group':
+                    callback = self._groupCallbacks.pop(message[1], None)
+                    if callback:
+                        callback(message[2])
+        except (EOFError, OSError) as e:
+            print('bus process: ', e)
+
+    def refresh(self):
+        '''
+        Takes the child's replies, then reads the shared memory table and
+        publishes every reading that is newer than the last one published
+        '''
+        self._receive()
+        for address in list(self.controllers):
+            values = self.table.read(address)
+            for command, index in LatestTable.fields.items():
+                data, readTime = values[index - 2], values[index - 1]
+                previous = self.latest.get((address, command))
+                if readTime == 0 or (previous and previous['time'] == readTime):
+                    continue
+                reading = {'address': address, 'data': data, 'error': None, 'command': command, 'time': readTime}
+                self.latest[(address, command)] = reading
+                for listener in list(self.listeners):
+                    try:
+                        listener(reading)
+                    except Exception as e:
+                        print('listener: ', e)
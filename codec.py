@@ -0,0 +1,368 @@
+'''
+Standard Bus frame codec working in place on preallocated buffers
+
+Requests are built by patching the value and check bytes into a bytearray
+template that is allocated once per parameter (struct.pack_into), and
+responses are read into a preallocated receive buffer and checked and
+decoded where they lie (struct.unpack_from, CRC over a memoryview) instead
+of slicing, hexlifying and unhexlifying copies of them.
+
+A set request template is reused by the next setRequest() of the same
+parameter, and a FrameReader's buffer by its next read(): use them before
+building or reading the next one, or copy them.
+'''
+import struct
+import crcmod
+
+# Data check bytes: CRC-16, 0x1021 polynomial, bit reversed, output inverted.
+# dataCrc(data, crc) continues the CRC of earlier data from crc
+dataCrc = crcmod.mkCrcFun(poly=0x11021, initCrc=0, rev=True, xorOut=0xFFFF)
+dataCheck = struct.Struct('<H')
+length = struct.Struct('>H')
+
+# Watlow's header check byte table, see PM3._headerCheckByte
+crc8Table = (
+    0x00, 0xfe, 0xff, 0x01, 0xfd, 0x03, 0x02, 0xfc,
+    0xf9, 0x07, 0x06, 0xf8, 0x04, 0xfa, 0xfb, 0x05,
+    0xf1, 0x0f, 0x0e, 0xf0, 0x0c, 0xf2, 0xf3, 0x0d,
+    0x08, 0xf6, 0xf7, 0x09, 0xf5, 0x0b, 0x0a, 0xf4,
+    0xe1, 0x1f, 0x1e, 0xe0, 0x1c, 0xe2, 0xe3, 0x1d,
+    0x18, 0xe6, 0xe7, 0x19, 0xe5, 0x1b, 0x1a, 0xe4,
+    0x10, 0xee, 0xef, 0x11, 0xed, 0x13, 0x12, 0xec,
+    0xe9, 0x17, 0x16, 0xe8, 0x14, 0xea, 0xeb, 0x15,
+    0xc1, 0x3f, 0x3e, 0xc0, 0x3c, 0xc2, 0xc3, 0x3d,
+    0x38, 0xc6, 0xc7, 0x39, 0xc5, 0x3b, 0x3a, 0xc4,
+    0x30, 0xce, 0xcf, 0x31, 0xcd, 0x33, 0x32, 0xcc,
+    0xc9, 0x37, 0x36, 0xc8, 0x34, 0xca, 0xcb, 0x35,
+    0x20, 0xde, 0xdf, 0x21, 0xdd, 0x23, 0x22, 0xdc,
+    0xd9, 0x27, 0x26, 0xd8, 0x24, 0xda, 0xdb, 0x25,
+    0xd1, 0x2f, 0x2e, 0xd0, 0x2c, 0xd2, 0xd3, 0x2d,
+    0x28, 0xd6, 0xd7, 0x29, 0xd5, 0x2b, 0x2a, 0xd4,
+    0x81, 0x7f, 0x7e, 0x80, 0x7c, 0x82, 0x83, 0x7d,
+    0x78, 0x86, 0x87, 0x79, 0x85, 0x7b, 0x7a, 0x84,
+    0x70, 0x8e, 0x8f, 0x71, 0x8d, 0x73, 0x72, 0x8c,
+    0x89, 0x77, 0x76, 0x88, 0x74, 0x8a, 0x8b, 0x75,
+    0x60, 0x9e, 0x9f, 0x61, 0x9d, 0x63, 0x62, 0x9c,
+    0x99, 0x67, 0x66, 0x98, 0x64, 0x9a, 0x9b, 0x65,
+    0x91, 0x6f, 0x6e, 0x90, 0x6c, 0x92, 0x93, 0x6d,
+    0x68, 0x96, 0x97, 0x69, 0x95, 0x6b, 0x6a, 0x94,
+    0x40, 0xbe, 0xbf, 0x41, 0xbd, 0x43, 0x42, 0xbc,
+    0xb9, 0x47, 0x46, 0xb8, 0x44, 0xba, 0xbb, 0x45,
+    0xb1, 0x4f, 0x4e, 0xb0, 0x4c, 0xb2, 0xb3, 0x4d,
+    0x48, 0xb6, 0xb7, 0x49, 0xb5, 0x4b, 0x4a, 0xb4,
+    0xa1, 0x5f, 0x5e, 0xa0, 0x5c, 0xa2, 0xa3, 0x5d,
+    0x58, 0xa6, 0xa7, 0x59, 0xa5, 0x5b, 0x5a, 0xa4,
+    0x50, 0xae, 0xaf, 0x51, 0xad, 0x53, 0x52, 0xac,
+    0xa9, 0x57, 0x56, 0xa8, 0x54, 0xaa, 0xab, 0x55
+)
+
+def headerCheck(frame, start=0):
+    '''
+    Returns the header check byte (an int) of frame[start:start + 7]
+    '''
+    t = crc8Table
+    return ~t[frame[start + 6] ^ t[frame[start + 5] ^ t[frame[start + 4] ^ t[frame[start + 3] ^
+              t[~frame[start + 2]]]]]] & 0xff
+
+def validate(frame, data=None):
+    '''
+    Checks the header and data check bytes of a received frame (bytes,
+    bytearray or memoryview) without copying it. data is a view of the data
+    portion if there already is one (see FrameCodec.dataView)
+    '''
+    if len(frame) < 10 or frame[7] != headerCheck(frame):
+        return False
+    if data is None:
+        data = memoryview(frame)[8:-2]
+    return dataCheck.unpack_from(frame, len(frame) - 2)[0] == dataCrc(data)
+
+def zone(address):
+    '''
+    Zone byte of an address ('10' = 1, '11' = 2, etc. read as hex)
+    '''
+    return int(str(9 + address), 16)
+
+def address(zone):
+    '''
+    Address of a zone byte (inverse of zone()), None for a zone byte that
+    no address maps to (a hex digit above 9)
+    '''
+    high, low = zone >> 4, zone & 0x0f
+    if high > 9 or low > 9 or high * 10 + low < 10:
+        return None
+    return high * 10 + low - 9
+
+class FrameCodec():
+    '''
+    Request frames for one controller address
+
+    Read requests never change and are built once per parameter. Set
+    requests are a template per parameter with the CRC-16 of everything
+    before the value precomputed, so building one packs the value in place
+    and runs the CRC over the value bytes only
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.zone = zone(address)
+        # Complete read request frames by parameter:
+        self._reads = {}
+        # Set request (frame, value offset, check offset, CRC before the
+        # value, view of the value bytes) by parameter:
+        self._sets = {}
+
+    def _header(self, frame, dataLength):
+        frame[0:5] = bytes([0x55, 0xff, 0x05, self.zone, 0x00])
+        length.pack_into(frame, 5, dataLength)
+        frame[7] = headerCheck(frame)
+
+    def frame(self, data):
+        '''
+        Returns a request frame (header, data and check bytes) for any data
+        portion, e.g. one no parameter describes
+        '''
+        frame = bytearray(8 + len(data) + 2)
+        self._header(frame, len(data))
+        frame[8:-2] = data
+        dataCheck.pack_into(frame, len(frame) - 2, dataCrc(data))
+        return frame
+
+    def readRequest(self, parameter):
+        '''
+        Returns the read request frame of a parameter (from parameters.lookup)
+        '''
+        frame = self._reads.get(parameter)
+        if frame is None:
+            frame = bytearray(8 + len(parameter.readData))
+            self._header(frame, len(parameter.readData) - 2)
+            frame[8:] = parameter.readData
+            frame = self._reads[parameter] = bytes(frame)
+        return frame
+
+    def _setTemplate(self, parameter):
+        template = self._sets.get(parameter)
+        if template is None:
+            frame = bytearray(8 + parameter.setLength + 2)
+            self._header(frame, parameter.setLength)
+            valueOffset = 8 + len(parameter.setPrefix)
+            checkOffset = valueOffset + parameter.format.size
+            frame[8:valueOffset] = parameter.setPrefix
+            template = (frame, valueOffset, checkOffset, dataCrc(parameter.setPrefix),
+                        memoryview(frame)[valueOffset:checkOffset])
+            self._sets[parameter] = template
+        return template
+
+    def setRequest(self, parameter, value):
+        '''
+        Returns the set request frame of a parameter, value in wire units
+        (degrees F for temperatures). The frame is the parameter's template,
+        overwritten by the next call
+        '''
+        frame, valueOffset, checkOffset, prefixCrc, valueView = self._setTemplate(parameter)
+        parameter.format.pack_into(frame, valueOffset, value)
+        dataCheck.pack_into(frame, checkOffset, dataCrc(valueView, prefixCrc))
+        return frame
+
+class FrameReader():
+    '''
+    Reads response frames into a preallocated receive buffer
+
+    Each read() returns the next response frame found on the bus:
+
+    * request frames (header byte 0x05) are skipped, so adapters that echo
+      what they send don't shift every response that follows
+    * bytes before a preamble (55 ff) with a valid header check byte are
+      skipped, so a read that starts mid-frame after a glitch resyncs on
+      the next frame instead of failing every read after it
+    '''
+    # Bytes skipped looking for a frame before giving up (at 38400 baud
+    # the read timeout normally ends the search long before):
+    maxSkip = 512
+    # Response headers remembered (one per controller and response length):
+    maxHeaders = 64
+
+    def __init__(self):
+        self._buffer = bytearray(64)
+        # Views of the buffer by (start, end), and of a received frame and
+        # its data portion by frame length:
+        self._slices = {}
+        self._views = {}
+        # Request frames (echoes) and bytes skipped so far:
+        self.echoes = 0
+        self.skipped = 0
+        # Frame returned by the last read() if its header checked out:
+        self._checked = None
+        # Response headers (with their check byte) that checked out:
+        self._headers = ()
+        # Connection of the last read(), its readinto and whether it reports
+        # the bytes waiting (in_waiting):
+        self._connection = None
+        self._readinto = None
+        self._waits = False
+
+    def _slice(self, start, end):
+        view = self._slices.get((start, end))
+        if view is None:
+            view = self._slices[(start, end)] = memoryview(self._buffer)[start:end]
+        return view
+
+    def _frameViews(self, size):
+        views = self._views.get(size)
+        if views is None:
+            frame = self._slice(0, size)
+            views = self._views[size] = (frame, frame[8:-2] if size >= 10 else None)
+        return views
+
+    def _readInto(self, connection, start, end):
+        '''
+        Reads buffer[start:end] from connection (readinto if it has it) and
+        returns the number of bytes read, which is short on a timeout
+        '''
+        if end > len(self._buffer):
+            buffer = bytearray(2 * end)
+            buffer[:start] = self._buffer[:start]
+            self._buffer = buffer
+            self._slices = {}
+            self._views = {}
+        view = self._slices.get((start, end)) or self._slice(start, end)
+        if connection is self._connection and self._readinto is not None:
+            return self._readinto(view) or 0
+        if hasattr(connection, 'readinto'):
+            return connection.readinto(view) or 0
+        data = connection.read(end - start)
+        view[:len(data)] = data
+        return len(data)
+
+    def read(self, connection, size=None):
+        '''
+        Reads the next response frame and returns a memoryview of it in the
+        receive buffer, short (or empty) if the read timed out. size is the
+        expected frame size if known (e.g. Parameter.readSize): what has
+        arrived of it is read together with the header. A port reports what
+        is waiting, so a shorter (error) response doesn't wait out the read
+        timeout; other connections (the broker, captures) already hold the
+        whole response
+        '''
+        self._checked = None
+        if connection is not self._connection:
+            self._connection = connection
+            self._readinto = getattr(connection, 'readinto', None)
+            self._waits = hasattr(connection, 'in_waiting')
+        if not size:
+            size = 8
+        elif self._waits:
+            size = max(8, min(size, connection.in_waiting))
+        received = self._readInto(connection, 0, size)
+        buffer = self._buffer
+        # The usual case, exactly one response frame with a header seen
+        # before (compared in one call instead of computing its check byte):
+        if buffer.startswith(self._headers) and received == 10 + (buffer[5] << 8 | buffer[6]):
+            self._checked = (self._views.get(received) or self._frameViews(received))[0]
+            return self._checked
+        skipped = 0
+        while received >= 8:
+            buffer = self._buffer
+            if buffer[0] == 0x55 and buffer[1] == 0xff and buffer[7] == headerCheck(buffer):
+                frameSize = 10 + (buffer[5] << 8 | buffer[6])
+                if received < frameSize:
+                    received += self._readInto(connection, received, frameSize)
+                    buffer = self._buffer
+                if received < frameSize:
+                    break
+                if buffer[2] != 0x05:
+                    if len(self._headers) < self.maxHeaders and not buffer.startswith(self._headers):
+                        self._headers += (bytes(buffer[:8]),)
+                    # Anything read past the frame belongs to no request:
+                    received = frameSize
+                    self._checked = self._frameViews(frameSize)[0]
+                    break
+                # Echo of a request, the response follows it:
+                self.echoes += 1
+                received -= frameSize
+                buffer[:received] = buffer[frameSize:frameSize + received]
+            else:
+                if skipped >= self.maxSkip:
+                    break
+                # Drop bytes up to the next possible preamble:
+                shift = buffer.find(0x55, 1, received)
+                if shift < 0:
+                    shift = received
+                received -= shift
+                buffer[:received] = buffer[shift:shift + received]
+                skipped += shift
+            if received < 8:
+                received += self._readInto(connection, received, 8)
+        self.skipped += skipped
+        return self._frameViews(received)[0]
+
+    def validate(self, frame):
+        '''
+        codec.validate() that skips the header check of a complete frame
+        returned by the last read(), which read() has already done
+        '''
+        if frame is not self._checked:
+            return validate(frame, self.dataView(frame))
+        size = len(frame)
+        return dataCrc(self._views[size][1]) == frame[size - 2] | frame[size - 1] << 8
+
+    def dataView(self, frame):
+        '''
+        Returns the cached view of the data portion of frame if frame is a
+        view returned by read(), otherwise None
+        '''
+        views = self._views.get(len(frame))
+        if views is not None and views[0] is frame:
+            return views[1]
+
+class FrameAssembler():
+    '''
+    Reassembles frames from a byte stream received in arbitrary chunks (bus
+    monitoring, see monitor.py)
+
+    feed() returns every complete frame with valid check bytes, requests and
+    responses alike, as bytes. Bytes outside a valid frame are dropped and
+    counted in skipped; a partial frame at the end is kept for the next feed()
+    '''
+    # Longest data portion accepted, so a false preamble with a valid header
+    # check byte isn't waited on for long:
+    maxLength = 256
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        end = len(buffer)
+        while True:
+            found = buffer.find(b'\x55\xff', start)
+            if found < 0:
+                # A preamble may be split between this chunk and the next:
+                found = end - 1 if end > start and buffer[-1] == 0x55 else end
+                self.skipped += found - start
+                start = found
+                break
+            self.skipped += found - start
+            start = found
+            if end - start < 8:
+                break
+            size = 10 + (buffer[start + 5] << 8 | buffer[start + 6])
+            if buffer[start + 7] != headerCheck(buffer, start) or size > 10 + self.maxLength:
+                start += 1
+                self.skipped += 1
+                continue
+            if end - start < size:
+                break
+            frame = bytes(buffer[start:start + size])
+            if dataCheck.unpack_from(frame, size - 2)[0] != dataCrc(frame[8:-2]):
+                start += 1
+                self.skipped += 1
+                continue
+            frames.append(frame)
+            start += size
+        del buffer[:start]
+        self.frames += len(frames)
+        return frames
@@ -0,0 +1,90 @@
+import configparser
+
+# Section names that do not describe a controller (see config.ini):
+reservedNames = ['SERIAL', 'GENERAL']
+
+def parseConfig(fileName):
+    '''
+    Reads a config .ini file (see config.ini for a template) and returns a dict
+    of general settings, serial settings and controllers
+
+    Used by both the GUI control tab and the headless poller so that they
+    accept exactly the same file. Missing settings fall back to the same
+    defaults the GUI has always used
+    '''
+    config = configparser.ConfigParser()
+    if not config.read(fileName):
+        raise Exception('Could not read config file: {0}'.format(fileName))
+
+    general = config['GENERAL'] if config.has_section('GENERAL') else {}
+    serialSettings = config['SERIAL'] if config.has_section('SERIAL') else {}
+
+    settings = {
+        # Maximum setpoint temperature in kelvin:
+        'maxTemp': float(general.get('maxtemp', 800)),
+        # Time interval between temperature and setpoint reads in seconds:
+        'readInterval': float(general.get('readinterval', 60)),
+        # Seconds a setpoint read (or written) is trusted before it is read again:
+        'setpointRefresh': float(general.get('setpointrefresh', 600)),
+        # Fastest read interval of a focused controller (GUI focus mode):
+        'focusInterval': float(general.get('focusinterval', 0.2)),
+        # Adaptive polling (adaptive.py), readinterval becomes the slowest rate:
+        'minReadInterval': float(general['minreadinterval']) if 'minreadinterval' in general else None,
+        'rateThreshold': float(general.get('ratethreshold', 0.05)),
+        'errorThreshold': float(general.get('errorthreshold', 2)),
+        'busBudget': float(general.get('busbudget', 10)),
+        # Predictive polling (predictive.py), replaces adaptive polling:
+        'tolerance': float(general['tolerance']) if 'tolerance' in general else None,
+        'processNoise': float(general.get('processnoise', 0.0001)),
+        # Over-temperature watchdog (alarms.py), see 'alarmtemp' and 'maxrate'
+        # in the controller sections:
+        'alarmInterval': float(general.get('alarminterval', 1)),
+        'alarmMargin': float(general.get('alarmmargin', 10)),
+        'alarmLookahead': float(general.get('alarmlookahead', 60)),
+        # Parameters read with current temp and setpoint in one request per
+        # controller through its assembly (e.g. heatPower, alarmState, loopMode):
+        'assembly': (['currentTemp', 'setpoint'] + [name.strip() for name in general['assembly'].split(',')]
+                     if general.get('assembly') else None),
+        'historyFile': general.get('historyfile'),
+        'logFile': general.get('logfile'),
+        # Local JSON API (api.py), disabled unless a port is given:
+        'apiHost': general.get('apihost', '127.0.0.1'),
+        'apiPort': int(general['apiport']) if 'apiport' in general else None,
+        # Run the bus engine in a child process (bus_process.py, GUI only):
+        'busProcess': general.get('busprocess', 'no').lower() in ('yes', 'true', '1'),
+        'port': serialSettings.get('port'),
+        # Baud rate, detected (autobaud.py) if missing, empty or 'auto':
+        'baudrate': (int(serialSettings['baudrate'])
+                     if serialSettings.get('baudrate', '').lower() not in ('', 'auto') else None),
+        'timeout': float(serialSettings.get('timeout') or 0.5),
+        # Bus protocol, 'standard' (Standard Bus) or 'modbus' (Modbus RTU):
+        'protocol': serialSettings.get('protocol', 'standard').lower(),
+        # Linux low-latency serial settings and exclusive lock (lowlatency.py):
+        'lowLatency': serialSettings.get('lowlatency', 'no').lower() in ('yes', 'true', '1'),
+        # Listen-only: decode the traffic of another master on the bus
+        # instead of polling (monitor.py, Standard Bus only):
+        'monitor': serialSettings.get('monitor', 'no').lower() in ('yes', 'true', '1'),
+        # host:port of a bus broker (broker.py) to use instead of the port:
+        'broker': serialSettings.get('broker'),
+        'controllers': []
+    }
+    # The broker relays Standard Bus frames only:
+    if settings['protocol'] == 'modbus' and settings['broker']:
+        raise Exception('protocol=modbus cannot be used with broker= in [SERIAL], '
+                        'the broker only relays Standard Bus frames')
+
+    for section in config.sections():
+        if section in reservedNames:
+            continue
+        settings['controllers'].append({
+            'name': section.title(),
+            'address': int(config[section]['address']),
+            'mode': config[section].get('mode', 'off').lower(),
+            # Optional temperature read interval for this controller only:
+            'readInterval': float(config[section]['readinterval']) if 'readinterval' in config[section] else None,
+            # Optional watchdog limits, kelvin and kelvin per second:
+            'alarmTemp': float(config[section]['alarmtemp']) if 'alarmtemp' in config[section] else None,
+            'maxRate': float(config[section]['maxrate']) if 'maxrate' in config[section] else None
+        })
+
+    return settings
@@ -3,21 +3,27 @@
 # TODO: Display the config parameters or default parameters somehow, likely means moving parsing to config_tab and emitting a dictionary??
 
 import sys
-import configparser
 import serial
-from PyQt5.QtWidgets import QApplication, QWidget, QLineEdit, QVBoxLayout, QPushButton, QButtonGroup
-from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
-from PyQt5.QtCore import pyqtSignal, QTimer, QThreadPool, QObject
-from PyQt5.Qt import *
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QButtonGroup
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from control_tab_ui import Ui_Form
 from controller import ControllerWidget
 from led import LEDWidget
-from worker import Worker
+from alarms import Watchdog, formatEvent, watchdogRules
+from config import parseConfig
+from engine import BusEngine
+from history import HistoryStore
+import autobaud
+import lowlatency
 
 class ControlTabWidget(QWidget):
 
     serialObjectEmitted = pyqtSignal(str)
     statusEmitted = pyqtSignal(str)
+    readingEmitted = pyqtSignal(object)
+    alarmEmitted = pyqtSignal(object)
+    groupEmitted = pyqtSignal(object)
+    portEmitted = pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
@@ -39,17 +45,52 @@ class ControlTabWidget(QWidget):
         self.ledTimer = QTimer(self)
         self.ledTimer.timeout.connect(self._handleBlinkLED)
 
-        # Threadpool to handle concurrent tasks (periodic controller reads):
-        # * The threadpool handles all Watlow read/set requests to prevent blocking.
-        # * The threadpool is limited to one thread so that requests and reads remain
-        #   sequential even when a set request is triggered during a periodic read.
-        #   Otherwise it is possible to read responses out of order.
-        self.threadpool = QThreadPool()
-        self.threadpool.setMaxThreadCount(1)
-
-        # Timer that reads controller values at specified interval
-        self.readTimer = QTimer(self)
-        self.readTimer.timeout.connect(lambda: self._runInThreadpool(self._readTempAll))
+        # Bus engine handles all Watlow read/set requests and periodic reads:
+        # * Requests run on a single worker thread outside the Qt event loop so
+        #   they remain sequential and a GUI stall never delays bus polling.
+        # * Readings are passed back to the GUI thread through readingEmitted
+        # * With 'busprocess' in the config file the engine runs in a child
+        #   process instead and refreshTimer reads its shared memory table
+        self.engine = BusEngine(self.serial)
+        self.processMode = False
+        self.engine.addListener(self._publishReading)
+        self.engine.addPortListener(self._portChanged)
+        self.readingEmitted.connect(self._handleReading)
+        self.engine.start()
+
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.timeout.connect(lambda: self.engine.refresh())
+
+        # Timer that reports bus overruns in the status bar while polling
+        self.statsTimer = QTimer(self)
+        self.statsTimer.timeout.connect(self._checkBusStats)
+        self.lastOverruns = 0
+
+        # Shows estimated temperatures between reads with predictive polling
+        self.estimateTimer = QTimer(self)
+        self.estimateTimer.timeout.connect(self._showEstimates)
+
+        # Fastest read interval of a focused controller in seconds:
+        self.minFocusInterval = 0.2
+        # Linux low-latency serial settings ('lowlatency' in the config file):
+        self.lowLatency = False
+        # Serial settings from the config file, the baud rate is detected
+        # while it is None (see autobaud.py):
+        self.port = None
+        self.baudrate = None
+        self.timeout = 0.5
+        # Listen-only mode ('monitor' in the config file) and its BusMonitor
+        # while connected:
+        self.monitorMode = False
+        self.monitor = None
+
+        # Optional history store, watchdog and JSON API opened from the config file:
+        self.history = None
+        self.watchdog = None
+        self.api = None
+        self.alarmEmitted.connect(self._handleAlarm)
+        self.groupEmitted.connect(self._handleGroupResult)
+        self.portEmitted.connect(self._handlePortEvent)
 
         # Default temperature and setpoint read interval in milliseconds:
         self.readInterval = 60000
@@ -61,9 +102,11 @@ class ControlTabWidget(QWidget):
         self.scrollWidget.setLayout(self.scrollWidgetLayout)
         self.ui.scrollArea.setWidget(self.scrollWidget)
 
-        # Available serial ports and descriptions
-        self.availablePorts = None
-        self._populateSerialPorts()
+        # Available serial ports and descriptions. Enumerating ports can be slow,
+        # so it is deferred until the event loop is running (after first paint)
+        self.availablePorts = ['']
+        self.ui.cbSerial.addItem('Select a port')
+        QTimer.singleShot(0, self._populateSerialPorts)
 
         # Button group is used primarily for 'exclusive' checked behavior
         self.tempButtons = QButtonGroup()
@@ -97,6 +140,7 @@ class ControlTabWidget(QWidget):
         '''
         widget.setParent(None)
         del self.controllerWidgetsDict[widget.address]
+        self.engine.removeController(widget.address)
 
     def _setCustomTempAll(self):
         '''
@@ -124,17 +168,58 @@ class ControlTabWidget(QWidget):
     def _setTempAll(self, temp):
         '''
         Sets temperature of connected watlow controllers based on
-        specified heat/cool mode
+        specified heat/cool mode. The setpoints are committed as one group so
+        the zones change together
         '''
+        values = {}
         for address, controllerWidget in self.controllerWidgetsDict.items():
             if controllerWidget.mode == 'heat' and temp > 25:
-                controllerWidget.write('setpoint', temp)
+                values[address] = temp
             elif controllerWidget.mode == 'cool' and temp < 25:
-                controllerWidget.write('setpoint', temp)
+                values[address] = temp
+        if values:
+            self.engine.setGroup(values, self.groupEmitted.emit)
+
+    def _handleGroupResult(self, result):
+        '''
+        Reports the time skew of a group setpoint commit and any controller
+        that did not confirm its new setpoint
+        '''
+        if result['failed']:
+            self.statusEmitted.emit('Setpoint not confirmed at address(es) {0}'.format(
+                ', '.join(str(address) for address in result['failed'])))
+        elif result['skew'] is not None:
+            self.statusEmitted.emit('Set {0} controllers within {1:.0f} ms'.format(
+                len(result['addresses']), result['skew'] * 1000))
+
+    def _portChanged(self, event):
+        '''
+        Bus engine port listener (reconnect thread). The low-latency settings
+        are applied again before requests resume on the re-opened port
+        '''
+        if event['state'] == 'reconnected' and self.lowLatency and isinstance(self.serial, serial.Serial):
+            try:
+                lowlatency.configure(self.serial)
+            except serial.SerialException as e:
+                print(e)
+        self.portEmitted.emit(event)
+
+    def _handlePortEvent(self, event):
+        '''
+        Shows a lost or re-opened port (the engine re-opens it on its own)
+        '''
+        if event['state'] == 'lost':
+            self.ui.connectLED.changeState(False)
+            self.statusEmitted.emit('Lost connection to {0}, reconnecting...'.format(event['port']))
+        else:
+            self.ui.connectLED.changeState(True)
+            self.statusEmitted.emit('Reconnected to {0} after {1:.1f} s'.format(event['port'], event['downtime']))
 
     def buttonGroupSetTempAll(self):
         if not self.serial.isOpen() or not self.serial:
             self.statusEmitted.emit('Serial port is not open!')
+        elif self.monitor:
+            self.statusEmitted.emit('Setpoints cannot be changed in monitor mode.')
         else:
             clickedBtn = self.sender()
             tempK = int(clickedBtn.text().split(' ')[0])
@@ -162,25 +247,90 @@ class ControlTabWidget(QWidget):
             self.statusEmitted.emit('Setpoint exceeds max temperature!')
         else:
             tempC = self._k_to_c(tempK)
-            self._runInThreadpool(self._setTempAll, tempC)
+            self._setTempAll(tempC)
+
+    def _publishReading(self, reading):
+        '''
+        Bus engine listener, may be called from the bus thread
+        '''
+        self.readingEmitted.emit(reading)
 
-    def _readTempAll(self):
+    def _setEngine(self, engine, processMode=False):
         '''
-        Reads current temp and setpoint for all controllers
+        Replaces the bus engine (only while disconnected), keeping the
+        controllers and GUI listener. processMode is True for a BusProcess
         '''
+        self.engine.removeListener(self._publishReading)
+        self.engine.stop()
+        self.engine = engine
+        self.processMode = processMode
+        self.engine.addListener(self._publishReading)
+        self.engine.addPortListener(self._portChanged)
+        self.engine.start()
         for address, controllerWidget in self.controllerWidgetsDict.items():
-            controllerWidget.read('currentTemp')
-            controllerWidget.read('setpoint')
+            self.engine.addController(address)
+            controllerWidget.engine = engine
+        if processMode:
+            self.refreshTimer.start(250)
+        else:
+            self.refreshTimer.stop()
+
+    def _handleReading(self, reading):
+        '''
+        Passes a reading published by the bus engine to its controller widget
+        (runs on the GUI thread)
+        '''
+        controllerWidget = self.controllerWidgetsDict.get(reading['address'])
+        if controllerWidget:
+            controllerWidget.handleReading(reading)
+
+    def _handleAlarm(self, event):
+        '''
+        Shows a watchdog level change in the status bar and on the
+        controller's row (runs on the GUI thread)
+        '''
+        controllerWidget = self.controllerWidgetsDict.get(event['address'])
+        name = controllerWidget.name if controllerWidget else ''
+        self.statusEmitted.emit(formatEvent(event, name))
+        if controllerWidget:
+            controllerWidget.setAlarm(event['level'])
 
     def _toggleTimerRead(self):
         '''
-        Initiates the QTimer for the read queries (_readTempAll)
+        Starts/Stops the bus engine's periodic reads of all controllers
+        '''
+        if not self.engine.isPolling():
+            self.engine.startPolling(self.readInterval / 1000)
+            self.statsTimer.start(5000)
+            if self.engine.predictive:
+                self.estimateTimer.start(500)
+        else:
+            self.engine.stopPolling()
+            self.statsTimer.stop()
+            self.estimateTimer.stop()
+
+    def _showEstimates(self):
+        '''
+        Displays each controller's estimated temperature and its uncertainty
+        between reads (predictive polling)
+        '''
+        if not self.engine.predictive:
+            return
+        for address, controllerWidget in self.controllerWidgetsDict.items():
+            estimate = self.engine.predictive.estimate(address)
+            if estimate is not None:
+                controllerWidget.showEstimate(*estimate)
+
+    def _checkBusStats(self):
+        '''
+        Shows overrun count and read lag when reads were coalesced because
+        the bus could not keep up with the read interval
         '''
-        if not self.readTimer.isActive():
-            self.readTimer.start(self.readInterval)
-            self._runInThreadpool(self._readTempAll)
-        elif self.readTimer.isActive():
-            self.readTimer.stop()
+        stats = self.engine.stats()
+        if stats.get('overruns', 0) > self.lastOverruns:
+            self.statusEmitted.emit('Bus overrun: {0} coalesced, {1} stale reads dropped, lag {2:.0f} ms'.format(
+                stats['overruns'], stats['staleDropped'], stats['lag']))
+            self.lastOverruns = stats['overruns']
 
     def _handleBlinkLED(self):
         if self.ui.monitorLED.state:
@@ -204,6 +354,8 @@ class ControlTabWidget(QWidget):
         Finds all connected serial ports and populates the serial combo box
         with the name and description of each
         '''
+        # QtSerialPort is only needed here, imported on first use:
+        from PyQt5.QtSerialPort import QSerialPortInfo
         portList = QSerialPortInfo.availablePorts()
         self.ui.cbSerial.clear()
         self.ui.cbSerial.addItem('Select a port')
@@ -231,31 +383,62 @@ class ControlTabWidget(QWidget):
         * Toggles the read timer
         '''
         index = self.ui.cbSerial.currentIndex()
-        if index == 0:
+        from broker import BrokerConnection
+        isBroker = isinstance(self.serial, BrokerConnection)
+        if index == 0 and not isBroker:
             self.statusEmitted.emit('Please select a port.')
         elif not self.serial.isOpen() or not self.serial:
-            print(self.availablePorts, self.availablePorts[index])
-            self.serial.port = self.availablePorts[index]
-            self.serial.baudrate = 38400 # Watlow controller default baudrate
-            self.serial.timeout = 0.5
+            # Controller probed for the baud rate when the config doesn't give one:
+            address = min(self.controllerWidgetsDict) if self.controllerWidgetsDict else 1
+            listenOnly = self.monitorMode and isinstance(self.serial, serial.Serial) and \
+                         self.engine.protocol == 'standard'
+            if self.monitorMode and not listenOnly:
+                print('Monitor mode needs a Standard Bus serial port, polling instead')
             try:
-                self.serial.open()
+                if isinstance(self.serial, serial.Serial):
+                    print(self.availablePorts, self.availablePorts[index])
+                    baudrate = autobaud.openPort(self.serial, self.availablePorts[index], self.baudrate,
+                                                 self.timeout, address, self.engine.protocol, listenOnly)
+                    print('Baud rate: ', baudrate)
+                else:
+                    if not isBroker:
+                        self.serial.port = self.availablePorts[index]
+                        self.serial.baudrate = self.baudrate
+                        self.serial.timeout = self.timeout
+                        self.serial.probeAddress = address
+                    self.serial.open()
+                if self.lowLatency and isinstance(self.serial, serial.Serial):
+                    try:
+                        print('Low latency mode: ', lowlatency.configure(self.serial))
+                    except serial.SerialException:
+                        self.serial.close()
+                        raise
             except serial.SerialException as e:
                 print(e)
-                self.statusEmitted.emit('Could not open port: ' + self.availablePorts[index])
+                self.statusEmitted.emit('Could not open port: ' + str(self.serial.port))
             else:
-                if self.controllerWidgetsDict:
-                    for address, controllerWidget in self.controllerWidgetsDict.items():
-                        controllerWidget.updateSerial(self.serial)
+                self.engine.updateSerial(self.serial)
                 self.ui.btnSerialConnect.setText('Disconnect')
                 self.ui.connectLED.changeState(True)
-                self.statusEmitted.emit('Connected to {0}'.format(self.serial.port))
-                self._toggleTimerRead()
+                if listenOnly:
+                    from monitor import BusMonitor
+                    self.monitor = BusMonitor(self.engine, self.serial)
+                    self.monitor.start()
+                    self.statusEmitted.emit('Listening to {0}'.format(self.serial.port))
+                else:
+                    self.statusEmitted.emit('Connected to {0}'.format(self.serial.port))
+                    self._toggleTimerRead()
                 self._toggleBlinkLED()
         else:
-            self._toggleTimerRead()
+            if self.monitor:
+                self.monitor.stop()
+                print('Monitor statistics: ', self.monitor.stats())
+                self.monitor = None
+            else:
+                self._toggleTimerRead()
             self._toggleBlinkLED()
             self.ui.monitorLED.changeState(False)
+            self.engine.cancelReconnect()
             self.serial.flush()
             self.serial.close()
             self.ui.btnSerialConnect.setText('Connect')
@@ -274,63 +457,131 @@ class ControlTabWidget(QWidget):
         '''
         Handler for config file name emitted from config_tab widget
         '''
-        config = configparser.ConfigParser()
-        config.read(fileName)
-        serialSettings = config['SERIAL']
+        try:
+            settings = parseConfig(fileName)
+        except Exception as e:
+            print(e)
+            self.statusEmitted.emit('Could not read config file: {0}'.format(e))
+            return
 
-        if 'maxtemp' in config['GENERAL'].keys():
-            self.maxTemp = float(config['GENERAL']['maxtemp'])
-        else:
-            self.maxTemp = 800
-        if 'readinterval' in config['GENERAL'].keys():
-            self.readInterval = int(config['GENERAL']['readinterval']) * 1000
-        else:
-            self.readInterval = 60000
+        self.maxTemp = settings['maxTemp']
+        self.readInterval = int(settings['readInterval'] * 1000)
+        self.minFocusInterval = settings['focusInterval']
 
         # Extract Serial Info:
-        try:
-            self.port = config['SERIAL']['port']
-            self.baudrate = config['SERIAL']['baudrate']
-            self.timeout = config['SERIAL']['timeout']
-
+        self.port = settings['port']
+        self.baudrate = settings['baudrate']
+        self.timeout = settings['timeout']
+        self.lowLatency = settings['lowLatency']
+        self.monitorMode = settings['monitor']
+        if self.port:
             for i, availablePort in enumerate(self.availablePorts):
                 if self.port in availablePort:
                     self.ui.cbSerial.setCurrentIndex(i)
-        except Exception as e:
-            print(e)
-        else:
-            print(self.port, self.baudrate, self.timeout)
+        print(self.port, self.baudrate, self.timeout)
+
+        # Bus process or broker replace the serial port (only while disconnected):
+        if not self.serial.isOpen():
+            if settings['busProcess'] != self.processMode:
+                if settings['busProcess']:
+                    # multiprocessing is only loaded for the opt-in process mode:
+                    from bus_process import BusProcess
+                    self._setEngine(BusProcess(), processMode=True)
+                else:
+                    self._setEngine(BusEngine())
+            if settings['busProcess']:
+                self.serial = self.engine.connection
+                self.serial.lowLatency = settings['lowLatency']
+            elif settings['broker']:
+                from broker import BrokerConnection, parseBrokerAddress
+                self.serial = BrokerConnection(*parseBrokerAddress(settings['broker']))
+            else:
+                self.serial = serial.Serial()
+            self.engine.updateSerial(self.serial)
+        self.engine.setProtocol(settings['protocol'])
+        self.engine.setAssembly(settings['assembly'])
+        self.engine.setMaxAge('setpoint', settings['setpointRefresh'])
+        self.engine.readInterval = settings['readInterval']
+        self.engine.setAdaptive(settings['minReadInterval'], settings['rateThreshold'],
+                                settings['errorThreshold'], settings['busBudget'])
+        if settings['tolerance']:
+            self.engine.setPredictive(settings['tolerance'], settings['minReadInterval'],
+                                      settings['processNoise'], budget=settings['busBudget'])
+
+        if self.history:
+            self.engine.removeListener(self.history.record)
+            self.history.close()
+            self.history = None
+        if settings['historyFile']:
+            self.history = HistoryStore(settings['historyFile'])
+            self.engine.addListener(self.history.record)
+
+        if self.watchdog:
+            self.watchdog.close()
+            self.watchdog = None
+        rules = watchdogRules(settings)
+        if rules:
+            self.watchdog = Watchdog(self.engine, rules, settings['alarmInterval'], settings['alarmMargin'],
+                                     settings['alarmLookahead'])
+            self.watchdog.addListener(self.alarmEmitted.emit)
+
+        if self.api:
+            self.api.stop()
+            self.api = None
+        if settings['apiPort']:
+            # The API is off by default, http.server is only loaded for it:
+            from api import ApiServer
+            names = {controller['address']: controller['name'] for controller in settings['controllers']}
+            self.api = ApiServer(self.engine, settings['apiHost'], settings['apiPort'], self.maxTemp, names,
+                                 self.watchdog)
+            try:
+                self.api.start()
+            except OSError as e:
+                print(e)
+                self.statusEmitted.emit('Could not start API on port {0}'.format(settings['apiPort']))
+                self.api = None
 
         # Deal with Controller Info:
-        try:
-            reservedNames = ['SERIAL', 'GENERAL']
-            controllers = [controller for controller in config.sections() if controller not in reservedNames]
-            if controllers == []:
-                raise Exception('No controllers found in config file.')
-        except Exception as e:
-            print(e)
+        if settings['controllers'] == []:
+            print('No controllers found in config file.')
         else:
-            self.controllerWidgetsDict = {int(config[controller]['address']): ControllerWidget(self.serial, controller.title(), int(config[controller]['address']), config[controller]['mode'], self.maxTemp) for controller in controllers}
+            for address in list(self.controllerWidgetsDict):
+                self.engine.removeController(address)
+            self.controllerWidgetsDict = {}
             self._clearLayout()
-            for address, controllerWidget in self.controllerWidgetsDict.items():
-                self.scrollWidgetLayout.addWidget(controllerWidget)
-                controllerWidget.widgetEmitted.connect(self._deleteWidget)
-                controllerWidget.statusEmitted.connect(self._passStatus)
-                controllerWidget.setPointEmitted.connect(self._runInThreadpool)
-
-        if self.serial.isOpen():
-            # Toggles read timer off then on again (reads when toggled on)
+            for controller in settings['controllers']:
+                self._addControllerWidget(ControllerWidget(self.engine, controller['name'], controller['address'], controller['mode'], self.maxTemp))
+                self.engine.setPeriod(controller['address'], 'currentTemp', controller['readInterval'])
+
+        if self.engine.isPolling():
+            # Restarts periodic reads with the new interval (reads when restarted)
             self._toggleTimerRead()
             self._toggleTimerRead()
 
-    def _runInThreadpool(self, func, *args, **kwargs):
+    def _addControllerWidget(self, controllerWidget):
+        '''
+        Registers a controller widget with the bus engine and adds it to the
+        scroll area
+        '''
+        self.engine.addController(controllerWidget.address)
+        self.controllerWidgetsDict[controllerWidget.address] = controllerWidget
+        self.scrollWidgetLayout.addWidget(controllerWidget)
+        controllerWidget.widgetEmitted.connect(self._deleteWidget)
+        controllerWidget.statusEmitted.connect(self._passStatus)
+        controllerWidget.focusEmitted.connect(self._toggleFocus)
+
+    def _toggleFocus(self, controllerWidget):
         '''
-        Creates QRunnable and passes to threadpool. Used with:
-        * Periodic temp/setpoint reads
-        * Changing setpoints from the control tab
-        * Individual set requests emitted from controller instances
+        Gives a controller most of the bus bandwidth (focus mode), or returns
+        to normal polling when the focused controller is clicked again
         '''
-        self.threadpool.start(Worker(func, *args, **kwargs))
+        focused = not controllerWidget.focused
+        for widget in self.controllerWidgetsDict.values():
+            widget.setFocused(False)
+        controllerWidget.setFocused(focused)
+        self.engine.setFocus(controllerWidget.address if focused else None, self.minFocusInterval)
+        if focused:
+            self.statusEmitted.emit('Focus on {0}'.format(controllerWidget.name))
 
     def handleManualAdd(self, controllerInfo):
         '''
@@ -339,10 +590,7 @@ class ControlTabWidget(QWidget):
         name = controllerInfo[0]
         address = controllerInfo[1]
         mode = controllerInfo[2]
-        controllerWidget = ControllerWidget(self.serial, name, address, mode)
-        self.controllerWidgetsDict[address] = controllerWidget
-        self.scrollWidgetLayout.addWidget(controllerWidget)
-        controllerWidget.widgetEmitted.connect(self._deleteWidget)
+        self._addControllerWidget(ControllerWidget(self.engine, name, address, mode, self.maxTemp))
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -1,23 +1,22 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QLineEdit, QPushButton
-from PyQt5.QtCore import pyqtSignal
-from PyQt5.QtCore import QSize
+from PyQt5.QtWidgets import QApplication, QWidget, QLineEdit, QPushButton, QLabel
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import QSize, QRect
 from controller_ui import Ui_Form
-from watlow_driver import PM3
 
 class ControllerWidget(QWidget):
 
     widgetEmitted = pyqtSignal(object)
     statusEmitted = pyqtSignal(str)
-    setPointEmitted = pyqtSignal(object)
+    focusEmitted = pyqtSignal(object)
 
-    def __init__(self, connection, name='No Name', address=1, mode=None, maxTemp=None):
+    def __init__(self, engine, name='No Name', address=1, mode=None, maxTemp=None):
         super().__init__()
 
         self.ui = Ui_Form()
         self.ui.setupUi(self)
 
-        self.connection = connection
+        self.engine = engine
         self.name = name
         self.address = int(address)
         self.mode = mode
@@ -26,6 +25,25 @@ class ControllerWidget(QWidget):
         self.setpoint = 0
         self.currentTemp = 0
 
+        # Focus mode (high rate reads of this controller) and the achieved
+        # sample rate, averaged over recent currentTemp readings:
+        self.focused = False
+        self.sampleRate = None
+        self.lastReadingTime = None
+        # Watchdog level: 'ok', 'warning' or 'alarm'
+        self.alarm = 'ok'
+        # Lets the style sheet color the background of the focused controller
+        self.setAttribute(Qt.WA_StyledBackground, True)
+
+        # Output power, alarm state and loop mode (read through the assembly
+        # when 'assembly' is set in the config file):
+        self.monitor = {}
+        self.labelMonitor = QLabel(self)
+        self.labelMonitor.setGeometry(QRect(310, 30, 170, 18))
+        font = self.labelMonitor.font()
+        font.setPointSize(8)
+        self.labelMonitor.setFont(font)
+
         # Setup scrollArea entry information:
         self.ui.labelName.setText(self.name)
         self.ui.labelAddress.setText(str(self.address))
@@ -35,13 +53,10 @@ class ControllerWidget(QWidget):
         elif mode.lower() == 'heat':
             self.ui.cbMode.setCurrentIndex(1)
 
-        # Initiate instance of Watlow PM3 Controller:
-        self.controller = PM3(self.connection, address=self.address)
-
         # Signals/Slots:
-        self.ui.btnSetTemp.clicked.connect(self._emitSetTemp)
+        self.ui.btnSetTemp.clicked.connect(self._setTempFromInput)
         self.ui.btnDelete.clicked.connect(self._handleEmitWidget)
-        self.ui.leSetTemp.returnPressed.connect(self._emitSetTemp)
+        self.ui.leSetTemp.returnPressed.connect(self._setTempFromInput)
         self.ui.cbMode.currentTextChanged.connect(self._handleChangeMode)
 
     def _handleEmitWidget(self):
@@ -51,15 +66,11 @@ class ControllerWidget(QWidget):
         '''
         self.widgetEmitted.emit(self)
 
-    def _emitSetTemp(self):
+    def _setTempFromInput(self):
         '''
-        Set temp function is emitted so that it will be added to the request threadpool
-        in the control tab rather than being called from the controller in the
-        main event loop. Avoids reading responses out of order.
-
-        * QLineEdit changes are made before emitting function because .clear()
-          would often crash program without rasing an error when executed after
-          being emitted (or possibly when executed in the threadpool)
+        Handles the setpoint line edit. The set request itself is queued on the
+        bus engine so it never runs in the main event loop and responses are
+        not read out of order
         '''
         try:
             tempK = int(self.ui.leSetTemp.text())
@@ -67,7 +78,7 @@ class ControllerWidget(QWidget):
             print(e)
             self.statusEmitted.emit('Temperature must be an integer.')
         else:
-            self.setPointEmitted.emit(lambda: self._handleSetTemp(tempK))
+            self._handleSetTemp(tempK)
         finally:
             self.ui.leSetTemp.clear()
 
@@ -80,6 +91,47 @@ class ControllerWidget(QWidget):
         except Exception as e:
             print('_handleSetTemp: ', e)
 
+    def mousePressEvent(self, event):
+        '''
+        Clicking the controller row toggles focus mode for it
+        '''
+        self.focusEmitted.emit(self)
+        super().mousePressEvent(event)
+
+    def setFocused(self, focused):
+        self.focused = focused
+        self.sampleRate = None
+        self.lastReadingTime = None
+        self._updateStyle()
+        self.ui.labelName.setText(self.name)
+
+    def setAlarm(self, level):
+        self.alarm = level
+        self._updateStyle()
+
+    def _updateStyle(self):
+        # Alarm colors take precedence over the focus color
+        color = {'alarm': 'salmon', 'warning': 'khaki'}.get(self.alarm)
+        if color is None and self.focused:
+            color = 'lightsteelblue'
+        self.setStyleSheet('ControllerWidget {{background-color: "{0}"}}'.format(color) if color else '')
+
+    def _updateSampleRate(self, readingTime):
+        if self.lastReadingTime is not None and readingTime > self.lastReadingTime:
+            rate = 1 / (readingTime - self.lastReadingTime)
+            self.sampleRate = rate if self.sampleRate is None else self.sampleRate + (rate - self.sampleRate) * 0.2
+            self.ui.labelName.setText('{0} ({1:.1f} Hz)'.format(self.name, self.sampleRate))
+        self.lastReadingTime = readingTime
+
+    def showEstimate(self, tempC, deviation):
+        '''
+        Shows the estimated current temp between reads (predictive polling)
+        with its uncertainty next to the controller name
+        '''
+        self.ui.lcdCurrentT.display(round(self._c_to_k(tempC), 1))
+        if not self.focused:
+            self.ui.labelName.setText('{0} (\u00b1{1:.1f} K)'.format(self.name, deviation))
+
     def _handleChangeMode(self, value):
         self.mode = value.lower()
 
@@ -110,33 +162,47 @@ class ControllerWidget(QWidget):
         elif command == 'setpoint':
             self.setpoint = self._c_to_k(response['data'])
             self.ui.lcdSetpoint.display(self._c_to_k(response['data']))
+        else:
+            self.monitor[command] = response['data']
+            self._updateMonitor()
+            return
         # Status LED:
         if abs((self.currentTemp - self.setpoint)) < 20:
             self.ui.connectLED.changeState(True)
         else:
             self.ui.connectLED.changeState(False)
 
-    def updateSerial(self, serialObj):
-        self.controller.updateSerial(serialObj)
+    def _updateMonitor(self):
+        parts = []
+        if 'heatPower' in self.monitor:
+            parts.append('Power {0:.0f}%'.format(self.monitor['heatPower']))
+        if 'alarmState' in self.monitor:
+            parts.append('Alarm {0}'.format(self.monitor['alarmState']))
+        if 'loopMode' in self.monitor:
+            parts.append('Mode {0}'.format(self.monitor['loopMode']))
+        self.labelMonitor.setText('  '.join(parts))
+
+    def handleReading(self, reading):
+        '''
+        Slot for readings published by the bus engine for this address
+        '''
+        if self.focused and reading['command'] == 'currentTemp' and reading['error'] is None:
+            self._updateSampleRate(reading['time'])
+        self._handleResponse(reading['command'], reading)
 
     def read(self, command):
-        commandDict = {'currentTemp': '4001', 'setpoint': '7001'}
-        try:
-            response = self.controller.write(dataParam=commandDict[command])
-        except Exception as e:
-            print(e)
-        else:
-            #print(response)
-            self._handleResponse(command, response)
+        '''
+        Queues a read of 'currentTemp' or 'setpoint' on the bus engine
+        '''
+        self.engine.read(self.address, command)
 
     def write(self, command, value):
-        try:
-            response = self.controller.set(value)
-        except Exception as e:
-            print(e)
-        else:
-            print('write response: ', response)
-            self._handleResponse(command, response)
+        '''
+        Queues a set request on the bus engine, the response is passed back
+        through handleReading
+        '''
+        if command == 'setpoint':
+            self.engine.set(self.address, value)
 
 
 if __name__ == '__main__':
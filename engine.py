@@ -0,0 +1,851 @@
+import queue
+import threading
+import time
+from adaptive import AdaptivePoller
+from predictive import PredictivePoller
+from scheduler import PollScheduler
+
+class BusEngine():
+    '''
+    Owns the Watlow PM3 controllers on one serial bus and runs every read/set
+    request on a single worker thread
+
+    * Requests are executed one at a time so that responses are never read
+      out of order, even when a set request arrives during a periodic read
+    * Contains no Qt code so it can be shared by the GUI and headless poller
+    * Decoded readings are passed to every registered listener (called from
+      the worker thread) and the most recent good reading of each
+      (address, command) pair is kept in self.latest
+    * PM3 objects (and the driver module) are only created on first bus access
+      so the driver is not loaded until there is something to connect to
+    '''
+    # Parameter IDs by command name. The IDs of the monitoring parameters
+    # (read through the assembly, see setAssembly) are from the PM manual
+    # and should be checked against the controller:
+    commandDict = {'currentTemp': '4001', 'setpoint': '7001', 'heatPower': '8011', 'alarmState': '9002',
+                   'loopMode': '8001'}
+    # Commands whose values are temperatures (degrees C):
+    temperatureCommands = ('currentTemp', 'setpoint')
+
+    def __init__(self, connection=None, protocol='standard'):
+        self.connection = connection
+        # 'standard' (Standard Bus, watlow_driver.PM3) or 'modbus' (Modbus
+        # RTU, modbus_driver.PM3Modbus):
+        self.protocol = protocol
+
+        # Dictionary of PM3 objects by address (None until first used):
+        self.controllers = {}
+
+        # Most recent valid reading by (address, command):
+        self.latest = {}
+
+        self.listeners = []
+
+        # Parameter cache: a periodic read is skipped while the last valid
+        # reading is younger than maxAge seconds (0 = always read). Setpoints
+        # only change when written (the set response refreshes the cache) or
+        # at the front panel, so they are re-verified on a slower schedule
+        self.maxAge = {'currentTemp': 0, 'setpoint': 600}
+        self._readTimes = {}
+
+        # Metrics, see stats():
+        self.transactions = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.overruns = 0
+        self.staleDropped = 0
+        self.lag = 0
+        # Time between the first and last acknowledged set of the last group
+        # commit (seconds):
+        self.groupSkew = None
+        self.setsCoalesced = 0
+        self.setsSkipped = 0
+
+        # Overrun protection: at most one sweep of periodic reads (and one
+        # readAll) waits for the bus thread at a time, later ones are merged
+        # into it. By deadline, keyed by (address, command):
+        self._pendingDue = None
+        self._readAllPending = False
+        # Setpoint writes waiting for the bus thread by address, and the
+        # waiting group commit ({address: value}, [callback]). A newer write
+        # replaces a waiting one (last writer wins):
+        self._pendingSets = {}
+        self._pendingGroup = None
+        self._pendingLock = threading.Lock()
+
+        self._queue = queue.Queue()
+        # Urgent requests (watchdog re-reads) run before anything queued and
+        # between the reads of a sweep:
+        self._urgent = queue.Queue()
+        self._thread = None
+        self._pollThread = None
+        self._pollStop = threading.Event()
+        # Set to re-plan the schedule right away (focus/controller changes):
+        self._pollWake = threading.Event()
+        self.readInterval = 60
+
+        # Optional AdaptivePoller (or PredictivePoller, also kept in
+        # self.predictive for its estimates) that sets each controller's read
+        # interval:
+        self.adaptive = None
+        self.predictive = None
+
+        # Periodic reads, with read intervals set per (address, command) in
+        # self.periods (readInterval by default):
+        self.scheduler = PollScheduler()
+        self.periods = {}
+
+        # Focus mode: one controller gets focusShare of the bus, read no
+        # faster than minFocusInterval, the others share the rest in a slow
+        # round-robin. transactionTime is a running average of measured reads
+        self.focus = None
+        self.minFocusInterval = 0.2
+        self.focusShare = 0.8
+        self.transactionTime = 0.05
+
+        # Commands read together from each controller's assembly (None = one
+        # request per parameter), and the addresses whose assembly is mapped:
+        self.assembly = None
+        self._assemblyReady = set()
+
+        # Fastest current temp read interval by address, set by the watchdog
+        # while a controller is close to an alarm limit:
+        self.priority = {}
+
+        # Automatic reconnect: when the port fails (adapter unplugged or
+        # reset) it is closed and re-opened in the background, first after
+        # minReconnectDelay seconds and then backing off to maxReconnectDelay.
+        # Queued requests wait for it, port listeners are told about it
+        self.reconnect = True
+        self.minReconnectDelay = 0.1
+        self.maxReconnectDelay = 5
+        self.portListeners = []
+        self.reconnects = 0
+        self.downtime = None
+        self._portUp = threading.Event()
+        self._portUp.set()
+        self._reconnectCancel = threading.Event()
+        self._stopping = False
+
+        # Set while a BusMonitor (monitor.py) publishes the traffic of
+        # another master: no controller is created, so nothing is written
+        self.listenOnly = False
+
+    def start(self):
+        '''
+        Starts the worker thread that executes queued bus requests
+        '''
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='BusEngine', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.stopPolling()
+        self._stopping = True
+        self.cancelReconnect()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._stopping = False
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            # Requests wait (in order) while the port is being re-opened:
+            self._portUp.wait()
+            self._runUrgent()
+            if job is None:
+                break
+            self._runJob(job)
+
+    def _runJob(self, job):
+        func, args, kwargs = job
+        try:
+            func(*args, **kwargs)
+        except OSError as e:
+            # serial.SerialException, raised by reads on a dead port
+            print(e)
+            self._portFailed()
+        except Exception as e:
+            print(e)
+
+    def addPortListener(self, listener):
+        '''
+        listener({'state': 'lost' or 'reconnected', 'port', 'attempts',
+        'downtime' (seconds)}) is called from the reconnect thread. On
+        'reconnected' the port is open and no request has used it yet
+        '''
+        self.portListeners.append(listener)
+
+    def _notifyPort(self, event):
+        for listener in list(self.portListeners):
+            try:
+                listener(event)
+            except Exception as e:
+                print('port listener: ', e)
+
+    def _portFailed(self):
+        '''
+        Called on the bus thread when a request could not be written or the
+        port raised: starts re-opening the port unless it was closed on
+        purpose or is already being re-opened
+        '''
+        if not self.reconnect or self._stopping or not self._portUp.is_set():
+            return
+        try:
+            if not self.connection.isOpen():
+                return
+        except Exception:
+            return
+        self._portUp.clear()
+        self._reconnectCancel.clear()
+        threading.Thread(target=self._reconnect, name='BusReconnect', daemon=True).start()
+
+    def _reconnect(self):
+        connection = self.connection
+        port = getattr(connection, 'port', None)
+        print('Lost connection to {0}, reconnecting'.format(port))
+        self._notifyPort({'state': 'lost', 'port': port, 'attempts': 0, 'downtime': 0})
+        lost = time.monotonic()
+        delay = self.minReconnectDelay
+        attempts = 0
+        while not self._reconnectCancel.wait(delay):
+            attempts += 1
+            try:
+                connection.close()
+            except Exception:
+                pass
+            try:
+                connection.open()
+            except Exception as e:
+                delay = min(delay * 2, self.maxReconnectDelay)
+                continue
+            if self._reconnectCancel.is_set():
+                # Closed on purpose while the port was being opened:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                break
+            self.reconnects += 1
+            self.downtime = time.monotonic() - lost
+            print('Reconnected to {0} after {1:.1f} s'.format(port, self.downtime))
+            self._notifyPort({'state': 'reconnected', 'port': port, 'attempts': attempts,
+                              'downtime': self.downtime})
+            # Rebinds every controller, the assembly mapping survives (it is
+            # kept by the controllers)
+            self.updateSerial(connection)
+            break
+        self._portUp.set()
+
+    def cancelReconnect(self):
+        '''
+        Stops re-opening the port (e.g. when it is closed on purpose) and
+        lets waiting requests run
+        '''
+        self._reconnectCancel.set()
+        self._portUp.set()
+
+    def _runUrgent(self):
+        while True:
+            try:
+                job = self._urgent.get_nowait()
+            except queue.Empty:
+                return
+            self._runJob(job)
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Queues any function to run on the bus thread
+        '''
+        self._queue.put((func, args, kwargs))
+
+    def submitUrgent(self, func, *args, **kwargs):
+        '''
+        Runs a function on the bus thread ahead of the queued requests, at
+        most one transaction later
+        '''
+        self._urgent.put((func, args, kwargs))
+        # Wakes the worker thread if it is idle:
+        self._queue.put((self._runUrgent, (), {}))
+
+    def updateSerial(self, serialObj):
+        self.connection = serialObj
+        for address, controller in self.controllers.items():
+            if controller is not None:
+                controller.updateSerial(serialObj)
+
+    def addController(self, address):
+        self.controllers.setdefault(int(address), None)
+        self._pollWake.set()
+
+    def _controller(self, address):
+        '''
+        Returns the PM3 object at address, creating it on first use
+        '''
+        if address not in self.controllers or self.listenOnly:
+            return None
+        if self.controllers[address] is None:
+            if self.protocol == 'modbus':
+                from modbus_driver import PM3Modbus as PM3
+            else:
+                from watlow_driver import PM3
+            self.controllers[address] = PM3(self.connection, address=address)
+            if self.assembly:
+                self._programAssembly(address)
+        return self.controllers[address]
+
+    def setAssembly(self, commands=None):
+        '''
+        Reads the commands (e.g. currentTemp, setpoint, heatPower) of each
+        controller in one request through its assembly. The assembly is
+        programmed on first access to each controller. None to read one
+        parameter per request
+        '''
+        self.assembly = list(commands) if commands else None
+        self._assemblyReady = set()
+        for address, controller in self.controllers.items():
+            if controller is not None and self.assembly:
+                self.submit(self._programAssembly, address)
+
+    def _programAssembly(self, address):
+        controller = self.controllers.get(address)
+        if controller is None or not self.assembly:
+            return
+        self.transactions += len(self.assembly)
+        if controller.programAssembly([self.commandDict[command] for command in self.assembly]):
+            self._assemblyReady.add(address)
+        else:
+            print('Assembly not available at address {0}, reading parameters one at a time'.format(address))
+
+    def setProtocol(self, protocol):
+        '''
+        Selects the bus protocol ('standard' or 'modbus'), controller objects
+        are re-created on next use
+        '''
+        if protocol != self.protocol:
+            self.protocol = protocol
+            self._assemblyReady = set()
+            for address in self.controllers:
+                self.controllers[address] = None
+
+    def removeController(self, address):
+        self.controllers.pop(address, None)
+        self.priority.pop(address, None)
+        self._assemblyReady.discard(address)
+        if self.focus == address:
+            self.focus = None
+        for key in [key for key in self.periods if key[0] == address]:
+            del self.periods[key]
+        # The bus thread may publish into latest meanwhile, a copy of its
+        # keys is iterated:
+        for key in [key for key in list(self.latest) if key[0] == address]:
+            self.latest.pop(key, None)
+            self._readTimes.pop(key, None)
+
+    def addListener(self, func):
+        self.listeners.append(func)
+
+    def removeListener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def _publish(self, command, response):
+        reading = dict(response, command=command, time=time.time())
+        key = (reading['address'], command)
+        if reading['error'] is None:
+            self.latest[key] = reading
+            self._readTimes[key] = time.monotonic()
+        else:
+            # Value is unknown until the next successful read:
+            self._readTimes.pop(key, None)
+        for listener in list(self.listeners):
+            try:
+                listener(reading)
+            except Exception as e:
+                print('listener: ', e)
+        return reading
+
+    def _read(self, address, command):
+        controller = self._controller(address)
+        if controller is None:
+            return
+        if address in self._assemblyReady and command in self.assembly:
+            return self._readAssembly(address).get(command)
+        self.transactions += 1
+        start = time.monotonic()
+        response = controller.write(dataParam=self.commandDict[command])
+        self.transactionTime += (time.monotonic() - start - self.transactionTime) * 0.2
+        # PM3.write returns None when the request could not be written
+        if response is None:
+            self._portFailed()
+            return
+        return self._publish(command, response)
+
+    def _readUrgent(self, address, command):
+        # The input belongs to the monitor while listening (nothing is read):
+        if self.listenOnly:
+            return
+        # Stale input (e.g. the late response to a timed out request) must not
+        # be taken for the response to a priority read:
+        try:
+            self.connection.reset_input_buffer()
+        except Exception as e:
+            print('Exception: ', e)
+        return self._read(address, command)
+
+    def _set(self, address, value):
+        controller = self._controller(address)
+        if controller is None:
+            return
+        self.transactions += 1
+        response = controller.set(value)
+        if response is None:
+            # Written again once the port is back, unless superseded
+            self._portFailed()
+            if not self._portUp.is_set():
+                self.set(address, value)
+            return
+        return self._publish('setpoint', response)
+
+    def _setGroup(self, values, callback=None):
+        '''
+        Sets several setpoints as close together in time as the bus allows
+
+        All set frames are built before the first one is sent. The bus is
+        half-duplex, so each frame still waits for its controller's response
+        before the next is sent, but responses are only read off the port in
+        the loop: parsing, verification and publishing happen afterwards
+        '''
+        frames = []
+        for address, value in values.items():
+            controller = self._controller(address)
+            if controller is not None:
+                frames.append((controller, value, controller._buildSetRequest(controller._c_to_f(value))))
+
+        responses = []
+        for controller, value, frame in frames:
+            try:
+                self.connection.write(frame)
+                response = controller._readSetResponse()
+            except OSError as e:
+                # Port failed: the whole group is committed again once it is back
+                print('Exception: ', e)
+                self._portFailed()
+                if not self._portUp.is_set():
+                    self.setGroup(values, callback)
+                    return
+                response = b''
+            except Exception as e:
+                print('Exception: ', e)
+                response = b''
+            responses.append((controller, value, response, time.monotonic()))
+        self.transactions += len(responses)
+
+        failed = []
+        for controller, value, response, ackTime in responses:
+            output = controller._parseSetResponse(response, value)
+            if output['error'] is None and abs(output['data'] - value) > 0.01:
+                output['error'] = Exception('Exception: Setpoint at address {0} reads back as {1}'.format(
+                    controller.address, output['data']))
+            if output['error'] is not None:
+                failed.append(controller.address)
+            self._publish('setpoint', output)
+        # None when nothing was written (e.g. every value already confirmed):
+        skew = responses[-1][3] - responses[0][3] if responses else None
+        if skew is not None:
+            self.groupSkew = skew
+        result = {'addresses': [controller.address for controller, value, frame in frames],
+                  'failed': failed, 'skew': skew}
+        if callback:
+            callback(result)
+        return result
+
+    def _isConfirmed(self, address, value):
+        '''
+        Returns True if value is the controller's setpoint according to a
+        fresh set response or read
+        '''
+        reading = self.latest.get((address, 'setpoint'))
+        return reading is not None and abs(reading['data'] - value) < 0.01 and self._isFresh(address, 'setpoint')
+
+    def _runSet(self, address):
+        with self._pendingLock:
+            if address not in self._pendingSets:
+                # Superseded by a group commit
+                return
+            value = self._pendingSets.pop(address)
+        if self._isConfirmed(address, value):
+            self.setsSkipped += 1
+            return
+        self._set(address, value)
+
+    def _runGroup(self):
+        with self._pendingLock:
+            values, callbacks = self._pendingGroup
+            self._pendingGroup = None
+        for address in [address for address, value in values.items() if self._isConfirmed(address, value)]:
+            self.setsSkipped += 1
+            del values[address]
+
+        # Every caller merged into the group hears about its commit:
+        def callback(result):
+            for function in callbacks:
+                function(result)
+        self._setGroup(values, callback if callbacks else None)
+
+    def _isFresh(self, address, command):
+        maxAge = self.maxAge.get(command, 0)
+        readTime = self._readTimes.get((address, command))
+        return maxAge > 0 and readTime is not None and time.monotonic() - readTime < maxAge
+
+    def _readAll(self):
+        '''
+        Reads current temp and setpoint for all controllers, skipping values
+        that are still fresh in the parameter cache
+        '''
+        self._readControllers(list(self.controllers))
+
+    def _readControllers(self, addresses):
+        for address in addresses:
+            commands = []
+            for command in ('currentTemp', 'setpoint'):
+                if self._isFresh(address, command):
+                    self.cacheHits += 1
+                else:
+                    self.cacheMisses += 1
+                    commands.append(command)
+            self._runUrgent()
+            self._readMany(address, commands)
+
+    def _readAssembly(self, address):
+        '''
+        Reads and publishes every assembly command of one controller in one
+        request. Returns {command: reading}
+        '''
+        controller = self._controller(address)
+        self.transactions += 1
+        start = time.monotonic()
+        responses = controller.readAssembly([self.commandDict[command] for command in self.temperatureCommands])
+        self.transactionTime += (time.monotonic() - start - self.transactionTime) * 0.2
+        readings = {}
+        if responses is None:
+            self._portFailed()
+            return readings
+        for command in self.assembly:
+            readings[command] = self._publish(command, responses[self.commandDict[command]])
+        return readings
+
+    def _readMany(self, address, commands):
+        '''
+        Reads several parameters of one controller, through the assembly or
+        in block reads when the driver supports them (Modbus)
+        '''
+        controller = self._controller(address)
+        if controller is None or not commands:
+            return
+        if address in self._assemblyReady and set(commands) <= set(self.assembly):
+            self._readAssembly(address)
+            return
+        if len(commands) == 1 or not hasattr(controller, 'readParameters'):
+            for command in commands:
+                self._read(address, command)
+            return
+        start = time.monotonic()
+        responses, transactions = controller.readParameters(commands)
+        self.transactions += transactions
+        if transactions:
+            self.transactionTime += ((time.monotonic() - start) / transactions - self.transactionTime) * 0.2
+        if responses is None:
+            self._portFailed()
+            return
+        for command in commands:
+            self._publish(command, responses[command])
+
+    def setMaxAge(self, command, seconds):
+        '''
+        Sets how long a cached value is used by periodic reads (0 = always read)
+        '''
+        self.maxAge[command] = seconds
+
+    def setPeriod(self, address, command, seconds):
+        '''
+        Sets the read interval of one controller parameter (None to use the
+        engine's readInterval)
+        '''
+        if seconds:
+            self.periods[(int(address), command)] = seconds
+        else:
+            self.periods.pop((int(address), command), None)
+        self._pollWake.set()
+
+    def setFocus(self, address=None, minInterval=None):
+        '''
+        Reads the current temp of one controller as fast as the bus safely
+        allows, the others in a slow background round-robin (None to clear)
+        '''
+        self.focus = int(address) if address is not None else None
+        if minInterval:
+            self.minFocusInterval = minInterval
+        self._pollWake.set()
+
+    def setPriority(self, address, interval=None):
+        '''
+        Reads the current temp of one controller at least every interval
+        seconds, whatever its configured or adaptive period (None to clear).
+        Ignored while listening (there are no reads to speed up)
+        '''
+        if self.listenOnly:
+            return
+        if interval:
+            self.priority[int(address)] = interval
+        else:
+            self.priority.pop(int(address), None)
+        self._pollWake.set()
+
+    def focusInterval(self):
+        # Rounded so small changes in transactionTime don't re-time the task
+        return round(max(self.minFocusInterval, self.transactionTime / self.focusShare), 2)
+
+    def setAdaptive(self, minInterval=None, rateThreshold=0.05, errorThreshold=2, budget=10):
+        '''
+        Enables adaptive polling (see AdaptivePoller) between minInterval and
+        the read interval, or disables it when minInterval is None
+        '''
+        self._clearAdaptive()
+        if minInterval:
+            self.adaptive = AdaptivePoller(minInterval, self.readInterval, rateThreshold, errorThreshold, budget)
+            self.addListener(self.adaptive.update)
+
+    def setPredictive(self, tolerance=None, minInterval=1, processNoise=0.0001, measurementNoise=0.01, budget=10):
+        '''
+        Enables predictive polling (see PredictivePoller): a controller is
+        read when the uncertainty of its estimated temperature reaches
+        tolerance degrees. Replaces adaptive polling, disabled when tolerance
+        is None
+        '''
+        self._clearAdaptive()
+        if tolerance:
+            self.adaptive = PredictivePoller(tolerance, minInterval or 1, self.readInterval,
+                                             processNoise, measurementNoise, budget)
+            self.predictive = self.adaptive
+            self.addListener(self.adaptive.update)
+
+    def _clearAdaptive(self):
+        if self.adaptive:
+            self.removeListener(self.adaptive.update)
+        self.adaptive = None
+        self.predictive = None
+
+    def stats(self):
+        lookups = self.cacheHits + self.cacheMisses
+        return {
+            'transactions': self.transactions,
+            'cacheHits': self.cacheHits,
+            'cacheMisses': self.cacheMisses,
+            'cacheHitRate': self.cacheHits / lookups if lookups else None,
+            'overruns': self.overruns,
+            'staleDropped': self.staleDropped,
+            'lag': self.lag * 1000,
+            'groupSkew': self.groupSkew * 1000 if self.groupSkew is not None else None,
+            'setsCoalesced': self.setsCoalesced,
+            'setsSkipped': self.setsSkipped,
+            'reconnects': self.reconnects,
+            'downtime': self.downtime,
+            **self.scheduler.jitterStats()
+        }
+
+    def read(self, address, command):
+        '''
+        Queues a read of 'currentTemp' or 'setpoint' from one controller
+        '''
+        self.submit(self._read, int(address), command)
+
+    def readNow(self, address, command='currentTemp'):
+        '''
+        Reads one controller parameter ahead of every queued request
+        '''
+        if self.listenOnly:
+            return
+        self.submitUrgent(self._readUrgent, int(address), command)
+
+    def set(self, address, value):
+        '''
+        Queues a setpoint change (value in degrees C) for one controller.
+        A change still waiting for the bus is replaced by the new value, and
+        a value equal to the confirmed setpoint is not written
+        '''
+        address = int(address)
+        with self._pendingLock:
+            waiting = address in self._pendingSets
+            self._pendingSets[address] = value
+            if waiting:
+                self.setsCoalesced += 1
+                return
+        self.submit(self._runSet, address)
+
+    def setGroup(self, values, callback=None):
+        '''
+        Queues a group commit of setpoints ({address: degrees C}, see
+        _setGroup). callback is called from the bus thread with
+        {'addresses', 'failed', 'skew' (seconds)}. Supersedes waiting writes
+        to the same controllers, and is merged into a waiting group commit
+        (whose callbacks are all called with the merged result)
+        '''
+        values = {int(address): value for address, value in values.items()}
+        with self._pendingLock:
+            for address in values:
+                if self._pendingSets.pop(address, None) is not None:
+                    self.setsCoalesced += 1
+            if self._pendingGroup is not None:
+                self.setsCoalesced += 1
+                self._pendingGroup[0].update(values)
+                if callback:
+                    self._pendingGroup[1].append(callback)
+                return
+            self._pendingGroup = (values, [callback] if callback else [])
+        self.submit(self._runGroup)
+
+    def readAll(self):
+        '''
+        Queues a read of all controllers, unless one is already waiting
+        '''
+        with self._pendingLock:
+            if self._readAllPending:
+                self.overruns += 1
+                return
+            self._readAllPending = True
+        self.submit(self._runReadAll)
+
+    def _runReadAll(self):
+        with self._pendingLock:
+            self._readAllPending = False
+        self._readAll()
+
+    def isPolling(self):
+        return self._pollThread is not None and self._pollThread.is_alive()
+
+    def startPolling(self, interval=None):
+        '''
+        Queues a read of every controller now and then every interval seconds
+        (or at the interval chosen by the adaptive poller). Read times are
+        anchored to the monotonic clock so they do not drift with the time
+        each sweep takes
+        '''
+        if interval is not None:
+            self.readInterval = interval
+            if self.adaptive:
+                self.adaptive.maxInterval = interval
+        self.stopPolling()
+        self._pollStop = threading.Event()
+        self._pollThread = threading.Thread(target=self._pollLoop, args=(self.readInterval, self._pollStop),
+                                            name='BusEnginePoll', daemon=True)
+        self._pollThread.start()
+
+    def stopPolling(self):
+        if self._pollThread is not None:
+            self._pollStop.set()
+            self._pollWake.set()
+            self._pollThread.join()
+            self._pollThread = None
+
+    def _syncSchedule(self, interval):
+        '''
+        Adds, removes and re-times scheduler tasks to match the controllers,
+        configured periods and adaptive intervals. New controllers are given
+        phases spread over the period so reads are evenly spaced on the bus
+        (every controller is read once when polling starts)
+        '''
+        addresses = list(self.controllers)
+        adaptiveIntervals = self.adaptive.intervals(addresses) if self.adaptive else {}
+        for key in self.scheduler.keys():
+            if key[0] not in self.controllers:
+                self.scheduler.remove(key)
+        if self.focus in self.controllers:
+            # Time for one read of every other parameter within the bus
+            # share left over by the focused controller:
+            backgroundPeriod = (2 * len(addresses) - 1) * self.transactionTime / (1 - self.focusShare)
+        for i, address in enumerate(addresses):
+            for command in ('currentTemp', 'setpoint'):
+                key = (address, command)
+                period = self.periods.get(key, interval)
+                if command == 'currentTemp' and address in adaptiveIntervals and key not in self.periods:
+                    period = adaptiveIntervals[address]
+                if self.focus in self.controllers:
+                    if key == (self.focus, 'currentTemp'):
+                        period = self.focusInterval()
+                    else:
+                        period = max(period, backgroundPeriod)
+                if command == 'currentTemp' and address in self.priority:
+                    period = min(period, self.priority[address])
+                if key not in self.scheduler:
+                    self.scheduler.schedule(key, period, phase=period * (i + 1) / len(addresses))
+                else:
+                    self.scheduler.setPeriod(key, period)
+
+    def _queueScheduled(self, due):
+        '''
+        Queues reads popped from the scheduler. If the previous sweep has not
+        started yet (the bus is slower than the schedule), the reads are
+        merged into it instead of queueing another sweep
+        '''
+        with self._pendingLock:
+            if self._pendingDue is not None:
+                self.overruns += 1
+                # Newer deadlines replace older ones of the same read
+                self._pendingDue.update(due)
+                return
+            self._pendingDue = dict(due)
+        self.submit(self._readPending)
+
+    def _readPending(self):
+        with self._pendingLock:
+            due, self._pendingDue = self._pendingDue, None
+        self._readScheduled(sorted(due.items(), key=lambda item: item[1]))
+
+    def _readScheduled(self, due):
+        '''
+        Runs the reads popped from the scheduler, recording how late each
+        one starts and skipping values that are fresh in the parameter cache.
+        Reads more than one period late are dropped, their next deadline is
+        already scheduled. The reads due from one controller are made
+        together (see _readMany), controllers in the order of their first
+        deadline
+        '''
+        reads = {}
+        for (address, command), deadline in due:
+            if address not in self.controllers:
+                continue
+            key = (address, command)
+            self.lag = time.monotonic() - deadline
+            if key in self.scheduler and self.lag > self.scheduler.period(key):
+                self.staleDropped += 1
+                continue
+            self.scheduler.recordJitter(key, deadline)
+            if self._isFresh(address, command):
+                self.cacheHits += 1
+            else:
+                self.cacheMisses += 1
+                reads.setdefault(address, []).append(command)
+        for address, commands in reads.items():
+            self._runUrgent()
+            self._readMany(address, commands)
+
+    def _pollLoop(self, interval, stopEvent):
+        self.scheduler.clear()
+        self.readAll()
+        while not stopEvent.is_set():
+            self._syncSchedule(interval)
+            due = self.scheduler.popDue()
+            if due:
+                self._queueScheduled(due)
+
+            # Wakes up for the next deadline, and at least every minInterval
+            # (or interval) to pick up new controllers and adaptive changes
+            wakeup = time.monotonic() + (self.adaptive.minInterval if self.adaptive else interval)
+            nextDeadline = self.scheduler.nextDeadline()
+            if nextDeadline is not None:
+                wakeup = min(wakeup, nextDeadline)
+            self._pollWake.wait(max(wakeup - time.monotonic(), 0))
+            self._pollWake.clear()
@@ -6,4 +6,6 @@ subprocess.call(['pyinstaller', 'main.py', '-y', '--onefile', '--clean', \
 
 # The crcmod module needs to be changed to only import _crcfunpy not crcmod._crcfunpy on line 45-47.
 # Otherwise, PyInstaller does not seem to handle the execution of crcmod properly and the compile exe
-# will not start.
\ No newline at end of file
+# will not start.
+# Startup time of the one-file build can be measured with:
+#   python bench_startup.py --exe dist\main.exe
@@ -0,0 +1,263 @@
+'''
+Headless poller for Watlow EZ-Zone PM3 controllers
+
+Loads the same config file as the GUI, polls every controller on the bus and
+accepts setpoint commands without importing PyQt. Readings are written to the
+log and, when 'historyfile' is set in [GENERAL], to the history store. When
+'apiport' is set the latest readings are also served by the JSON API (api.py).
+With 'monitor=yes' in [SERIAL] nothing is sent: readings are decoded from the
+traffic of another master on the bus (monitor.py) and set commands are refused.
+
+Usage:
+    python headless.py config.ini [--set KELVIN] [--commands]
+
+With --commands, setpoint commands are read from stdin, one per line:
+    set <address> <kelvin>
+    setall <kelvin>
+    read
+'''
+import argparse
+import logging
+import sys
+import time
+import serial
+from alarms import Watchdog, formatEvent, watchdogRules
+from api import ApiServer
+from config import parseConfig
+from engine import BusEngine
+from history import HistoryStore
+import autobaud
+import lowlatency
+
+log = logging.getLogger('watlow')
+
+class HeadlessPoller():
+    '''
+    Runs the BusEngine polling loop and setpoint commands from a parsed
+    config file (see config.parseConfig)
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.maxTemp = settings['maxTemp']
+        self.modes = {c['address']: c['mode'] for c in settings['controllers']}
+        self.names = {c['address']: c['name'] for c in settings['controllers']}
+
+        if settings['broker']:
+            from broker import BrokerConnection, parseBrokerAddress
+            self.serial = BrokerConnection(*parseBrokerAddress(settings['broker']))
+        else:
+            self.serial = serial.Serial()
+        self.engine = BusEngine(self.serial)
+        for controller in settings['controllers']:
+            self.engine.addController(controller['address'])
+            self.engine.setPeriod(controller['address'], 'currentTemp', controller['readInterval'])
+        self.engine.setProtocol(settings['protocol'])
+        self.engine.setAssembly(settings['assembly'])
+        self.engine.setMaxAge('setpoint', settings['setpointRefresh'])
+        self.engine.readInterval = settings['readInterval']
+        self.engine.setAdaptive(settings['minReadInterval'], settings['rateThreshold'],
+                                settings['errorThreshold'], settings['busBudget'])
+        if settings['tolerance']:
+            self.engine.setPredictive(settings['tolerance'], settings['minReadInterval'],
+                                      settings['processNoise'], budget=settings['busBudget'])
+        self.engine.addListener(self._logReading)
+        self.engine.addPortListener(self._logPort)
+
+        self.history = None
+        if settings['historyFile']:
+            self.history = HistoryStore(settings['historyFile'])
+            self.engine.addListener(self.history.record)
+
+        self.watchdog = None
+        rules = watchdogRules(settings)
+        if rules:
+            self.watchdog = Watchdog(self.engine, rules, settings['alarmInterval'], settings['alarmMargin'],
+                                     settings['alarmLookahead'])
+            self.watchdog.addListener(self._logAlarm)
+
+        self.api = None
+        if settings['apiPort']:
+            self.api = ApiServer(self.engine, settings['apiHost'], settings['apiPort'], self.maxTemp, self.names,
+                                 self.watchdog)
+
+        # Listen-only: values come from another master's traffic
+        self.monitor = None
+        if settings['monitor']:
+            if settings['broker'] or settings['protocol'] != 'standard':
+                log.error('Monitor mode needs a Standard Bus serial port, polling instead')
+            else:
+                from monitor import BusMonitor
+                self.monitor = BusMonitor(self.engine, self.serial)
+
+    def open(self):
+        if self.settings['broker']:
+            self.serial.open()
+        else:
+            baudrate = autobaud.openPort(self.serial, self.settings['port'], self.settings['baudrate'],
+                                         self.settings['timeout'], autobaud.probeAddress(self.settings),
+                                         self.settings['protocol'], listenOnly=self.monitor is not None)
+            log.info('Baud rate: %s', baudrate)
+        if self.settings['lowLatency'] and not self.settings['broker']:
+            try:
+                log.info('Low latency mode: %s', lowlatency.configure(self.serial))
+            except serial.SerialException:
+                self.serial.close()
+                raise
+        log.info('Connected to %s', self.serial.port)
+        self.engine.start()
+        if self.monitor:
+            self.monitor.start()
+            log.info('Listening to %s without sending', self.serial.port)
+        else:
+            self.engine.startPolling(self.settings['readInterval'])
+        if self.api:
+            self.api.start()
+            log.info('API listening on %s:%s', self.api.host, self.api.port)
+
+    def close(self):
+        if self.api:
+            self.api.stop()
+        if self.monitor:
+            self.monitor.stop()
+            log.info('Monitor statistics: %s', self.monitor.stats())
+        self.engine.stop()
+        log.info('Bus statistics: %s', self.engine.stats())
+        if self.serial.isOpen():
+            self.serial.flush()
+            self.serial.close()
+        if self.history:
+            self.history.close()
+        log.info('Disconnected')
+
+    def _k_to_c(self, k):
+        return k - 273.15
+
+    def _c_to_k(self, c):
+        return c + 273.15
+
+    def _logReading(self, reading):
+        name = self.names.get(reading['address'], '')
+        if reading['error'] is not None:
+            log.warning('%s (address %s) %s: %s', name, reading['address'], reading['command'], reading['error'])
+        elif reading['command'] in self.engine.temperatureCommands:
+            log.info('%s (address %s) %s: %.2f K', name, reading['address'], reading['command'],
+                     self._c_to_k(reading['data']))
+        else:
+            log.info('%s (address %s) %s: %s', name, reading['address'], reading['command'], reading['data'])
+
+    def _logPort(self, event):
+        if event['state'] == 'lost':
+            log.error('Lost connection to %s, reconnecting', event['port'])
+            return
+        if self.settings['lowLatency'] and not self.settings['broker']:
+            try:
+                lowlatency.configure(self.serial)
+            except serial.SerialException as e:
+                log.error('Low latency mode: %s', e)
+        log.info('Reconnected to %s after %.1f s (%d attempts)', event['port'], event['downtime'], event['attempts'])
+
+    def _logAlarm(self, event):
+        message = formatEvent(event, self.names.get(event['address'], ''))
+        if event['level'] == 'alarm':
+            log.error(message)
+        else:
+            log.warning(message)
+
+    def setTemp(self, address, tempK):
+        '''
+        Sets the setpoint of one controller (kelvin)
+        '''
+        if self.monitor:
+            log.error('Setpoints cannot be changed in monitor mode')
+            return False
+        if self.maxTemp and tempK > self.maxTemp:
+            log.error('Setpoint exceeds max temperature!')
+            return False
+        self.engine.set(address, self._k_to_c(tempK))
+        return True
+
+    def setTempAll(self, tempK):
+        '''
+        Sets the setpoint of the controllers in the matching heat/cool mode,
+        same as the control tab (as one group commit)
+        '''
+        if self.monitor:
+            log.error('Setpoints cannot be changed in monitor mode')
+            return False
+        if self.maxTemp and tempK > self.maxTemp:
+            log.error('Setpoint exceeds max temperature!')
+            return False
+        tempC = self._k_to_c(tempK)
+        values = {}
+        for address, mode in self.modes.items():
+            if (mode == 'heat' and tempC > 25) or (mode == 'cool' and tempC < 25):
+                values[address] = tempC
+        if values:
+            self.engine.setGroup(values, self._logGroupResult)
+        return True
+
+    def _logGroupResult(self, result):
+        if result['failed']:
+            log.error('Setpoint not confirmed at address(es) %s', result['failed'])
+        if result['skew'] is not None:
+            log.info('Set %d controllers within %.1f ms', len(result['addresses']), result['skew'] * 1000)
+
+    def handleCommand(self, line):
+        '''
+        Handles one text command: 'set <address> <kelvin>', 'setall <kelvin>'
+        or 'read'
+        '''
+        args = line.split()
+        try:
+            if not args:
+                return
+            elif args[0] == 'set' and len(args) == 3:
+                self.setTemp(int(args[1]), float(args[2]))
+            elif args[0] == 'setall' and len(args) == 2:
+                self.setTempAll(float(args[1]))
+            elif args[0] == 'read':
+                self.engine.readAll()
+            else:
+                log.error('Unknown command: %s', line.strip())
+        except ValueError as e:
+            log.error('Invalid command %s: %s', line.strip(), e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Poll Watlow PM3 controllers without the GUI')
+    parser.add_argument('config', help='config .ini file (same format as the GUI)')
+    parser.add_argument('--set', type=float, metavar='KELVIN', help='set all heat/cool controllers on startup')
+    parser.add_argument('--commands', action='store_true', help='read setpoint commands from stdin')
+    args = parser.parse_args(argv)
+
+    try:
+        settings = parseConfig(args.config)
+    except Exception as e:
+        print(e)
+        return 1
+    logging.basicConfig(filename=settings['logFile'], level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    poller = HeadlessPoller(settings)
+    try:
+        poller.open()
+    except serial.SerialException as e:
+        log.error('Could not open port %s: %s', settings['port'], e)
+        return 1
+
+    if args.set is not None:
+        poller.setTempAll(args.set)
+    try:
+        if args.commands:
+            for line in sys.stdin:
+                poller.handleCommand(line)
+        else:
+            while poller.engine.isPolling() or (poller.monitor and poller.monitor.isRunning()):
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
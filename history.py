@@ -0,0 +1,53 @@
+import sqlite3
+import threading
+
+class HistoryStore():
+    '''
+    Stores controller readings in an SQLite database, one row per reading
+
+    Values are stored as returned by the driver (degrees C for temperatures).
+    The store can be used as a BusEngine listener (see record), so it is
+    written from the bus thread and read from any other thread
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(fileName, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS readings '
+                        '(time REAL, address INTEGER, parameter TEXT, value REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS readings_time ON readings (address, parameter, time)')
+        self.db.commit()
+
+    def record(self, reading):
+        '''
+        Adds one reading dict (as published by BusEngine). Readings that
+        returned an error are not stored
+        '''
+        if reading['error'] is not None:
+            return
+        with self._lock:
+            self.db.execute('INSERT INTO readings VALUES (?, ?, ?, ?)',
+                            (reading['time'], reading['address'], reading['command'], reading['data']))
+            self.db.commit()
+
+    def query(self, address=None, parameter=None, start=None, end=None):
+        '''
+        Returns a list of (time, address, parameter, value) rows ordered by time
+        '''
+        conditions = []
+        args = []
+        for column, op, value in (('address', '=', address), ('parameter', '=', parameter),
+                                  ('time', '>=', start), ('time', '<', end)):
+            if value is not None:
+                conditions.append('{0} {1} ?'.format(column, op))
+                args.append(value)
+        sql = 'SELECT time, address, parameter, value FROM readings'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time'
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,134 @@
+'''
+Linux low-latency mode for the bus serial port ('lowlatency=yes' in [SERIAL])
+
+USB-RS485 adapters (FTDI and others) hold received bytes for up to 16 ms
+before passing them to the OS, which adds to every transaction. configure()
+applies, as far as the port supports it:
+
+* ASYNC_LOW_LATENCY (TIOCSSERIAL ioctl), which FTDI drivers turn into a
+  1 ms latency timer
+* the FTDI latency timer in sysfs, written directly if it is still higher
+  (needs write permission on the sysfs file)
+* an exclusive lock on the device, so a second program opening the port
+  fails instead of corrupting frames
+
+Reads need no termios tuning: pyserial leaves VMIN and VTIME at 0 and waits
+with select(), so a read returns as soon as the requested bytes have
+arrived, and frames are read by length (see watlow_driver.readFrame).
+VTIME's 0.1 s resolution would be far coarser than a frame anyway.
+
+Settings the port doesn't support (ptys, other platforms) are skipped with
+a message, so the mode can be left on for local testing against a pty.
+Measure the difference on a real bus with:
+
+    python lowlatency.py config.ini --address 1 --count 100
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+import serial
+
+import autobaud
+from config import parseConfig
+
+def _latencyTimerFile(port):
+    device = os.path.basename(os.path.realpath(port))
+    return os.path.join('/sys/bus/usb-serial/devices', device, 'latency_timer')
+
+def _setLatencyTimer(port, ms=1):
+    '''
+    Lowers the FTDI latency timer of port to ms milliseconds. Returns the
+    timer now in effect, or None if the port has none
+    '''
+    fileName = _latencyTimerFile(port)
+    try:
+        with open(fileName) as f:
+            current = int(f.read())
+    except (OSError, ValueError):
+        return None
+    if current <= ms:
+        return current
+    try:
+        with open(fileName, 'w') as f:
+            f.write(str(ms))
+    except OSError as e:
+        print('Could not lower the latency timer of {0}: {1}'.format(port, e))
+        return current
+    return ms
+
+def configure(connection):
+    '''
+    Applies the low-latency settings to an open serial.Serial. Returns a
+    dict of what was applied ('exclusive', 'asyncLowLatency' and
+    'latencyTimer' in ms or None). Raises serial.SerialException if another
+    program has the port locked
+    '''
+    applied = {'exclusive': False, 'asyncLowLatency': False, 'latencyTimer': None}
+    if not sys.platform.startswith('linux') or getattr(connection, 'fd', None) is None:
+        print('Low latency mode is only available for serial ports on Linux')
+        return applied
+
+    # pyserial takes the flock when exclusive is set on an open port:
+    connection.exclusive = True
+    applied['exclusive'] = True
+    try:
+        connection.set_low_latency_mode(True)
+    except (ValueError, AttributeError) as e:
+        # ptys and some drivers don't have TIOCGSERIAL/TIOCSSERIAL
+        print('ASYNC_LOW_LATENCY not supported on {0}: {1}'.format(connection.port, e))
+    else:
+        applied['asyncLowLatency'] = True
+    applied['latencyTimer'] = _setLatencyTimer(connection.port)
+    return applied
+
+def measureTurnaround(connection, address=1, count=50):
+    '''
+    Returns the times in seconds of count current temp reads (request
+    written until response decoded) from the controller at address
+    '''
+    from watlow_driver import PM3
+    controller = PM3(connection=connection, address=address)
+    controller.printFrames = False
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = controller.write('4001')
+        if response is not None and response['error'] is None:
+            times.append(time.perf_counter() - start)
+    return times
+
+def _report(label, times):
+    if not times:
+        print('{0}: no valid responses'.format(label))
+        return
+    times = sorted(times)
+    print('{0}: median {1:.2f} ms, 95% {2:.2f} ms ({3} reads)'.format(
+        label, statistics.median(times) * 1000, times[int(len(times) * 0.95) - 1] * 1000, len(times)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure bus turnaround with and without low latency mode')
+    parser.add_argument('config', help='config .ini file with the [SERIAL] port')
+    parser.add_argument('--address', type=int, default=1)
+    parser.add_argument('--count', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    settings = parseConfig(args.config)
+    try:
+        connection = serial.Serial()
+        autobaud.openPort(connection, settings['port'], settings['baudrate'], settings['timeout'],
+                          autobaud.probeAddress(settings), settings['protocol'])
+    except serial.SerialException as e:
+        print('Could not open port {0}: {1}'.format(settings['port'], e))
+        return 1
+    try:
+        _report('default', measureTurnaround(connection, args.address, args.count))
+        print('applied: ', configure(connection))
+        _report('low latency', measureTurnaround(connection, args.address, args.count))
+    finally:
+        connection.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
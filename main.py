@@ -1,6 +1,9 @@
+import multiprocessing
+import os
 import sys
-import images_qrc
+import time
 from PyQt5.QtWidgets import QApplication, QMainWindow
+from PyQt5.QtCore import QEvent, QTimer
 from PyQt5.QtGui import QIcon
 from main_ui import Ui_MainWindow
 from control_tab import ControlTabWidget
@@ -14,8 +17,9 @@ class MainWindow(QMainWindow):
         self.ui.setupUi(self)
 
         self.setWindowTitle('Watlow EZ-Zone PM3 Temperature Control')
-        # Icon from: https://icons8.com/icons/set/temperature
-        self.setWindowIcon(QIcon(':icon.ico'))
+        # The embedded resources are large, they are loaded after the first
+        # paint (see event()):
+        self._painted = False
 
         # Tab and Widget Setup
         self.controlTabWidget = ControlTabWidget()
@@ -29,6 +33,25 @@ class MainWindow(QMainWindow):
         self.configTabWidget.tabIndexEmitted.connect(self._changeTab)
         self.configTabWidget.manualAddEmitted.connect(self.controlTabWidget.handleManualAdd)
 
+    def _loadResources(self):
+        import images_qrc
+        # Icon from: https://icons8.com/icons/set/temperature
+        self.setWindowIcon(QIcon(':icon.ico'))
+
+    def event(self, e):
+        '''
+        Queues loading the resources on the first paint. When
+        WATLOW_STARTUP_BENCHMARK is set (see bench_startup.py), also prints
+        the time of the first paint and exits
+        '''
+        if e.type() == QEvent.Paint and not self._painted:
+            self._painted = True
+            QTimer.singleShot(0, self._loadResources)
+            if os.environ.get('WATLOW_STARTUP_BENCHMARK'):
+                print('first-paint {0:.6f}'.format(time.time()), flush=True)
+                QTimer.singleShot(0, QApplication.quit)
+        return super().event(e)
+
     def _displayStatus(self, message):
         self.ui.statusbar.showMessage(message, 10000)
 
@@ -36,6 +59,8 @@ class MainWindow(QMainWindow):
         self.ui.tabWidget.setCurrentIndex(index)
 
 if __name__ == '__main__':
+    # Needed by the optional bus process in the frozen (freeze.py) build:
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -0,0 +1,269 @@
+import serial
+import crcmod
+import struct
+from binascii import hexlify
+
+class PM3Modbus():
+    '''
+    Object representing a Watlow PM3 PID temperature controller on a Modbus
+    RTU bus, with the same write/set interface as watlow_driver.PM3
+
+    * Every parameter is a 32-bit value in two holding registers, low word
+      first (the PM default 'Modbus Word Order')
+    * readParameters() merges the registers of several parameters into as
+      few block reads as possible
+
+    The register numbers below are the relative Modbus addresses from the
+    EZ-ZONE PM user manual (instance 1). They depend on the controller
+    model, check them against the manual for your firmware
+    '''
+    registerDict = {
+        'currentTemp': 360,     # Analog Input 1, Analog Input Value
+        'setpoint': 2160,       # Loop 1, Closed Loop Set Point
+        'heatPower': 1904,      # Loop 1, Heat Power (percent)
+        'alarmState': 1496,     # Alarm 1, Alarm State (enumeration)
+        'loopMode': 1880        # Loop 1, User Control Mode (enumeration)
+    }
+    # Values that are not temperatures, returned as read:
+    rawParameters = {'heatPower': 'f', 'alarmState': 'I', 'loopMode': 'I'}
+    # Standard Bus parameter IDs (BusEngine.commandDict) accepted for
+    # compatibility with PM3:
+    dataParamDict = {'4001': 'currentTemp', '7001': 'setpoint', '8011': 'heatPower', '9002': 'alarmState',
+                     '8001': 'loopMode'}
+
+    # User programmable memory block: pointer n (two registers at
+    # assemblyDefinition + 2n) holds the register of a parameter whose value
+    # is then read at assemblyWorking + 2n
+    assemblyDefinition = 40
+    assemblyWorking = 200
+    assemblySize = 40
+
+    # Registers in one read request (Modbus limit 125) and the largest gap
+    # of unused registers that is read through to merge two blocks:
+    maxBlock = 125
+    maxGap = 20
+    # Write multiple registers response: address, function, register, count, CRC
+    setResponseLength = 8
+
+    def __init__(self, connection, port=None, timeout=0.5, address=1, baudrate=38400):
+        self.port = port
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.address = address
+        if not connection:
+            self.open()
+        else:
+            self.connection = connection
+
+    def open(self):
+        self.connection = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+
+    def close(self):
+        self.connection.flush()
+        self.connection.close()
+
+    def _f_to_c(self, f):
+        return (f - 32) * (5/9)
+
+    def _c_to_f(self, c):
+        return (c * (9/5)) + 32
+
+    def _crc(self, frameBytes):
+        '''
+        Modbus CRC-16 (0xFFFF initial value, 0x8005 polynomial, bit reversed),
+        appended little-endian
+        '''
+        crc_fun = crcmod.mkCrcFun(poly=0x18005, initCrc=0xFFFF, rev=True, xorOut=0)
+        return struct.pack('<H', crc_fun(frameBytes))
+
+    def _buildReadRequest(self, register, count):
+        request = struct.pack('>BBHH', self.address, 0x03, register, count)
+        return request + self._crc(request)
+
+    def _buildSetRequest(self, value, register=None):
+        '''
+        Write multiple registers request (function 0x10) of one float
+        '''
+        if register is None:
+            register = self.registerDict['setpoint']
+        low, high = struct.unpack('<HH', struct.pack('<f', value))
+        request = struct.pack('>BBHHBHH', self.address, 0x10, register, 2, 4, low, high)
+        return request + self._crc(request)
+
+    def _blocks(self, registers):
+        '''
+        Merges the two-register parameters starting at registers into
+        [(first register, count), ...] block reads
+        '''
+        blocks = []
+        for register in sorted(set(registers)):
+            if blocks:
+                start, count = blocks[-1]
+                end = register + 2
+                if register - (start + count) <= self.maxGap and end - start <= self.maxBlock:
+                    blocks[-1] = (start, max(count, end - start))
+                    continue
+            blocks.append((register, 2))
+        return blocks
+
+    def _readResponse(self, function):
+        '''
+        Reads one response frame and returns its data bytes (after the
+        function code). Raises an exception for exception responses, bad
+        check bytes and timeouts
+        '''
+        response = self.connection.read(3)
+        if len(response) < 3:
+            raise Exception('Exception: No response at address {0}'.format(self.address))
+        if response[1] == function | 0x80:
+            response += self.connection.read(2)
+            raise Exception('Exception: Modbus exception {0} at address {1}'.format(response[2], self.address))
+        if function == 0x03:
+            response += self.connection.read(response[2] + 2)
+        else:
+            response += self.connection.read(5)
+        if response[0] != self.address or response[-2:] != self._crc(response[:-2]):
+            print('Invalid Response at address {0}: '.format(self.address), hexlify(response))
+            raise Exception('Exception: Invalid response received from address {0}'.format(self.address))
+        return response[2:-2]
+
+    def _transact(self, request, function):
+        try:
+            self.connection.write(request)
+        except Exception as e:
+            print('Exception: ', e)
+            return None
+        return self._readResponse(function)
+
+    def _decode(self, name, registers):
+        '''
+        Decodes the two registers (low word first) of a parameter
+        '''
+        raw = struct.pack('<HH', *registers)
+        if name in self.rawParameters:
+            return struct.unpack('<' + self.rawParameters[name], raw)[0]
+        return self._f_to_c(struct.unpack('<f', raw)[0])
+
+    def readParameters(self, names):
+        '''
+        Reads several parameters (keys of registerDict) in as few block reads
+        as possible. Returns ({name: response dict}, number of transactions),
+        or (None, 0) if the request could not be written
+        '''
+        registers = {name: self.registerDict[name] for name in names}
+        blocks = self._blocks(registers.values())
+        values = {}
+        errors = {}
+        for start, count in blocks:
+            try:
+                data = self._transact(self._buildReadRequest(start, count), 0x03)
+            except Exception as e:
+                for name, register in registers.items():
+                    if start <= register < start + count:
+                        errors[name] = e
+                continue
+            if data is None:
+                return None, 0
+            words = struct.unpack('>{0}H'.format(count), data[1:1 + 2 * count])
+            for name, register in registers.items():
+                if start <= register < start + count:
+                    offset = register - start
+                    values[name] = self._decode(name, words[offset:offset + 2])
+        output = {}
+        for name in names:
+            output[name] = {
+                'address': self.address,
+                'data': values.get(name),
+                'error': errors.get(name)
+            }
+        return output, len(blocks)
+
+    def programAssembly(self, dataParams):
+        '''
+        Points the first assembly pointers at the parameters in dataParams
+        (registerDict keys or Standard Bus IDs) so readAssembly() gets all of
+        them in one block read. Returns False if a pointer was not accepted
+        '''
+        if len(dataParams) > self.assemblySize:
+            raise ValueError('At most {0} parameters fit in the assembly'.format(self.assemblySize))
+        for i, dataParam in enumerate(dataParams):
+            register = self.registerDict[self.dataParamDict.get(dataParam, dataParam)]
+            request = struct.pack('>BBHHBHH', self.address, 0x10, self.assemblyDefinition + 2 * i, 2, 4, register, 0)
+            try:
+                if self._transact(request + self._crc(request), 0x10) is None:
+                    return False
+            except Exception as e:
+                print('Assembly pointer not accepted at address {0}: '.format(self.address), e)
+                return False
+        self.assemblyParams = list(dataParams)
+        return True
+
+    def readAssembly(self, temperatures=('4001', '7001')):
+        '''
+        Reads every parameter mapped by programAssembly in one block read.
+        Returns {dataParam: response dict} (temperatures in degrees C), or
+        None if the request could not be written
+        '''
+        params = getattr(self, 'assemblyParams', [])
+        try:
+            data = self._transact(self._buildReadRequest(self.assemblyWorking, 2 * len(params)), 0x03)
+        except Exception as e:
+            return {dataParam: {'address': self.address, 'data': None, 'error': e} for dataParam in params}
+        if data is None:
+            return None
+        words = struct.unpack('>{0}H'.format(2 * len(params)), data[1:1 + 4 * len(params)])
+        output = {}
+        for i, dataParam in enumerate(params):
+            name = self.dataParamDict.get(dataParam, dataParam)
+            output[dataParam] = {'address': self.address, 'data': self._decode(name, words[2 * i:2 * i + 2]),
+                                 'error': None}
+        return output
+
+    def write(self, dataParam):
+        '''
+        Reads one parameter ('4001'/'7001' as for PM3, or a registerDict key)
+        and returns a dict containing the response data and address
+        '''
+        name = self.dataParamDict.get(dataParam, dataParam)
+        output, transactions = self.readParameters([name])
+        if output is not None:
+            return output[name]
+
+    def _readSetResponse(self):
+        '''
+        Reads the response to a set request written by the caller
+        '''
+        return self.connection.read(self.setResponseLength)
+
+    def _parseSetResponse(self, bytesResponse, value):
+        '''
+        Checks a write multiple registers response (it echoes the register
+        and count, not the value) and returns the response dict with the
+        value written (degrees C)
+        '''
+        try:
+            if len(bytesResponse) < self.setResponseLength:
+                raise Exception('Exception: No response at address {0}'.format(self.address))
+            if bytesResponse[0] != self.address or bytesResponse[-2:] != self._crc(bytesResponse[:-2]) or \
+               struct.unpack('>BHH', bytesResponse[1:6]) != (0x10, self.registerDict['setpoint'], 2):
+                print('Invalid Response at address {0}: '.format(self.address), hexlify(bytesResponse))
+                raise Exception('Exception: Invalid response received from address {0}'.format(self.address))
+        except Exception as e:
+            return {'address': self.address, 'data': None, 'error': e}
+        return {'address': self.address, 'data': value, 'error': None}
+
+    def set(self, value):
+        '''
+        Changes the PM3 temperature setpoint (value in degrees C) and returns
+        the response dict
+        '''
+        request = self._buildSetRequest(self._c_to_f(value))
+        try:
+            self.connection.write(request)
+        except Exception as e:
+            print('Exception: ', e)
+        else:
+            return self._parseSetResponse(self.connection.read(self.setResponseLength), value)
+
+    def updateSerial(self, serialObj):
+        self.connection = serialObj
@@ -0,0 +1,269 @@
+'''
+Listen-only monitoring of a bus driven by another master (e.g. a PLC)
+
+With 'monitor=yes' in [SERIAL] nothing is ever written to the port. A
+BusMonitor reads the raw byte stream, reassembles every Standard Bus frame
+(codec.FrameAssembler), matches each response to the last request sent to
+its zone and publishes the decoded values through the BusEngine's listeners,
+so the display, history, watchdog and API get them as if they were polled.
+
+The port is read on one thread and frames are decoded and published on
+another, so slow listeners (e.g. history commits) back up the queue between
+them rather than the port's input buffer. A fully loaded 38400 baud bus is
+about 180 frames per second; python bench_codec.py shows the decode rate.
+'''
+import queue
+import threading
+import time
+import serial
+
+import codec
+import parameters
+
+# Service bytes (frame[9]) of read and set requests and read responses:
+readService = 0x03
+setService = 0x04
+
+class BusMonitor():
+    '''
+    Decodes the traffic on an open serial port into BusEngine readings. The
+    engine is switched to listen-only while the monitor runs
+    '''
+    # Bytes read at most at once, and chunks waiting to be decoded at most
+    # (further chunks are dropped and counted):
+    chunkSize = 4096
+    maxBacklog = 1000
+
+    def __init__(self, engine, connection):
+        self.engine = engine
+        self.connection = connection
+        self.assembler = codec.FrameAssembler()
+        # Parameter and monotonic time of the last request by zone:
+        self._pending = {}
+        self._chunks = queue.Queue(self.maxBacklog)
+        self._stop = threading.Event()
+        self._threads = []
+
+        # Metrics, see stats():
+        self.bytesRead = 0
+        self.requests = 0
+        self.responses = 0
+        self.matched = 0
+        # Requests that got no response before the next one to their zone,
+        # and responses without a request (e.g. the monitor started between
+        # them):
+        self.unanswered = 0
+        self.unmatched = 0
+        # Frames from zones no address maps to, requests for parameters not
+        # in parameters.py (their responses are not decoded), frames that
+        # could not be decoded, and bytes dropped because the decode thread
+        # fell behind:
+        self.unknownZones = 0
+        self.unknownParameters = 0
+        self.errors = 0
+        self.droppedBytes = 0
+        # Chunks waiting to be decoded, the most so far:
+        self.backlog = 0
+        # Running average of request to response time (seconds):
+        self.responseTime = None
+
+    def start(self):
+        self.engine.listenOnly = True
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._readLoop, name='BusMonitorRead', daemon=True),
+                         threading.Thread(target=self._decodeLoop, name='BusMonitorDecode', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.engine.listenOnly = False
+
+    def isRunning(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def _readLoop(self):
+        while not self._stop.is_set():
+            try:
+                # Blocks for the first byte (up to the port timeout), then
+                # takes everything that has arrived with it:
+                data = self.connection.read(1)
+                waiting = self.connection.in_waiting
+                if data and waiting:
+                    data += self.connection.read(min(waiting, self.chunkSize))
+            except (OSError, serial.SerialException) as e:
+                print('Bus monitor: ', e)
+                self._reopen()
+                continue
+            if data:
+                self.bytesRead += len(data)
+                try:
+                    self._chunks.put_nowait(data)
+                except queue.Full:
+                    self.droppedBytes += len(data)
+
+    def _reopen(self):
+        '''
+        Re-opens a failed port (adapter unplugged or reset) until it works
+        or the monitor is stopped, telling the engine's port listeners
+        '''
+        port = self.connection.port
+        self.engine._notifyPort({'state': 'lost', 'port': port, 'attempts': 0, 'downtime': 0})
+        lost = time.monotonic()
+        delay = self.engine.minReconnectDelay
+        attempts = 0
+        while not self._stop.wait(delay):
+            attempts += 1
+            try:
+                self.connection.close()
+                self.connection.open()
+            except (OSError, serial.SerialException):
+                delay = min(delay * 2, self.engine.maxReconnectDelay)
+                continue
+            # A frame cut off by the failure can't be completed:
+            self.assembler = codec.FrameAssembler()
+            self.engine.reconnects += 1
+            self.engine.downtime = time.monotonic() - lost
+            self.engine._notifyPort({'state': 'reconnected', 'port': port, 'attempts': attempts,
+                                     'downtime': self.engine.downtime})
+            return
+
+    def _decodeLoop(self):
+        while not self._stop.is_set():
+            try:
+                data = self._chunks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.backlog = max(self.backlog, self._chunks.qsize() + 1)
+            try:
+                self.feed(data)
+            except Exception as e:
+                # Keeps decoding the chunks that follow:
+                self.errors += 1
+                print('Bus monitor: ', e)
+
+    def feed(self, data):
+        '''
+        Decodes received bytes and publishes the values of the complete
+        frames among them. Returns the readings published
+        '''
+        readings = []
+        for frame in self.assembler.feed(data):
+            # The zone is byte 3 of a request, byte 4 of a response:
+            request = frame[2] == 0x05
+            zone = frame[3] if request else frame[4]
+            address = codec.address(zone)
+            if address is None:
+                self.unknownZones += 1
+                continue
+            try:
+                if request:
+                    reading = self._request(frame, zone, address)
+                else:
+                    reading = self._response(frame, zone, address)
+            except Exception as e:
+                self.errors += 1
+                print('Bus monitor: could not decode {0}: {1}'.format(frame.hex(), e))
+                continue
+            if reading is not None:
+                readings.append(reading)
+        return readings
+
+    def _publish(self, address, parameter, response):
+        # Only configured controllers are shown and recorded:
+        if address not in self.engine.controllers:
+            return
+        command = parameter.name if parameter.instance == 1 else '{0}{1}'.format(parameter.name,
+                                                                                 parameter.instance)
+        return self.engine._publish(command, response)
+
+    def _request(self, frame, zone, address):
+        '''
+        Remembers a read request (01 03 01 class member instance) or set
+        request (01 04 class member instance type value) until its response
+        '''
+        self.requests += 1
+        unanswered = self._pending.pop(zone, None)
+        if len(frame) >= 16 and frame[8] == 0x01 and frame[9] == readService and frame[10] == 0x01:
+            self._pending[zone] = (self._parameter(frame[11], frame[12], frame[13]), time.monotonic())
+        elif len(frame) >= 16 and frame[8] == 0x01 and frame[9] == setService:
+            self._pending[zone] = (self._parameter(frame[10], frame[11], frame[12]), time.monotonic())
+        if unanswered is not None:
+            self.unanswered += 1
+        if unanswered is not None and unanswered[0] is not None:
+            return self._publish(address, unanswered[0], {
+                'address': address,
+                'data': None,
+                'error': Exception('Exception: No response at address {0}'.format(address))
+            })
+
+    def _response(self, frame, zone, address):
+        '''
+        Decodes a response with the parameter of the last request to its
+        zone (the bus is half-duplex, so the next response from a zone
+        answers it). A read response (02 03 01 class member instance type
+        value) without a request is decoded from its own parameter bytes
+        '''
+        self.responses += 1
+        pending = self._pending.pop(zone, None)
+        if pending is not None:
+            self.matched += 1
+            elapsed = time.monotonic() - pending[1]
+            if self.responseTime is None:
+                self.responseTime = elapsed
+            self.responseTime += (elapsed - self.responseTime) * 0.2
+            parameter = pending[0]
+        elif len(frame) >= 21 and frame[9] == readService and frame[10] == 0x01:
+            self.unmatched += 1
+            parameter = self._parameter(frame[11], frame[12], frame[13])
+        else:
+            self.unmatched += 1
+            return
+        if parameter is None:
+            return
+        # The type code before the value tells how to decode it:
+        typeCode = frame[-3 - parameter.format.size] if len(frame) > 3 + parameter.format.size else None
+        if typeCode != parameter.typeCode:
+            return self._publish(address, parameter, {
+                'address': address,
+                'data': None,
+                'error': Exception('Exception: Unexpected data type {0} from address {1}'.format(typeCode,
+                                                                                              address))
+            })
+        return self._publish(address, parameter, {
+            'address': address,
+            'data': parameter.decode(frame),
+            'error': None
+        })
+
+    def _parameter(self, paramClass, member, instance):
+        '''
+        Returns the Parameter of a request or response, None (counted) if it
+        is not in parameters.py: its data type is unknown
+        '''
+        try:
+            return parameters.lookup('{0}{1:03d}'.format(paramClass, member), instance)
+        except KeyError:
+            self.unknownParameters += 1
+            return None
+
+    def stats(self):
+        return {
+            'bytes': self.bytesRead,
+            'frames': self.assembler.frames,
+            'skippedBytes': self.assembler.skipped,
+            'requests': self.requests,
+            'responses': self.responses,
+            'matched': self.matched,
+            'unanswered': self.unanswered,
+            'unmatched': self.unmatched,
+            'unknownZones': self.unknownZones,
+            'unknownParameters': self.unknownParameters,
+            'errors': self.errors,
+            'droppedBytes': self.droppedBytes,
+            'maxBacklog': self.backlog,
+            'responseTime': self.responseTime
+        }
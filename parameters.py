@@ -0,0 +1,121 @@
+'''
+Registry of PM3 Standard Bus parameters
+
+Each parameter (one per name and instance) gets its request data built at
+import time: the complete data portion and check bytes of its read request
+and the data prefix of its set request. codec.FrameCodec turns these into
+frames for an address.
+
+To add a parameter, add a row to parameterTable with its ID from the PM
+manual's parameter table. IDs other than 4001 and 7001 have not been checked
+on a controller. A parameter that is not in the table can still be read
+by ID with its data type given (see lookup).
+'''
+import struct
+from codec import dataCrc, dataCheck
+
+# name, ID, data type, units ('F' = temperature, degrees F on the wire), writable
+parameterTable = [
+    ('currentTemp', '4001', 'float', 'F', False),  # Analog Input Value
+    ('setpoint', '7001', 'float', 'F', True),      # Closed Loop Set Point
+    ('loopMode', '8001', 'enum', None, True),      # Control Mode
+    ('heatPower', '8011', 'float', '%', False),    # Heat Power
+    ('alarmState', '9002', 'enum', None, False),   # Alarm State
+]
+
+# Instances (loops/inputs) of every parameter:
+instances = (1, 2)
+
+# Data type: (type code, struct format on the wire). Type codes other than
+# 0x08 (float) are assumptions
+dataTypes = {
+    'float': (0x08, struct.Struct('>f')),
+    'enum': (0x0f, struct.Struct('>H')),
+    'uint32': (0x0a, struct.Struct('>I')),
+}
+
+def splitId(paramId):
+    '''
+    Splits a parameter ID from the manual into class and member numbers
+    (e.g. '4001' to 4, 1)
+    '''
+    paramId = format(int(paramId), '05d')
+    return int(paramId[:2]), int(paramId[2:])
+
+class Parameter():
+    '''
+    One parameter instance with its precompiled request data and decoder
+    '''
+    def __init__(self, name, paramId, instance=1, dataType='float', units=None, writable=False):
+        self.name = name
+        self.id = paramId
+        self.instance = instance
+        self.dataType = dataType
+        self.units = units
+        self.writable = writable
+        self.paramClass, self.member = splitId(paramId)
+        self.typeCode, self.format = dataTypes[dataType]
+
+        # Read request data and data check bytes:
+        data = bytes([0x01, 0x03, 0x01, self.paramClass, self.member, instance])
+        self.readData = data + dataCheck.pack(dataCrc(data))
+
+        # Set request data up to the value (see codec.FrameCodec.setRequest):
+        self.setPrefix = bytes([0x01, 0x04, self.paramClass, self.member, instance, self.typeCode])
+        self.setLength = len(self.setPrefix) + self.format.size
+
+        # Frame sizes of the responses (header, 02 03 01 class member instance
+        # type value, and 02 04 class member instance type value, check bytes):
+        self.readSize = 8 + 7 + self.format.size + 2
+        self.setSize = 8 + 6 + self.format.size + 2
+
+    def decode(self, bytesResponse):
+        '''
+        Returns the value at the end of a read or set response (before the
+        data check bytes), in degrees C for temperatures
+        '''
+        value = self.format.unpack_from(bytesResponse, len(bytesResponse) - 2 - self.format.size)[0]
+        if self.units == 'F':
+            return (value - 32) * (5/9)
+        return value
+
+    def encode(self, value):
+        '''
+        Converts a value (degrees C for temperatures) to wire units
+        '''
+        if self.units == 'F':
+            return (value * (9/5)) + 32
+        return value
+
+# Lookups by (name, instance) and (ID, instance):
+byName = {}
+byId = {}
+for name, paramId, dataType, units, writable in parameterTable:
+    for instance in instances:
+        parameter = Parameter(name, paramId, instance, dataType, units, writable)
+        byName[(name, instance)] = parameter
+        byId[(paramId, instance)] = parameter
+
+# Parameters not in the table looked up with their data type, by (ID,
+# instance, data type), kept apart from byId so a lookup without a data
+# type still fails:
+untabled = {}
+
+def lookup(key, instance=1, dataType=None):
+    '''
+    Returns the Parameter for a name or ID ('currentTemp' or '4001'). An ID
+    not in the table needs its dataType (a key of dataTypes), otherwise
+    KeyError is raised
+    '''
+    parameter = byName.get((key, instance)) or byId.get((str(key), instance))
+    if parameter is not None:
+        if dataType is not None and dataType != parameter.dataType:
+            raise ValueError('Parameter {0} is a {1}, not a {2}'.format(key, parameter.dataType, dataType))
+        return parameter
+    if dataType is None:
+        raise KeyError('Unknown parameter {0} (instance {1}), give its data type'.format(key, instance))
+    key = (str(key), instance, dataType)
+    parameter = untabled.get(key)
+    if parameter is None:
+        parameter = untabled[key] = Parameter(key[0], key[0], instance, dataType)
+    return parameter
@@ -0,0 +1,136 @@
+import math
+import time
+from adaptive import AdaptivePoller
+
+class TempEstimator():
+    '''
+    Kalman filter of one controller's temperature and rate of change
+    (degrees C and degrees C per second)
+
+    Constant-rate model driven by white noise in the rate: between readings
+    the temperature is extrapolated along the estimated rate and its
+    variance grows with the time since the last reading. The process noise
+    is scaled up while readings land further from the prediction than
+    expected (ramp starts, approach to setpoint), so a controller that is
+    not following the model is read more often
+    '''
+    def __init__(self, processNoise, measurementNoise):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        # Running average of innovation^2 / expected variance (at least 1):
+        self.noiseScale = 1.0
+        self.temp = None
+        self.rate = 0.0
+        self.time = None
+        # Covariance of [temp, rate]:
+        self.p00 = self.p01 = self.p11 = 0.0
+
+    def covariance(self, dt):
+        '''
+        Returns the predicted covariance (p00, p01, p11) dt seconds after the
+        last update
+        '''
+        q = self.processNoise * self.noiseScale
+        p00 = self.p00 + 2 * dt * self.p01 + dt * dt * self.p11 + q * dt ** 3 / 3
+        p01 = self.p01 + dt * self.p11 + q * dt * dt / 2
+        p11 = self.p11 + q * dt
+        return p00, p01, p11
+
+    def update(self, temp, readingTime):
+        if self.temp is None:
+            self.temp = temp
+            self.time = readingTime
+            self.p00 = self.measurementNoise
+            # Unknown rate: about 0.1 degrees per second either way
+            self.p11 = 0.01
+            return
+        dt = max(readingTime - self.time, 0)
+        p00, p01, p11 = self.covariance(dt)
+        predicted = self.temp + self.rate * dt
+        s = p00 + self.measurementNoise
+        k0, k1 = p00 / s, p01 / s
+        innovation = temp - predicted
+        self.noiseScale = min(max(self.noiseScale + (innovation ** 2 / s - self.noiseScale) * 0.3, 1), 10000)
+        self.temp = predicted + k0 * innovation
+        self.rate += k1 * innovation
+        self.p00 = (1 - k0) * p00
+        self.p01 = (1 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        self.time = readingTime
+
+    def predict(self, at):
+        '''
+        Returns (temp, standard deviation) at time at
+        '''
+        dt = max(at - self.time, 0)
+        return self.temp + self.rate * dt, math.sqrt(self.covariance(dt)[0])
+
+    def timeToVariance(self, variance, maxTime):
+        '''
+        Returns the time after the last update at which the predicted
+        temperature variance reaches variance (maxTime if it doesn't)
+        '''
+        if self.covariance(maxTime)[0] < variance:
+            return maxTime
+        low, high = 0, maxTime
+        for i in range(30):
+            mid = (low + high) / 2
+            if self.covariance(mid)[0] < variance:
+                low = mid
+            else:
+                high = mid
+        return low
+
+class PredictivePoller(AdaptivePoller):
+    '''
+    Chooses each controller's read interval from a Kalman estimate of its
+    temperature: a controller is read again when the predicted uncertainty
+    (one standard deviation) reaches tolerance degrees
+
+    * A controller holding its setpoint is predictable and is read rarely
+      (down to maxInterval), a ramping or noisy one as often as minInterval
+    * estimate() gives the temperature between readings for display. The
+      extrapolation stops at the setpoint, which the controller settles on
+    * processNoise (degrees^2/s^3) is how quickly the rate of change is
+      assumed to wander, measurementNoise (degrees^2) the sensor noise
+    * Intervals are stretched to fit the bus budget as in AdaptivePoller
+    '''
+    def __init__(self, tolerance, minInterval, maxInterval, processNoise=0.0001, measurementNoise=0.01, budget=10):
+        super().__init__(minInterval, maxInterval, budget=budget)
+        self.tolerance = tolerance
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.estimators = {}
+
+    def update(self, reading):
+        '''
+        BusEngine listener, feeds current temps to the estimators
+        '''
+        super().update(reading)
+        if reading['error'] is not None or reading['command'] != 'currentTemp':
+            return
+        address = reading['address']
+        if address not in self.estimators:
+            self.estimators[address] = TempEstimator(self.processNoise, self.measurementNoise)
+        self.estimators[address].update(reading['data'], reading['time'])
+
+    def estimate(self, address, at=None):
+        '''
+        Returns (temp, standard deviation) in degrees C, or None before the
+        first reading
+        '''
+        estimator = self.estimators.get(address)
+        if estimator is None or estimator.temp is None:
+            return None
+        temp, deviation = estimator.predict(time.time() if at is None else at)
+        setpoint = self._setpoints.get(address)
+        if setpoint is not None and (estimator.temp - setpoint) * (temp - setpoint) < 0:
+            temp = setpoint
+        return temp, deviation
+
+    def interval(self, address):
+        estimator = self.estimators.get(address)
+        if estimator is None or estimator.temp is None:
+            return self.minInterval
+        interval = estimator.timeToVariance(self.tolerance ** 2, self.maxInterval)
+        return min(max(interval, self.minInterval), self.maxInterval)
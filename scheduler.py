@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+
+class PollScheduler():
+    '''
+    Deadline heap of periodic reads, one task per (address, command) key
+
+    * Each task has its own period and phase. Deadlines are computed as
+      anchor + n * period on the monotonic clock, so lateness of one read
+      never shifts the following ones (no accumulated drift)
+    * Deadlines that have already passed when a task is due are skipped and
+      counted in self.missed instead of being run back to back
+    * Sampling jitter (actual read time - deadline) is recorded per key
+    '''
+    def __init__(self):
+        self._heap = []
+        self._tasks = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.missed = 0
+        self.jitter = {}
+
+    def __contains__(self, key):
+        return key in self._tasks
+
+    def keys(self):
+        return list(self._tasks)
+
+    def period(self, key):
+        return self._tasks[key]['period']
+
+    def _push(self, task):
+        task['version'] = next(self._counter)
+        heapq.heappush(self._heap, (task['anchor'] + task['count'] * task['period'], task['version'], task['key']))
+
+    def schedule(self, key, period, phase=0):
+        '''
+        Adds (or replaces) a task that is first due phase seconds from now
+        '''
+        with self._lock:
+            task = {'key': key, 'period': period, 'anchor': time.monotonic() + phase, 'count': 0}
+            self._tasks[key] = task
+            self._push(task)
+
+    def setPeriod(self, key, period):
+        '''
+        Changes a task's period. The next deadline is one new period after the
+        last deadline (or now, if that has already passed)
+        '''
+        with self._lock:
+            task = self._tasks[key]
+            if task['period'] == period:
+                return
+            lastDeadline = task['anchor'] + (task['count'] - 1) * task['period']
+            task['anchor'] = max(lastDeadline + period, time.monotonic())
+            task['count'] = 0
+            task['period'] = period
+            self._push(task)
+
+    def remove(self, key):
+        with self._lock:
+            self._tasks.pop(key, None)
+            self.jitter.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._tasks = {}
+            self._heap = []
+
+    def nextDeadline(self):
+        '''
+        Returns the earliest deadline (monotonic time) or None
+        '''
+        with self._lock:
+            while self._heap:
+                deadline, version, key = self._heap[0]
+                task = self._tasks.get(key)
+                if task is not None and task['version'] == version:
+                    return deadline
+                # Removed or rescheduled task:
+                heapq.heappop(self._heap)
+            return None
+
+    def popDue(self, now=None):
+        '''
+        Returns [(key, deadline), ...] for every task due at now and moves each
+        of them to its next deadline
+        '''
+        if now is None:
+            now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, version, key = heapq.heappop(self._heap)
+                task = self._tasks.get(key)
+                if task is None or task['version'] != version:
+                    continue
+                due.append((key, deadline))
+                task['count'] += 1
+                nextDeadline = task['anchor'] + task['count'] * task['period']
+                if nextDeadline <= now:
+                    # Overrun: skip to the first deadline in the future
+                    skipped = math.floor((now - nextDeadline) / task['period']) + 1
+                    self.missed += skipped
+                    task['count'] += skipped
+                self._push(task)
+        return due
+
+    def recordJitter(self, key, deadline, actual=None):
+        '''
+        Records how late a read started relative to its deadline (seconds)
+        '''
+        if actual is None:
+            actual = time.monotonic()
+        lateness = actual - deadline
+        stats = self.jitter.setdefault(key, {'count': 0, 'mean': 0.0, 'max': 0.0})
+        stats['count'] += 1
+        stats['mean'] += (lateness - stats['mean']) / stats['count']
+        stats['max'] = max(stats['max'], lateness)
+
+    def jitterStats(self):
+        '''
+        Returns the mean and maximum lateness (ms) over all keys
+        '''
+        stats = list(self.jitter.values())
+        count = sum(s['count'] for s in stats)
+        if not count:
+            return {'jitterMean': None, 'jitterMax': None, 'missedDeadlines': self.missed}
+        return {
+            'jitterMean': sum(s['mean'] * s['count'] for s in stats) / count * 1000,
+            'jitterMax': max(s['max'] for s in stats) * 1000,
+            'missedDeadlines': self.missed
+        }
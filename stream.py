@@ -0,0 +1,127 @@
+import collections
+import json
+import struct
+import threading
+
+# Binary record: address (uint8), parameter ID (uint16), time (float64),
+# value (float32, kelvin for temperatures), little-endian. 15 bytes per reading
+binaryRecord = struct.Struct('<BHdf')
+
+# Parameter IDs used in binary records, by engine command name:
+parameterIds = {'currentTemp': 4001, 'setpoint': 7001, 'heatPower': 8011, 'alarmState': 9002, 'loopMode': 8001}
+
+class Subscriber():
+    '''
+    Bounded queue of encoded readings for one stream client
+
+    When the client falls behind, the oldest readings are dropped (counted in
+    self.dropped) so a slow client never holds more than maxlen readings and
+    never blocks the publisher or other clients
+    '''
+    def __init__(self, encoding='json', delta=False, maxlen=256):
+        self.encoding = encoding
+        self.delta = delta
+        self.dropped = 0
+        self.closed = False
+        self._queue = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def put(self, payload):
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(payload)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        '''
+        Waits for readings and returns all queued payloads (empty list on
+        timeout or when closed)
+        '''
+        with self._cond:
+            if not self._queue and not self.closed:
+                self._cond.wait(timeout)
+            payloads = list(self._queue)
+            self._queue.clear()
+            return payloads
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+class StreamHub():
+    '''
+    Fans each reading published by the bus engine out to many subscribers
+
+    Each reading is encoded once per encoding, and whether it changed since
+    the previous reading of the same address/parameter is decided once, so
+    publishing costs one queue append per subscriber
+    '''
+    def __init__(self, temperatures=('currentTemp', 'setpoint')):
+        # Commands whose values are converted to kelvin:
+        self.temperatures = temperatures
+        self.subscribers = []
+        self._lastValues = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, encoding='json', delta=False, maxlen=256):
+        subscriber = Subscriber(encoding, delta, maxlen)
+        with self._lock:
+            self.subscribers = self.subscribers + [subscriber]
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+        subscriber.close()
+
+    def close(self):
+        for subscriber in self.subscribers:
+            self.unsubscribe(subscriber)
+
+    def encode(self, reading):
+        '''
+        Returns {'json': bytes, 'binary': bytes} for one engine reading
+        '''
+        value = reading['data']
+        if reading['command'] in self.temperatures:
+            value += 273.15
+        event = {
+            'address': reading['address'],
+            'parameter': reading['command'],
+            'value': value,
+            'time': reading['time']
+        }
+        return {
+            'json': json.dumps(event).encode('utf-8'),
+            'binary': binaryRecord.pack(reading['address'], parameterIds.get(reading['command'], 0),
+                                        reading['time'], value)
+        }
+
+    def publish(self, reading):
+        '''
+        BusEngine listener, called from the bus thread for each reading
+        '''
+        if reading['error'] is not None:
+            return
+        key = (reading['address'], reading['command'])
+        changed = self._lastValues.get(key) != reading['data']
+        self._lastValues[key] = reading['data']
+
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        encoded = self.encode(reading)
+        for subscriber in subscribers:
+            if changed or not subscriber.delta:
+                subscriber.put(encoded[subscriber.encoding])
+
+    def publishEvent(self, kind, event):
+        '''
+        Sends a non-reading event (e.g. an alarm) to the JSON subscribers
+        '''
+        payload = json.dumps(dict(event, event=kind)).encode('utf-8')
+        for subscriber in self.subscribers:
+            if subscriber.encoding == 'json':
+                subscriber.put(payload)
@@ -0,0 +1,872 @@
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+from adaptive import AdaptivePoller
+from alarms import Watchdog
+from api import ApiServer
+from broker import BrokerConnection, BusBroker
+from bus_process import BusProcess, LatestTable
+from config import parseConfig
+from engine import BusEngine
+from headless import HeadlessPoller
+from monitor import BusMonitor
+from predictive import PredictivePoller
+from scheduler import PollScheduler
+from stream import StreamHub, binaryRecord
+from watlow_driver import PM3
+
+class FakeBus():
+    '''
+    In-memory stand-in for the serial port that answers Standard Bus read
+    and set requests like a PM3 (values in degrees F on the wire). Unread
+    bytes stay in the input like on a port; echo sends requests back before
+    their response and noise is received before the next response. A dead
+    bus fails like an unplugged adapter
+    '''
+    def __init__(self, temps=None, echo=False):
+        self.checks = PM3(connection=self)
+        self.values = {}
+        for address, temp in (temps or {1: 20.0, 2: 21.0}).items():
+            self.values[(address, 4, 1)] = temp
+            self.values[(address, 7, 1)] = 25.0
+        self.requests = []
+        self.echo = echo
+        self.noise = b''
+        self.dead = False
+        self.opened = True
+        self._response = b''
+        # Assembly pointers by address:
+        self.assembly = {}
+
+    def _wire(self, key):
+        # Temperatures (classes 4 and 7) are in degrees F on the wire
+        return self.values[key] * 9 / 5 + 32 if key[1] in (4, 7) else self.values[key]
+
+    def _frame(self, zone, data):
+        header = bytes([0x55, 0xff, 0x06, 0x00, zone]) + struct.pack('>H', len(data))
+        return header + self.checks._headerCheckByte(header) + data + self.checks._dataCheckByte(data)
+
+    def isOpen(self):
+        return self.opened
+
+    def open(self):
+        if self.dead:
+            raise OSError(2, 'No such file or directory')
+        self.opened = True
+
+    def close(self):
+        self.opened = False
+
+    def write(self, request):
+        if self.dead or not self.opened:
+            raise OSError(5, 'Input/output error')
+        request = bytes(request)
+        self.requests.append(request)
+        zone = request[3]
+        address = int(format(zone, 'x')) - 9
+        if request[9] == 0x03 and request[11] == PM3.assemblyClass:
+            data = bytes([0x02, 0x03, 0x01, request[11], request[12], request[13]])
+            for key in self.assembly.get(address, []):
+                data += bytes([0x08]) + struct.pack('>f', self._wire(key))
+        elif request[9] == 0x03:
+            key = (address, request[11], request[12])
+            data = bytes([0x02, 0x03, 0x01, request[11], request[12], request[13], 0x08]) + struct.pack('>f', self._wire(key))
+        elif request[10] == PM3.assemblyClass:
+            # Assembly pointer n (member n) to class, member:
+            pointers = self.assembly.setdefault(address, [])
+            del pointers[request[11] - 1:]
+            pointers.append((address, request[14], request[15]))
+            data = bytes(request[8:18])
+        else:
+            value = struct.unpack('>f', request[14:18])[0]
+            self.values[(address, 7, 1)] = (value - 32) * 5 / 9
+            data = bytes([0x02, 0x04, 0x07, 0x01, 0x01, 0x08]) + struct.pack('>f', value)
+        self._response += (request if self.echo else b'') + self.noise + self._frame(zone, data)
+        self.noise = b''
+        return len(request)
+
+    def read(self, size=1):
+        data, self._response = self._response[:size], self._response[size:]
+        return data
+
+    def reset_input_buffer(self):
+        self._response = b''
+
+class TestBusEngine(unittest.TestCase):
+    '''
+    Test suite for the BusEngine class. Requests are run directly on the test
+    thread (the worker thread is not started)
+    '''
+    def setUp(self):
+        self.bus = FakeBus()
+        self.engine = BusEngine(self.bus)
+        self.engine.addController(1)
+        self.engine.addController(2)
+
+    def test_readAll(self):
+        '''
+        Tests that a sweep publishes the current temp and setpoint of every
+        controller and stores them in the latest-value cache
+        '''
+        readings = []
+        self.engine.addListener(readings.append)
+        self.engine._readAll()
+
+        self.assertEqual(len(readings), 4)
+        self.assertAlmostEqual(self.engine.latest[(1, 'currentTemp')]['data'], 20.0, places=3)
+        self.assertAlmostEqual(self.engine.latest[(2, 'setpoint')]['data'], 25.0, places=3)
+
+    def test_setpointCache(self):
+        '''
+        Tests that fresh setpoints are not re-read by periodic sweeps and
+        that a set response refreshes the cached setpoint (write-through)
+        '''
+        for i in range(3):
+            self.engine._readAll()
+        # 4 reads on the first sweep, then only the two current temps:
+        self.assertEqual(len(self.bus.requests), 8)
+        self.assertEqual(self.engine.stats()['cacheHits'], 4)
+
+        self.engine._set(1, 50.0)
+        self.engine._readAll()
+        self.assertEqual(len(self.bus.requests), 11)
+        self.assertAlmostEqual(self.engine.latest[(1, 'setpoint')]['data'], 50.0, places=3)
+
+        # maxAge of 0 reads every setpoint on every sweep:
+        self.engine.setMaxAge('setpoint', 0)
+        self.engine._readAll()
+        self.assertEqual(len(self.bus.requests), 15)
+
+    def test_setGroup(self):
+        '''
+        Tests that a group commit writes every setpoint, verifies the set
+        responses and reports the skew between the first and last one
+        '''
+        result = self.engine._setGroup({1: 40.0, 2: 45.0})
+        self.assertEqual(result['addresses'], [1, 2])
+        self.assertEqual(result['failed'], [])
+        self.assertGreaterEqual(result['skew'], 0)
+        self.assertAlmostEqual(self.bus.values[(2, 7, 1)], 45.0, places=3)
+        self.assertAlmostEqual(self.engine.latest[(1, 'setpoint')]['data'], 40.0, places=3)
+
+        # Nothing is written when every value is already confirmed:
+        skew = self.engine.groupSkew
+        results = []
+        self.engine.setGroup({1: 40.0, 2: 45.0}, results.append)
+        self.engine._runJob(self.engine._queue.get())
+        self.assertEqual((results[0]['addresses'], results[0]['skew']), ([], None))
+        self.assertEqual(self.engine.groupSkew, skew)
+
+    def test_setGroupMerge(self):
+        '''
+        Tests that group commits merged while waiting are written once and
+        that every caller's callback gets the result
+        '''
+        results = []
+        self.engine.setGroup({1: 40.0}, lambda result: results.append(('first', result)))
+        self.engine.setGroup({2: 45.0}, lambda result: results.append(('second', result)))
+        self.assertEqual(self.engine._queue.qsize(), 1)
+        self.engine._runJob(self.engine._queue.get())
+        self.assertEqual([name for name, result in results], ['first', 'second'])
+        self.assertEqual(results[0][1]['addresses'], [1, 2])
+        self.assertIs(results[0][1], results[1][1])
+
+    def test_setCoalescing(self):
+        '''
+        Tests that only the newest of several waiting setpoint changes is
+        written and that a change to the confirmed setpoint is skipped
+        '''
+        for value in (30.0, 40.0, 50.0):
+            self.engine.set(1, value)
+        self.assertEqual(self.engine._queue.qsize(), 1)
+        self.engine._runJob(self.engine._queue.get())
+        self.assertEqual(len(self.bus.requests), 1)
+        self.assertAlmostEqual(self.bus.values[(1, 7, 1)], 50.0, places=3)
+
+        self.engine.set(1, 50.0)
+        self.engine._runJob(self.engine._queue.get())
+        self.assertEqual(len(self.bus.requests), 1)
+        self.assertEqual(self.engine.stats()['setsCoalesced'], 2)
+        self.assertEqual(self.engine.stats()['setsSkipped'], 1)
+
+    def test_readAllOverrun(self):
+        '''
+        Tests that sweeps requested while a slow sweep is running are merged
+        into one waiting sweep
+        '''
+        gate = threading.Event()
+        writing = threading.Event()
+        write = self.bus.write
+        def slowWrite(request):
+            writing.set()
+            gate.wait()
+            return write(request)
+        self.bus.write = slowWrite
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+
+        self.engine.readAll()
+        self.assertTrue(writing.wait(5))
+        for i in range(3):
+            self.engine.readAll()
+        self.assertEqual((self.engine._queue.qsize(), self.engine.overruns), (1, 2))
+        gate.set()
+        # 4 reads in the first sweep, the current temps in the merged one
+        # (setpoints are still fresh):
+        deadline = time.monotonic() + 5
+        while len(self.bus.requests) < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(len(self.bus.requests), 6)
+        self.assertFalse(self.engine._readAllPending)
+
+    def test_focus(self):
+        '''
+        Tests that a focused controller is read at the focus interval while
+        polling, the others no faster than their share of the bus allows,
+        and that all return to the read interval when focus is cleared
+        '''
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        self.engine.startPolling(60)
+        self.engine.setFocus(1, 0.05)
+        time.sleep(0.5)
+        self.engine.stopPolling()
+        reads = {1: 0, 2: 0}
+        for request in self.bus.requests:
+            if request[11] == 4:
+                reads[int(format(request[3], 'x')) - 9] += 1
+        # One read of each when polling starts, then address 1 only:
+        self.assertGreaterEqual(reads[1], 5)
+        self.assertEqual(reads[2], 1)
+        self.assertEqual(self.engine.scheduler.period((1, 'currentTemp')), self.engine.focusInterval())
+        self.assertLess(self.engine.focusInterval(), 0.1)
+
+        self.engine.setFocus(None)
+        self.engine._syncSchedule(60)
+        for address in (1, 2):
+            self.assertEqual(self.engine.scheduler.period((address, 'currentTemp')), 60)
+
+    def test_assembly(self):
+        '''
+        Tests that the assembly is programmed on first access and then every
+        parameter of a controller is read in one request
+        '''
+        self.bus.values[(1, 8, 11)] = 45.0
+        self.bus.values[(2, 8, 11)] = 0.0
+        self.engine.setAssembly(['currentTemp', 'setpoint', 'heatPower'])
+        readings = []
+        self.engine.addListener(readings.append)
+        self.engine._readAll()
+        # Three pointers and one read per controller:
+        self.assertEqual(len(self.bus.requests), 8)
+        self.assertEqual(len(readings), 6)
+        self.assertAlmostEqual(self.engine.latest[(1, 'heatPower')]['data'], 45.0, places=3)
+        self.assertAlmostEqual(self.engine.latest[(2, 'currentTemp')]['data'], 21.0, places=3)
+
+        self.engine._read(1, 'currentTemp')
+        self.assertEqual(len(self.bus.requests), 9)
+
+    def test_resync(self):
+        '''
+        Tests that echoed requests and a glitch before a response don't
+        cost any reading, and that a priority read discards stale input
+        '''
+        self.bus.echo = True
+        self.bus.noise = b'\x00\x55\x13'
+        readings = []
+        self.engine.addListener(readings.append)
+        self.engine._readAll()
+        self.engine._setGroup({1: 40.0, 2: 45.0})
+        self.assertEqual([r['error'] for r in readings], [None] * 6)
+        self.assertAlmostEqual(self.engine.latest[(2, 'setpoint')]['data'], 45.0, places=3)
+
+        # Late response of address 2 still waiting when address 1 is read:
+        self.bus.echo = False
+        self.bus.write(self.engine.controllers[2]._buildReadRequest('4001'))
+        self.engine.readNow(1)
+        self.engine._runUrgent()
+        self.assertEqual(readings[-1]['address'], 1)
+        self.assertAlmostEqual(readings[-1]['data'], 20.0, places=3)
+
+    def test_reconnect(self):
+        '''
+        Tests that a failed port is re-opened in the background while
+        requests wait, and that a setpoint write that failed is written
+        once the port is back
+        '''
+        events = []
+        self.engine.minReconnectDelay = 0.01
+        self.engine.addPortListener(events.append)
+        self.bus.dead = True
+        self.engine._set(1, 40.0)
+        self.assertFalse(self.engine._portUp.is_set())
+        self.assertEqual(self.engine._queue.qsize(), 1)
+
+        time.sleep(0.05)
+        self.bus.dead = False
+        self.assertTrue(self.engine._portUp.wait(5))
+        self.engine._runJob(self.engine._queue.get())
+        self.assertAlmostEqual(self.bus.values[(1, 7, 1)], 40.0, places=3)
+        self.assertEqual([event['state'] for event in events], ['lost', 'reconnected'])
+        self.assertGreater(events[1]['attempts'], 1)
+        self.assertEqual(self.engine.stats()['reconnects'], 1)
+
+        # A port closed on purpose is not re-opened:
+        self.bus.close()
+        self.engine._read(1, 'currentTemp')
+        self.assertTrue(self.engine._portUp.is_set())
+
+        # Nor one closed (Disconnect) while it was being re-opened:
+        self.bus.open()
+        reopen = self.bus.open
+        def disconnectWhileOpening():
+            self.engine.cancelReconnect()
+            self.bus.close()
+            reopen()
+        self.bus.open = disconnectWhileOpening
+        self.bus.dead = True
+        self.engine._read(1, 'currentTemp')
+        self.bus.dead = False
+        self.assertTrue(self.engine._portUp.wait(5))
+        time.sleep(0.05)
+        self.assertFalse(self.bus.isOpen())
+        self.assertEqual(self.engine.stats()['reconnects'], 1)
+
+    def test_monitor(self):
+        '''
+        Tests that another master's traffic, received in small chunks with
+        noise between frames, is matched and published for the configured
+        controllers, that a request without a response is published as an
+        error and that the engine writes nothing while listening
+        '''
+        plc = FakeBus({1: 30.0, 2: 35.0, 3: 40.0})
+        master = {address: PM3(connection=plc, address=address) for address in (1, 2, 3)}
+        traffic = b''
+        for address, request in ((1, master[1]._buildReadRequest('4001')),
+                                 (3, master[3]._buildReadRequest('4001')),
+                                 (1, master[1]._buildSetRequest(master[1]._c_to_f(50.0))),
+                                 (2, master[2]._buildReadRequest('4001'))):
+            plc.write(request)
+            traffic += bytes(request) + plc.read(64)
+        # No response to the first request, noise before the next:
+        traffic = traffic[:-21] + b'\x00\x55' + traffic[-37:]
+
+        readings = []
+        self.engine.addListener(readings.append)
+        monitor = BusMonitor(self.engine, None)
+        for i in range(0, len(traffic), 5):
+            monitor.feed(traffic[i:i + 5])
+
+        self.assertAlmostEqual(self.engine.latest[(1, 'currentTemp')]['data'], 30.0, places=3)
+        self.assertAlmostEqual(self.engine.latest[(1, 'setpoint')]['data'], 50.0, places=3)
+        self.assertAlmostEqual(self.engine.latest[(2, 'currentTemp')]['data'], 35.0, places=3)
+        self.assertNotIn((3, 'currentTemp'), self.engine.latest)
+        self.assertEqual([reading['address'] for reading in readings if reading['error'] is not None], [2])
+        stats = monitor.stats()
+        self.assertEqual((stats['requests'], stats['matched'], stats['unanswered'], stats['unmatched']),
+                         (5, 4, 1, 0))
+        self.assertEqual(stats['skippedBytes'], 2)
+
+        # Zones no address maps to (another device's traffic) are skipped:
+        other = PM3(connection=None)
+        for zone in (0x1a, 0x1a, 0xff):
+            header = bytes([0x55, 0xff, 0x05, zone, 0x00, 0x00, 0x06])
+            data = bytes.fromhex('010301040101')
+            monitor.feed(header + other._headerCheckByte(header) + data + other._dataCheckByte(data))
+        self.assertEqual((monitor.stats()['unknownZones'], monitor.stats()['errors']), (3, 0))
+
+        # A parameter not in parameters.py (its data type is unknown) is not
+        # decoded:
+        published = len(readings)
+        request = master[1]._buildReadRequest('4002')
+        plc.write(master[1]._buildReadRequest('4001'))
+        monitor.feed(bytes(request) + plc.read(64))
+        self.assertEqual((len(readings), monitor.stats()['unknownParameters'], monitor.stats()['errors']),
+                         (published, 1, 0))
+
+        self.engine.listenOnly = True
+        self.engine._set(1, 20.0)
+        self.engine._read(2, 'currentTemp')
+        self.assertEqual(self.bus.requests, [])
+
+        # Watchdog re-reads must not flush the monitor's unread input:
+        self.bus._response = b'unread'
+        self.engine.readNow(1)
+        self.engine._readUrgent(1, 'currentTemp')
+        self.engine.setPriority(1, 1)
+        self.assertTrue(self.engine._urgent.empty())
+        self.assertEqual((self.bus._response, self.engine.priority), (b'unread', {}))
+
+class TestApiServer(unittest.TestCase):
+    '''
+    Test suite for the ApiServer class (readings are published directly)
+    '''
+    def setUp(self):
+        self.engine = BusEngine(FakeBus())
+        self.engine.addController(1)
+        self.engine.addController(2)
+        self.engine._readAll()
+        self.api = ApiServer(self.engine, port=0, maxTemp=500, names={1: 'Downstream'})
+        self.addCleanup(self.api.stop)
+
+    def test_readings(self):
+        '''
+        Tests kelvin conversion, names, the per-address filter and that a
+        body is cached until the next reading
+        '''
+        readings = json.loads(self.api.readings())['readings']
+        self.assertEqual([controller['address'] for controller in readings], [1, 2])
+        self.assertEqual(readings[0]['name'], 'Downstream')
+        self.assertAlmostEqual(readings[0]['currentTemp']['value'], 293.15, places=3)
+        self.assertAlmostEqual(readings[1]['setpoint']['value'], 298.15, places=3)
+        one = json.loads(self.api.readings(2))['readings']
+        self.assertEqual(one, readings[1:])
+        self.assertEqual(json.loads(self.api.readings(3))['readings'], [])
+
+        body = self.api.readings()
+        self.assertIs(self.api.readings(), body)
+        self.engine._publish('currentTemp', {'address': 1, 'data': 30.0, 'error': None})
+        self.assertAlmostEqual(json.loads(self.api.readings())['readings'][0]['currentTemp']['value'], 303.15,
+                               places=3)
+
+    def test_invalidateWhileBuilding(self):
+        '''
+        Tests that a body built while a reading arrives is not served from
+        the new cache
+        '''
+        api = self.api
+        class Latest(dict):
+            def items(self):
+                api._invalidate(None)
+                return dict.items(self)
+        self.engine.latest = Latest(self.engine.latest)
+        api.readings()
+        self.assertEqual(api._cache, {})
+
+    def test_http(self):
+        '''
+        Tests the HTTP routes for readings and setpoints
+        '''
+        self.api.start()
+        url = 'http://127.0.0.1:{0}'.format(self.api.server.server_address[1])
+        with urllib.request.urlopen(url + '/readings/1') as response:
+            self.assertEqual(json.loads(response.read())['readings'][0]['address'], 1)
+        request = urllib.request.Request(url + '/setpoint', json.dumps({'address': 1, 'temp': 600}).encode())
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        self.assertEqual(error.exception.code, 400)
+        self.assertEqual(self.api.setTemp(3, 300), 'No controller at address 3.')
+        self.assertIsNone(self.api.setTemp(1, 300))
+        self.assertEqual(self.engine._pendingSets, {1: 300 - 273.15})
+
+        # The engine drops writes while listening to another master:
+        self.engine.listenOnly = True
+        request = urllib.request.Request(url + '/setpoint', json.dumps({'address': 2, 'temp': 300}).encode())
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        self.assertEqual(error.exception.code, 409)
+        self.assertNotIn(2, self.engine._pendingSets)
+
+    def test_stream(self):
+        '''
+        Tests one server-sent event round trip: a reading published after a
+        client subscribed arrives as a JSON event in kelvin
+        '''
+        self.api.start()
+        url = 'http://127.0.0.1:{0}/stream'.format(self.api.server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+            while not self.api.stream.subscribers:
+                time.sleep(0.001)
+            self.engine._publish('currentTemp', {'address': 2, 'data': 30.0, 'error': None})
+            line = response.readline()
+            self.assertTrue(line.startswith(b'data: '))
+            event = json.loads(line[6:])
+            self.assertEqual((event['address'], event['parameter']), (2, 'currentTemp'))
+            self.assertAlmostEqual(event['value'], 303.15, places=3)
+
+class TestHeadlessPoller(unittest.TestCase):
+    '''
+    Test suite for the HeadlessPoller setpoint commands (jobs are run
+    directly on the test thread)
+    '''
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        fileName = os.path.join(directory.name, 'config.ini')
+        with open(fileName, 'w') as f:
+            f.write('[GENERAL]\nmaxtemp=500\n[SERIAL]\nport=COM3\n'
+                    '[DOWNSTREAM]\naddress=1\nmode=heat\n[UPSTREAM]\naddress=2\nmode=cool\n')
+        self.poller = HeadlessPoller(parseConfig(fileName))
+        self.bus = FakeBus()
+        self.poller.engine.updateSerial(self.bus)
+
+    def runJobs(self):
+        engine = self.poller.engine
+        while not engine._queue.empty():
+            engine._runJob(engine._queue.get())
+
+    def test_setTemp(self):
+        '''
+        Tests that a setpoint is written to one controller in degrees C and
+        that one above maxtemp is refused
+        '''
+        self.assertTrue(self.poller.setTemp(2, 300))
+        self.runJobs()
+        self.assertAlmostEqual(self.bus.values[(2, 7, 1)], 300 - 273.15, places=3)
+        with self.assertLogs('watlow', 'ERROR'):
+            self.assertFalse(self.poller.setTemp(2, 600))
+        self.assertTrue(self.poller.engine._queue.empty())
+
+    def test_setTempAll(self):
+        '''
+        Tests that only controllers in the matching heat/cool mode are set,
+        as one group commit, and that a setpoint above maxtemp is refused
+        '''
+        with self.assertLogs('watlow', 'INFO') as logs:
+            self.assertTrue(self.poller.setTempAll(350))
+            self.runJobs()
+        self.assertAlmostEqual(self.bus.values[(1, 7, 1)], 350 - 273.15, places=3)
+        self.assertEqual(self.bus.values[(2, 7, 1)], 25.0)
+        self.assertIn('Set 1 controllers', logs.output[-1])
+        self.poller.setTempAll(280)
+        self.runJobs()
+        self.assertAlmostEqual(self.bus.values[(2, 7, 1)], 280 - 273.15, places=3)
+        self.assertAlmostEqual(self.bus.values[(1, 7, 1)], 350 - 273.15, places=3)
+        with self.assertLogs('watlow', 'ERROR'):
+            self.assertFalse(self.poller.setTempAll(501))
+        self.assertIsNone(self.poller.engine._pendingGroup)
+
+    def test_handleCommand(self):
+        '''
+        Tests the stdin commands, including unknown and malformed ones
+        '''
+        self.poller.handleCommand('set 1 310')
+        self.poller.handleCommand('setall 280')
+        self.poller.handleCommand('')
+        self.runJobs()
+        self.assertAlmostEqual(self.bus.values[(1, 7, 1)], 310 - 273.15, places=3)
+        self.assertAlmostEqual(self.bus.values[(2, 7, 1)], 280 - 273.15, places=3)
+        self.poller.handleCommand('read')
+        self.runJobs()
+        self.assertIn((2, 'currentTemp'), self.poller.engine.latest)
+        with self.assertLogs('watlow', 'ERROR') as logs:
+            self.poller.handleCommand('set one 300')
+            self.poller.handleCommand('heat 1')
+            self.poller.handleCommand('set 1 600')
+        self.assertEqual(len(logs.output), 3)
+        self.assertTrue(self.poller.engine._queue.empty())
+
+class TestStreamHub(unittest.TestCase):
+    '''
+    Test suite for the StreamHub and Subscriber classes
+    '''
+    def reading(self, address, command, data, readingTime=1000.0):
+        return {'address': address, 'command': command, 'data': data, 'error': None, 'time': readingTime}
+
+    def test_dropOldest(self):
+        '''
+        Tests that a subscriber that falls behind keeps the newest readings
+        and counts the ones dropped
+        '''
+        hub = StreamHub()
+        slow = hub.subscribe(maxlen=3)
+        fast = hub.subscribe()
+        for i in range(5):
+            hub.publish(self.reading(1, 'heatPower', float(i)))
+        self.assertEqual([json.loads(payload)['value'] for payload in slow.get(0)], [2.0, 3.0, 4.0])
+        self.assertEqual((slow.dropped, len(fast.get(0)), fast.dropped), (2, 5, 0))
+        self.assertEqual(slow.get(0), [])
+        hub.close()
+        self.assertTrue(slow.closed)
+        self.assertEqual(hub.subscribers, [])
+
+    def test_delta(self):
+        '''
+        Tests that delta subscribers only get readings whose value changed,
+        per address and parameter, and that errors are not sent
+        '''
+        hub = StreamHub()
+        delta = hub.subscribe(delta=True)
+        every = hub.subscribe()
+        for address, command, data in ((1, 'currentTemp', 20.0), (1, 'currentTemp', 20.0),
+                                       (2, 'currentTemp', 20.0), (1, 'setpoint', 20.0),
+                                       (1, 'currentTemp', 21.0)):
+            hub.publish(self.reading(address, command, data))
+        hub.publish({'address': 1, 'command': 'currentTemp', 'data': None, 'error': Exception('timeout'),
+                     'time': 1000.0})
+        events = [json.loads(payload) for payload in delta.get(0)]
+        self.assertEqual([(event['address'], event['parameter']) for event in events],
+                         [(1, 'currentTemp'), (2, 'currentTemp'), (1, 'setpoint'), (1, 'currentTemp')])
+        self.assertEqual(len(every.get(0)), 5)
+
+    def test_binary(self):
+        '''
+        Tests the packed binary record of a reading (kelvin for
+        temperatures, parameter ID from the engine command)
+        '''
+        hub = StreamHub()
+        subscriber = hub.subscribe(encoding='binary')
+        hub.publish(self.reading(3, 'setpoint', 25.0, 1234.5))
+        hub.publish(self.reading(3, 'heatPower', 42.5, 1235.5))
+        hub.publishEvent('alarm', {'address': 3})
+        payloads = subscriber.get(0)
+        self.assertEqual([len(payload) for payload in payloads], [15, 15])
+        address, parameter, readingTime, value = binaryRecord.unpack(payloads[0])
+        self.assertEqual((address, parameter, readingTime), (3, 7001, 1234.5))
+        self.assertAlmostEqual(value, 298.15, places=3)
+        self.assertEqual(binaryRecord.unpack(payloads[1])[1::2], (8011, 42.5))
+
+class TestBusBroker(unittest.TestCase):
+    '''
+    Test suite for the BusBroker class, with the bus thread running
+    '''
+    def setUp(self):
+        self.bus = FakeBus()
+        # Holds every bus write until set:
+        self.gate = threading.Event()
+        self.gate.set()
+        write = self.bus.write
+        def gatedWrite(request):
+            self.gate.wait()
+            return write(request)
+        self.bus.write = gatedWrite
+        self.broker = BusBroker(self.bus)
+        self.request = PM3(connection=None)._buildReadRequest('4001')
+
+    def _startBus(self):
+        threading.Thread(target=self.broker._runBus, daemon=True).start()
+        self.addCleanup(self.broker._queue.put, None)
+
+    def test_coalescing(self):
+        '''
+        Tests that identical reads waiting at the same time share one bus
+        transaction and all get its response
+        '''
+        self._startBus()
+        self.gate.clear()
+        responses = []
+        clients = [threading.Thread(target=lambda: responses.append(self.broker.transact(self.request)))
+                   for i in range(3)]
+        for client in clients:
+            client.start()
+        while self.broker.coalesced < 2:
+            time.sleep(0.001)
+        self.gate.set()
+        for client in clients:
+            client.join(5)
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(len(set(responses)), 1)
+        self.assertTrue(PM3(connection=None)._validateResponse(responses[0]))
+        self.assertEqual((len(self.bus.requests), self.broker.transactions), (1, 1))
+        self.assertEqual(self.broker._inflight, {})
+
+    def test_errors(self):
+        '''
+        Tests that a failed transaction answers its clients with an empty
+        response and the bus thread keeps serving, and that a client gives
+        up after transactTimeout when the bus thread is not running, its
+        abandoned transaction never reaching the bus
+        '''
+        self.broker.transactTimeout = 0.05
+        setRequest = bytes(PM3(connection=None)._buildSetRequest(value=100.0))
+        self.assertEqual(self.broker.transact(setRequest), b'')
+        self.assertEqual(self.broker.transact(self.request), b'')
+        self.assertEqual(self.broker._inflight, {})
+        self.assertGreater(BrokerConnection().timeout, BusBroker(self.bus).transactTimeout)
+
+        self.broker.transactTimeout = 5
+        self._startBus()
+        self.assertEqual(len(self.broker.transact(self.request)), 21)
+        self.assertEqual(self.bus.requests, [self.request])
+        self.bus.dead = True
+        self.assertEqual(self.broker.transact(self.request), b'')
+        self.bus.dead = False
+        self.assertEqual(len(self.broker.transact(self.request)), 21)
+
+def _writeTable(name, count):
+    # Writer process of TestBusProcess.test_latestTable
+    table = LatestTable(name, 4)
+    for i in range(1, count + 1):
+        table.write({'address': 1, 'error': None, 'command': 'currentTemp', 'data': float(i), 'time': float(i)})
+        table.write({'address': 1, 'error': None, 'command': 'setpoint', 'data': -float(i), 'time': -float(i)})
+    table.close()
+
+class TestBusProcess(unittest.TestCase):
+    '''
+    Test suite for the bus process shared memory table and stats
+    '''
+    def test_latestTable(self):
+        '''
+        Tests that a reader never returns a torn slot while a writer in
+        another process updates it (each value is written with an equal
+        time)
+        '''
+        table = LatestTable(slots=4)
+        self.addCleanup(table.close, True)
+        writer = multiprocessing.get_context('spawn').Process(target=_writeTable, args=(table.name, 100000))
+        writer.start()
+        reads = 0
+        while writer.is_alive():
+            temp, tempTime, setpoint, setpointTime = table.read(1)
+            self.assertEqual((temp, setpoint), (tempTime, setpointTime))
+            reads += 1
+        writer.join()
+        self.assertEqual(writer.exitcode, 0)
+        self.assertEqual(table.read(1), (100000.0, 100000.0, -100000.0, -100000.0))
+        self.assertGreater(reads, 0)
+
+    def test_stats(self):
+        '''
+        Tests that stats() returns the metrics of the engine in the child
+        process without waiting for them, and that group commit results are
+        passed to their callback (on a pty, nothing answers)
+        '''
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+        busProcess = BusProcess(slots=4)
+        self.addCleanup(busProcess.stop)
+        self.assertEqual(busProcess.stats(), {})
+        busProcess.open(os.ttyname(slave), 38400, 0.1)
+        busProcess.addController(1)
+        results = []
+        busProcess.setGroup({1: 40.0}, results.append)
+        start = time.monotonic()
+        self.assertEqual(busProcess.stats(), {})
+        self.assertLess(time.monotonic() - start, 0.5)
+        end = time.monotonic() + 10
+        while (not busProcess.stats() or not results) and time.monotonic() < end:
+            busProcess.refresh()
+            time.sleep(0.05)
+        stats = busProcess.stats()
+        self.assertEqual(stats['reconnects'], 0)
+        self.assertEqual((results[0]['addresses'], results[0]['failed']), ([1], [1]))
+
+class TestAdaptivePoller(unittest.TestCase):
+    '''
+    Test suite for the AdaptivePoller class
+    '''
+    def reading(self, address, command, data):
+        return {'address': address, 'command': command, 'data': data, 'error': None}
+
+    def test_intervals(self):
+        '''
+        Tests that a controller far from setpoint is read at the fastest rate,
+        a stable one at the slowest, and that the budget stretches intervals
+        '''
+        poller = AdaptivePoller(minInterval=2, maxInterval=60, errorThreshold=2, budget=10)
+        for address, temp in ((1, 100.0), (2, 25.0)):
+            poller.update(self.reading(address, 'setpoint', 25.0))
+            poller.update(self.reading(address, 'currentTemp', temp))
+
+        intervals = poller.intervals([1, 2])
+        self.assertEqual(intervals[1], 2)
+        self.assertEqual(intervals[2], 60)
+
+        poller.budget = 0.25
+        intervals = poller.intervals([1, 2])
+        self.assertLessEqual(sum(1 / interval for interval in intervals.values()), 0.25 + 1e-9)
+
+class TestPredictivePoller(unittest.TestCase):
+    '''
+    Test suite for the PredictivePoller class (reading times passed in)
+    '''
+    def reading(self, address, data, readingTime):
+        return {'address': address, 'command': 'currentTemp', 'data': data, 'error': None, 'time': readingTime}
+
+    def test_estimate(self):
+        '''
+        Tests that a steady ramp is extrapolated between readings and that a
+        controller that stops following the model is read more often
+        '''
+        poller = PredictivePoller(tolerance=0.5, minInterval=1, maxInterval=60)
+        for i in range(20):
+            poller.update(self.reading(1, 25.0 + i, i))
+            poller.update(self.reading(2, 25.0 + i, i))
+        temp, deviation = poller.estimate(1, 21)
+        self.assertAlmostEqual(temp, 46.0, places=1)
+        self.assertLess(deviation, 0.5)
+
+        # Controller 2 levels off at 50 degrees:
+        for i in range(20, 25):
+            poller.update(self.reading(1, 25.0 + i, i))
+            poller.update(self.reading(2, 50.0, i))
+        self.assertGreater(poller.interval(1), 3 * poller.interval(2))
+
+class TestWatchdog(unittest.TestCase):
+    '''
+    Test suite for the Watchdog class (engine requests are queued, not run)
+    '''
+    def reading(self, address, data, readingTime):
+        return {'address': address, 'command': 'currentTemp', 'data': data, 'error': None, 'time': readingTime}
+
+    def test_levels(self):
+        '''
+        Tests the warning/alarm levels and that a controller near its limit
+        is re-read right away and then at the alarm interval
+        '''
+        engine = BusEngine(FakeBus())
+        engine.addController(1)
+        engine.addController(2)
+        events = []
+        watchdog = Watchdog(engine, {1: {'limit': 100, 'maxRate': None}, 2: {'limit': None, 'maxRate': 2}},
+                            interval=0.5, margin=10, lookahead=60)
+        watchdog.addListener(events.append)
+
+        watchdog.check(self.reading(1, 50.0, 0))
+        self.assertEqual(events, [])
+        watchdog.check(self.reading(1, 95.0, 100))
+        self.assertEqual((events[-1]['level'], events[-1]['reason']), ('warning', 'nearLimit'))
+        self.assertEqual(engine.priority[1], 0.5)
+        self.assertEqual(engine._urgent.qsize(), 1)
+
+        watchdog.check(self.reading(1, 101.0, 101))
+        self.assertEqual((events[-1]['level'], events[-1]['reason']), ('alarm', 'overTemp'))
+        watchdog.check(self.reading(1, 50.0, 300))
+        self.assertEqual(events[-1]['level'], 'ok')
+        self.assertNotIn(1, engine.priority)
+
+        watchdog.check(self.reading(2, 20.0, 0))
+        watchdog.check(self.reading(2, 25.0, 1))
+        self.assertEqual((events[-1]['level'], events[-1]['reason']), ('alarm', 'rateOfRise'))
+        self.assertEqual(len(watchdog.active()), 1)
+
+class TestPollScheduler(unittest.TestCase):
+    '''
+    Test suite for the PollScheduler class (times passed in explicitly)
+    '''
+    def test_deadlines(self):
+        '''
+        Tests that deadlines stay on the period grid when reads are late and
+        that missed deadlines are skipped rather than run back to back
+        '''
+        scheduler = PollScheduler()
+        scheduler.schedule((1, 'currentTemp'), 1.0)
+        start = scheduler.nextDeadline()
+
+        # Popped 0.3 s late, the next deadline is still start + 1:
+        due = scheduler.popDue(start + 0.3)
+        self.assertEqual(due, [((1, 'currentTemp'), start)])
+        self.assertAlmostEqual(scheduler.nextDeadline(), start + 1.0)
+        self.assertEqual(scheduler.popDue(start + 0.9), [])
+
+        # 2.5 periods late, deadlines start + 2 and start + 3 are skipped:
+        due = scheduler.popDue(start + 3.5)
+        self.assertEqual(len(due), 1)
+        self.assertAlmostEqual(scheduler.nextDeadline(), start + 4.0)
+        self.assertEqual(scheduler.missed, 2)
+
+        scheduler.recordJitter((1, 'currentTemp'), start, start + 0.002)
+        self.assertAlmostEqual(scheduler.jitterStats()['jitterMax'], 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+from config import parseConfig
+from engine import BusEngine
+from modbus_driver import PM3Modbus
+
+class FakeModbusBus():
+    '''
+    In-memory stand-in for the serial port that answers Modbus RTU read and
+    write holding registers requests (values in degrees F, low word first)
+    '''
+    def __init__(self):
+        self.checks = PM3Modbus(connection=self)
+        self.registers = {}
+        self.requests = []
+        self._response = b''
+        for address in (1, 2):
+            self.setFloat(address, 360, 68.0)
+            self.setFloat(address, 2160, 77.0)
+
+    def setFloat(self, address, register, value):
+        low, high = struct.unpack('<HH', struct.pack('<f', value))
+        self.registers[(address, register)] = low
+        self.registers[(address, register + 1)] = high
+
+    def _register(self, address, register):
+        # Assembly working registers read the register their pointer is set to
+        if 200 <= register < 280:
+            pointer = self.registers.get((address, 40 + (register - 200) // 2 * 2), 0)
+            return self.registers.get((address, pointer + register % 2), 0)
+        return self.registers.get((address, register), 0)
+
+    def write(self, request):
+        request = bytes(request)
+        self.requests.append(request)
+        address, function, register, count = struct.unpack('>BBHH', request[:6])
+        if function == 0x03:
+            words = [self._register(address, register + i) for i in range(count)]
+            response = struct.pack('>BBB{0}H'.format(count), address, function, 2 * count, *words)
+        else:
+            low, high = struct.unpack('>HH', request[7:11])
+            self.registers[(address, register)] = low
+            self.registers[(address, register + 1)] = high
+            response = request[:6]
+        self._response = response + self.checks._crc(response)
+        return len(request)
+
+    def read(self, size=1):
+        data, self._response = self._response[:size], self._response[size:]
+        return data
+
+    def reset_input_buffer(self):
+        self._response = b''
+
+class TestPM3Modbus(unittest.TestCase):
+    '''
+    Test suite for the PM3Modbus class
+    '''
+    def setUp(self):
+        self.bus = FakeModbusBus()
+        self.pm3 = PM3Modbus(connection=self.bus)
+
+    def test_crc(self):
+        '''
+        Tests the Modbus CRC of a read holding registers request
+        '''
+        self.assertEqual(self.pm3._crc(bytes.fromhex('01030000000a')), b'\xc5\xcd')
+        self.assertEqual(self.pm3._buildReadRequest(0, 10), bytes.fromhex('01030000000ac5cd'))
+
+    def test_blocks(self):
+        '''
+        Tests that neighbouring registers are merged into one block read and
+        distant ones are not
+        '''
+        self.assertEqual(self.pm3._blocks([360, 364, 2160]), [(360, 6), (2160, 2)])
+        self.assertEqual(self.pm3._blocks([360, 500]), [(360, 2), (500, 2)])
+
+    def test_readSet(self):
+        '''
+        Tests reads through the PM3 interface, a set and a read of several
+        parameters (current temp and setpoint are too far apart in the
+        register map to be merged, see test_assembly)
+        '''
+        self.assertAlmostEqual(self.pm3.write('4001')['data'], 20.0, places=3)
+        response = self.pm3.set(50.0)
+        self.assertIsNone(response['error'])
+        self.assertAlmostEqual(self.pm3.write('7001')['data'], 50.0, places=3)
+
+        requests = len(self.bus.requests)
+        output, transactions = self.pm3.readParameters(['currentTemp', 'setpoint'])
+        self.assertEqual(transactions, 2)
+        self.assertEqual(len(self.bus.requests), requests + 2)
+        self.assertAlmostEqual(output['currentTemp']['data'], 20.0, places=3)
+        self.assertAlmostEqual(output['setpoint']['data'], 50.0, places=3)
+
+    def test_assembly(self):
+        '''
+        Tests that parameters far apart are read in one block read through
+        the assembly
+        '''
+        self.bus.setFloat(1, 1904, 42.5)
+        self.assertTrue(self.pm3.programAssembly(['4001', '7001', 'heatPower']))
+        requests = len(self.bus.requests)
+        output = self.pm3.readAssembly()
+        self.assertEqual(len(self.bus.requests), requests + 1)
+        self.assertAlmostEqual(output['4001']['data'], 20.0, places=3)
+        self.assertAlmostEqual(output['7001']['data'], 25.0, places=3)
+        self.assertAlmostEqual(output['heatPower']['data'], 42.5, places=3)
+
+    def test_engine(self):
+        '''
+        Tests that the bus engine reads and sets through the Modbus driver
+        '''
+        engine = BusEngine(self.bus, protocol='modbus')
+        engine.addController(1)
+        engine.addController(2)
+        engine._readAll()
+        self.assertAlmostEqual(engine.latest[(2, 'currentTemp')]['data'], 20.0, places=3)
+        result = engine._setGroup({1: 30.0, 2: 35.0})
+        self.assertEqual(result['failed'], [])
+        self.assertAlmostEqual(engine.latest[(2, 'setpoint')]['data'], 35.0, places=3)
+
+    def test_scheduledReads(self):
+        '''
+        Tests that the periodic reads due from a controller are made in one
+        readParameters call, and in one request through the assembly
+        '''
+        engine = BusEngine(self.bus, protocol='modbus')
+        engine.addController(1)
+        engine.addController(2)
+        calls = []
+        for address in (1, 2):
+            controller = engine._controller(address)
+            def readParameters(names, read=controller.readParameters, address=address):
+                calls.append((address, list(names)))
+                return read(names)
+            controller.readParameters = readParameters
+        due = [((address, command), time.monotonic()) for address in (1, 2)
+               for command in ('currentTemp', 'setpoint')]
+        engine._readScheduled(due)
+        self.assertEqual(calls, [(1, ['currentTemp', 'setpoint']), (2, ['currentTemp', 'setpoint'])])
+        self.assertAlmostEqual(engine.latest[(2, 'setpoint')]['data'], 25.0, places=3)
+
+        engine.setAssembly(['currentTemp', 'setpoint'])
+        while not engine._queue.empty():
+            engine._runJob(engine._queue.get())
+        requests = len(self.bus.requests)
+        engine._readScheduled(due)
+        self.assertEqual(len(self.bus.requests), requests + 2)
+        self.assertAlmostEqual(engine.latest[(1, 'currentTemp')]['data'], 20.0, places=3)
+
+    def test_config(self):
+        '''
+        Tests that Modbus through the bus broker (Standard Bus only) is
+        rejected when the config file is read
+        '''
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        fileName = os.path.join(directory.name, 'config.ini')
+        with open(fileName, 'w') as f:
+            f.write('[SERIAL]\nport=COM3\nprotocol=modbus\n')
+        self.assertEqual(parseConfig(fileName)['protocol'], 'modbus')
+        with open(fileName, 'a') as f:
+            f.write('broker=127.0.0.1:8767\n')
+        with self.assertRaises(Exception) as error:
+            parseConfig(fileName)
+        self.assertIn('broker', str(error.exception))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 import unittest
 
 from watlow_driver import PM3
+import parameters
+import codec
+import bulk
+import autobaud
+from config import parseConfig
+import io
+import os
+import tempfile
 from binascii import unhexlify
 
 class TestWatlow(unittest.TestCase):
@@ -168,6 +176,149 @@ class TestWatlow(unittest.TestCase):
             result = self.assertTrue(self.test_pm3_address1._validateResponse(unhexlify(response)), \
                                      msg=response)
 
+    def test_parameterRegistry(self):
+        '''
+        Tests registry lookups by name and ID, second instance requests and
+        that read-only parameters are not set
+        '''
+        self.assertIs(parameters.lookup('currentTemp'), parameters.lookup('4001'))
+        self.assertEqual(self.test_pm3_address1._buildReadRequest('4001', instance=2),
+                         self.test_pm3_address1._buildFrame(bytes.fromhex('010301040102')))
+        self.assertEqual(self.test_pm3_address1._buildSetRequest(value=78.5, instance=1),
+                         unhexlify('55ff051000000aec010407010108429d0000ad74'))
+        response = unhexlify('55FF060010000B8802030104010108468F3638DD0E')
+        self.assertAlmostEqual(parameters.lookup('4001').decode(response),
+                               self.test_pm3_address1._parseResponse(response)['data'])
+        with self.assertRaises(ValueError):
+            self.test_pm3_address1.setParameter('4001', 20.0)
+
+        # IDs not in the table are only decoded with their data type given,
+        # and are not added to the table:
+        with self.assertRaises(KeyError):
+            parameters.lookup('4002')
+        with self.assertRaises(KeyError):
+            self.test_pm3_address1.write('4002')
+        self.assertEqual(parameters.lookup('4002', dataType='enum').format.size, 2)
+        self.assertIs(parameters.lookup('4002', dataType='enum'), parameters.lookup('4002', dataType='enum'))
+        self.assertNotIn(('4002', 1), parameters.byId)
+        with self.assertRaises(ValueError):
+            parameters.lookup('4001', dataType='enum')
+
+    def test_receive(self):
+        '''
+        Tests that responses read into the receive buffer (with and without
+        readinto) are checked and decoded in place, that echoed requests and
+        bytes before a valid header are skipped, and that set requests reuse
+        their template
+        '''
+        response = unhexlify('55FF060010000B8802030104010108468F3638DD0E')
+        reader = codec.FrameReader()
+        frame = reader.read(io.BytesIO(response))
+        self.assertIs(reader.dataView(frame), reader._views[len(response)][1])
+        self.assertTrue(codec.validate(frame, reader.dataView(frame)))
+        self.assertAlmostEqual(self.test_pm3_address1._parseResponse(frame)['data'],
+                               self.test_pm3_address1._parseResponse(response)['data'])
+        self.assertEqual(len(reader.read(io.BytesIO(response[:8]))), 8)
+
+        # Echo of the request, a glitch and a false preamble before the response:
+        request = self.test_pm3_address1._buildReadRequest('4001')
+        stream = io.BytesIO(request + b'\x01\x55\xff\x02' + response + response[:3])
+        self.assertEqual(bytes(reader.read(stream)), response)
+        self.assertEqual((reader.echoes, reader.skipped), (1, 4))
+        self.assertEqual(len(reader.read(stream)), 3)
+
+        # With the expected size, header and data are read in one call (only
+        # what is waiting on a port), the header check byte is only computed
+        # for a header not seen before:
+        class Port(io.BytesIO):
+            in_waiting = 8
+        for stream in (io.BytesIO(response), io.BytesIO(request + response), Port(response)):
+            frame = reader.read(stream, len(response))
+            self.assertEqual(bytes(frame), response)
+            self.assertTrue(reader.validate(frame))
+        self.assertEqual(reader._headers, (response[:8],))
+        frame = reader.read(io.BytesIO(response[:-1] + b'\x00'), len(response))
+        self.assertFalse(reader.validate(frame))
+        frame = reader.read(io.BytesIO(response[:7] + b'\x00' + response[8:]), len(response))
+        self.assertFalse(reader.validate(frame))
+
+        frames = codec.FrameCodec(1)
+        first = frames.setRequest(parameters.lookup('7001'), 78.5)
+        self.assertEqual(first, unhexlify('55ff051000000aec010407010108429d0000ad74'))
+        self.assertIs(frames.setRequest(parameters.lookup('7001'), 81), first)
+        self.assertEqual(first, unhexlify('55ff051000000aec01040701010842a20000c4b8'))
+
+    def test_autobaud(self):
+        '''
+        Tests that the rate a controller answers at is found, cached for the
+        port and probed first the next time, and that the port is left at
+        the cached rate when nothing answers
+        '''
+        class Port():
+            # Answers current temp reads of address 1 at 19200 baud only:
+            def __init__(self):
+                self.port = '/dev/ttyTEST'
+                self.baudrate = 9600
+                self.timeout = 0.5
+                self.probed = []
+                self.answer = True
+                self._response = b''
+            def reset_input_buffer(self):
+                self._response = b''
+            def write(self, request):
+                self.probed.append(self.baudrate)
+                if self.answer and self.baudrate == 19200 and request[3] == codec.zone(1):
+                    self._response = unhexlify('55FF060010000B8802030104010108468F3638DD0E')
+            def read(self, size):
+                data, self._response = self._response[:size], self._response[size:]
+                return data
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        fileName = os.path.join(directory.name, 'baudrates.json')
+        port = Port()
+        self.assertEqual(autobaud.detect(port, address=1, fileName=fileName), 19200)
+        self.assertEqual((port.probed, port.baudrate, port.timeout), ([38400, 19200], 19200, 0.5))
+        self.assertEqual(autobaud.loadCache(fileName), {'/dev/ttyTEST': 19200})
+        port.probed = []
+        self.assertEqual(autobaud.detect(port, address=1, fileName=fileName), 19200)
+        self.assertEqual(port.probed, [19200])
+        port.answer = False
+        self.assertIsNone(autobaud.detect(port, address=2, fileName=fileName))
+        self.assertEqual(port.baudrate, 19200)
+
+    def test_configDefaults(self):
+        '''
+        Tests that an empty baudrate or timeout in the config file means
+        auto and the default timeout
+        '''
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        fileName = os.path.join(directory.name, 'config.ini')
+        with open(fileName, 'w') as f:
+            f.write('[SERIAL]\nport=COM3\nbaudrate=\ntimeout=\n')
+        settings = parseConfig(fileName)
+        self.assertEqual((settings['baudrate'], settings['timeout']), (None, 0.5))
+
+    @unittest.skipIf(bulk.np is None, 'NumPy not installed')
+    def test_decodeFrames(self):
+        '''
+        Tests that bulk decoding matches _parseResponse frame by frame,
+        including the invalid frame
+        '''
+        responses = [unhexlify(response) for response in (
+            '55FF060010000B8802030104010108468F3638DD0E',
+            '55ff060011000b1002030104010108468f393a07ae',
+            '55ff060011000b100203010701010842960000d3b0',
+            '55ff060010000b8802030104010108468f3abe4356', # Incorrect dataChk
+        )]
+        decoded = bulk.decodeFrames(b''.join(responses) + responses[0][:5])
+        self.assertEqual(list(decoded['address']), [1, 2, 2, 1])
+        self.assertEqual(list(decoded['parameter']), [4001, 4001, 7001, 4001])
+        self.assertEqual(list(decoded['valid']), [True, True, True, False])
+        for response, value in zip(responses[:3], decoded['value']):
+            self.assertAlmostEqual(value, self.test_pm3_address1._parseResponse(response)['data'], places=3)
+
 # These are all confirmed working requests or responses that can be used to test
 # Need some from other addresses and the 'set temp' parameter
 